@@ -1,18 +1,35 @@
-from flask import Flask, jsonify, request, send_file, redirect
+from flask import Flask, jsonify, request, send_file, redirect, Response, stream_with_context
+import click
 import stripe
 import os
 import requests
+import httpx
 import json
 import uuid
 import hashlib
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import base64
+from urllib.parse import quote, urlencode, urlparse
 import io
-import tempfile
+import csv
 import zipfile
-import subprocess
-import shutil
+import tempfile
+import threading
+import queue
+import heapq
+import itertools
+import random
+import time
+import ssl
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, deque
+import numpy as np
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.serialization import pkcs7
 from google.cloud import firestore
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
 from google.oauth2 import service_account
 from firebase_admin import messaging
 import firebase_admin
@@ -21,6 +38,120 @@ from firebase_admin import credentials as admin_credentials  # Changed to avoid
 # Initialize Flask app first 
 app = Flask(__name__)
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Safe now that every transfer carries an idempotency key; also retries 409 "key in use"
+stripe.max_network_retries = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', 2))
+
+# Outbound HTTP: every requests-based call (Stripe, Square) goes through OutboundSession, which
+# shares one set of per-host keep-alive pools, sets connect/read timeouts, retries idempotent
+# calls with jittered backoff and records per-host latency/error metrics
+OUTBOUND_CONNECT_TIMEOUT = float(os.getenv('OUTBOUND_CONNECT_TIMEOUT', 3.05))
+OUTBOUND_READ_TIMEOUT = float(os.getenv('OUTBOUND_READ_TIMEOUT', 30))
+OUTBOUND_POOL_SIZE = int(os.getenv('OUTBOUND_POOL_SIZE', 16))  # keep-alive connections per host
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', 2))
+OUTBOUND_RETRY_BASE_SECONDS = float(os.getenv('OUTBOUND_RETRY_BASE_SECONDS', 0.25))
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+class OutboundMetrics:
+    """Per-host request counts, errors, retries and latency percentiles"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+    
+    def record(self, host, seconds, status=None, error=False, retried=False):
+        with self.lock:
+            metrics = self.hosts.get(host)
+            if metrics is None:
+                metrics = self.hosts[host] = {
+                    'requests': 0, 'errors': 0, 'server_errors': 0, 'retries': 0, 'latencies': deque(maxlen=1000)
+                }
+            metrics['requests'] += 1
+            metrics['latencies'].append(seconds)
+            if error:
+                metrics['errors'] += 1
+            elif status is not None and status >= 500:
+                metrics['server_errors'] += 1
+            if retried:
+                metrics['retries'] += 1
+    
+    def stats(self):
+        with self.lock:
+            hosts = {}
+            for host, metrics in self.hosts.items():
+                latencies = sorted(metrics['latencies'])
+                pick = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1) if latencies else None
+                hosts[host] = {
+                    'requests': metrics['requests'],
+                    'errors': metrics['errors'],
+                    'server_errors': metrics['server_errors'],
+                    'retries': metrics['retries'],
+                    'latency_p50_ms': pick(0.50),
+                    'latency_p95_ms': pick(0.95)
+                }
+        # Connections opened per host pool; far fewer than requests means keep-alive/TLS reuse works
+        pools = outbound_adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            host = pool.host if pool.port in (None, 80, 443) else f"{pool.host}:{pool.port}"
+            if host in hosts:
+                hosts[host]['connections_opened'] = hosts[host].get('connections_opened', 0) + pool.num_connections
+        return hosts
+
+outbound_metrics = OutboundMetrics()
+outbound_adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=OUTBOUND_POOL_SIZE)
+
+class OutboundSession(requests.Session):
+    """requests.Session over the shared pools with default timeouts, jittered retries for
+    idempotent calls (pass idempotent=True for safe POSTs) and per-host metrics"""
+    
+    def __init__(self, max_retries=OUTBOUND_MAX_RETRIES):
+        super().__init__()
+        self.max_retries = max_retries
+        self.mount('https://', outbound_adapter)
+        self.mount('http://', outbound_adapter)
+    
+    def request(self, method, url, idempotent=None, **kwargs):
+        kwargs.setdefault('timeout', (OUTBOUND_CONNECT_TIMEOUT, OUTBOUND_READ_TIMEOUT))
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        host = urlparse(url).netloc
+        
+        for attempt in range(self.max_retries + 1):
+            can_retry = idempotent and attempt < self.max_retries
+            delay = OUTBOUND_RETRY_BASE_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+            start = time.perf_counter()
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                retry = can_retry and not isinstance(e, requests.exceptions.SSLError)
+                outbound_metrics.record(host, time.perf_counter() - start, error=True, retried=retry)
+                if not retry:
+                    raise
+                print(f"⚠️ {method} {host} failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            
+            retry = can_retry and response.status_code in RETRY_STATUSES
+            outbound_metrics.record(host, time.perf_counter() - start, status=response.status_code, retried=retry)
+            if not retry:
+                return response
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = min(float(retry_after), 5.0)
+            response.close()
+            print(f"⚠️ {method} {host} returned {response.status_code}, retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+outbound = OutboundSession()
+
+# Stripe retries itself (max_network_retries, with idempotency keys), so its session doesn't
+stripe.default_http_client = stripe.http_client.RequestsClient(
+    session=OutboundSession(max_retries=0),
+    timeout=(OUTBOUND_CONNECT_TIMEOUT, OUTBOUND_READ_TIMEOUT)
+)
 
 # Initialize Firestore with manual credentials
 creds_dict = json.loads(os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
@@ -33,127 +164,1214 @@ if not firebase_admin._apps:
     firebase_admin.initialize_app(admin_cred)
 
 
+# Merchant payment notifications go through a durable Firestore outbox and are
+# delivered by a background dispatcher in batches (Firestore batch writes + FCM send_each)
+NOTIFY_BATCH_SIZE = int(os.getenv('NOTIFY_BATCH_SIZE', 500))
+NOTIFY_FLUSH_SECONDS = float(os.getenv('NOTIFY_FLUSH_SECONDS', 0.5))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', 5))
+NOTIFY_RETRY_BASE_SECONDS = float(os.getenv('NOTIFY_RETRY_BASE_SECONDS', 2))
+NOTIFY_LEASE_SECONDS = int(os.getenv('NOTIFY_LEASE_SECONDS', 300))
+NOTIFY_RECOVERY_SECONDS = int(os.getenv('NOTIFY_RECOVERY_SECONDS', 60))
+# Retried requests with the same idempotency key (header/body, or the payment's transaction_id)
+# are acknowledged without writing or pushing again for this long
+NOTIFY_DEDUPE_TTL_SECONDS = int(os.getenv('NOTIFY_DEDUPE_TTL_SECONDS', 600))
+NOTIFY_DEDUPE_MAX_KEYS = int(os.getenv('NOTIFY_DEDUPE_MAX_KEYS', 100000))
+# Running revenue totals live in businesses/<id>/revenue_shards, spread over this many
+# documents per period so a busy merchant stays under Firestore's per-document write rate
+REVENUE_SHARDS = int(os.getenv('REVENUE_SHARDS', 10))
+# Collapse a merchant's pushes inside this window into one digest push (0 = off);
+# businesses/<id>.notificationCoalesceSeconds overrides it per merchant
+NOTIFY_COALESCE_SECONDS = float(os.getenv('NOTIFY_COALESCE_SECONDS', 0))
+
+def payment_push_body(customer_name, amount, tip_amount):
+    if tip_amount > 0:
+        return f"{customer_name} paid ${amount:.2f} + ${tip_amount:.2f} tip"
+    return f"{customer_name} paid ${amount:.2f}"
+
+def payment_notification_doc(payload, enqueued_at):
+    """In-app notification record for one payment"""
+    return {
+        'type': 'paymentReceived',
+        'userId': payload['merchant_id'],
+        'amount': payload['amount'],
+        'tipAmount': payload['tip_amount'],
+        'paymentMethod': payload['payment_method'],
+        'customerName': payload['customer_name'],
+        'timestamp': enqueued_at,
+        'isRead': False,
+        # Written in the same batch as the revenue increments; the analytics rollup follows in
+        # its own batch and flips analyticsRolledUp. Backfill folds whatever is still False
+        'rolledUp': True,
+        'analyticsRolledUp': False
+    }
+
+def payment_push_message(payload):
+    """FCM message to the merchant's topic for one payment"""
+    return messaging.Message(
+        notification=messaging.Notification(
+            title='💰 Payment Received!',
+            body=payment_push_body(payload['customer_name'], payload['amount'], payload['tip_amount']),
+        ),
+        data={
+            'type': 'payment_received',
+            'merchant_id': payload['merchant_id'],
+            'amount': str(payload['amount']),
+            'tip_amount': str(payload['tip_amount'])
+        },
+        topic=f"merchant_{payload['merchant_id']}"
+    )
+
+def payment_digest_message(merchant_id, payloads):
+    """One FCM message summarising several payments to the same merchant"""
+    amount = round(sum(payload['amount'] for payload in payloads), 2)
+    tip_amount = round(sum(payload['tip_amount'] for payload in payloads), 2)
+    body = f"{len(payloads)} payments, ${amount:.2f}"
+    if tip_amount > 0:
+        body += f" + ${tip_amount:.2f} tips"
+    return messaging.Message(
+        notification=messaging.Notification(
+            title='💰 Payments Received!',
+            body=body,
+        ),
+        data={
+            'type': 'payments_digest',
+            'merchant_id': merchant_id,
+            'count': str(len(payloads)),
+            'amount': str(amount),
+            'tip_amount': str(tip_amount)
+        },
+        topic=f"merchant_{merchant_id}"
+    )
+
+def to_cents(amount):
+    return int(round(float(amount) * 100))
+
+def revenue_period(when):
+    """Daily revenue bucket (UTC date) for a timestamp"""
+    return when.astimezone(timezone.utc).strftime('%Y-%m-%d')
+
+def add_revenue_increments(write_batch, items):
+    """Fold the payments in items into one Increment per merchant/period on a random shard"""
+    totals = {}
+    for item in items:
+        payload = item['payload']
+        for period in ('lifetime', revenue_period(item['enqueued_at'])):
+            total = totals.setdefault((payload['merchant_id'], period), [0, 0, 0])
+            total[0] += to_cents(payload['amount'])
+            total[1] += to_cents(payload['tip_amount'])
+            total[2] += 1
+    
+    for (merchant_id, period), (revenue_cents, tip_cents, count) in totals.items():
+        shard = random.randrange(REVENUE_SHARDS)
+        shard_ref = db.collection('businesses').document(merchant_id) \
+            .collection('revenue_shards').document(f"{period}_{shard}")
+        write_batch.set(shard_ref, {
+            'period': period,
+            'shard': shard,
+            'revenueCents': firestore.Increment(revenue_cents),
+            'tipCents': firestore.Increment(tip_cents),
+            'count': firestore.Increment(count)
+        }, merge=True)
+
+def analytics_key(value):
+    """Map key safe to use in a Firestore field path"""
+    return ''.join(ch if ch.isalnum() or ch == '_' else '_' for ch in str(value)) or 'unknown'
+
+def analytics_buckets(when):
+    """(bucket id, bucket start) for the hourly and daily rollups a UTC timestamp falls in"""
+    when = when.astimezone(timezone.utc)
+    hour = when.replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    return [(f"hour:{hour.strftime('%Y-%m-%dT%H')}", hour), (f"day:{day.strftime('%Y-%m-%d')}", day)]
+
+def add_analytics_increments(write_batch, items):
+    """Fold the payments in items into hourly and daily rollups under businesses/<id>/analytics.
+    Customers get one document each under the bucket (analytics/<bucket>/customers/<key>), so a
+    busy merchant's day never grows the bucket document toward Firestore's size/index limits"""
+    rollups = {}
+    for item in items:
+        payload = item['payload']
+        amount_cents = to_cents(payload['amount'])
+        tip_cents = to_cents(payload['tip_amount'])
+        customer_name = str(payload.get('customer_name') or 'Customer')
+        customer_key = hashlib.sha1(customer_name.encode('utf-8')).hexdigest()[:12]
+        method_key = analytics_key(payload.get('payment_method') or 'unknown')
+        for bucket, start in analytics_buckets(item['enqueued_at']):
+            rollup = rollups.setdefault((payload['merchant_id'], bucket), {
+                'start': start, 'revenueCents': 0, 'tipCents': 0, 'count': 0, 'methods': {}, 'customers': {}
+            })
+            rollup['revenueCents'] += amount_cents
+            rollup['tipCents'] += tip_cents
+            rollup['count'] += 1
+            rollup['methods'][method_key] = rollup['methods'].get(method_key, 0) + 1
+            customer = rollup['customers'].setdefault(customer_key, {'name': customer_name, 'count': 0, 'revenueCents': 0})
+            customer['count'] += 1
+            customer['revenueCents'] += amount_cents
+    
+    for (merchant_id, bucket), rollup in rollups.items():
+        rollup_ref = db.collection('businesses').document(merchant_id).collection('analytics').document(bucket)
+        write_batch.set(rollup_ref, {
+            'bucket': bucket,
+            'start': rollup['start'],
+            'revenueCents': firestore.Increment(rollup['revenueCents']),
+            'tipCents': firestore.Increment(rollup['tipCents']),
+            'count': firestore.Increment(rollup['count']),
+            'methods': {method: firestore.Increment(count) for method, count in rollup['methods'].items()}
+        }, merge=True)
+        for key, customer in rollup['customers'].items():
+            write_batch.set(rollup_ref.collection('customers').document(key), {
+                'name': customer['name'],
+                'count': firestore.Increment(customer['count']),
+                'revenueCents': firestore.Increment(customer['revenueCents'])
+            }, merge=True)
+
+def is_document_id(value):
+    """Usable as a single Firestore document id (a '/' would turn it into a path)"""
+    return isinstance(value, str) and value not in ('.', '..') and '/' not in value \
+        and not (value.startswith('__') and value.endswith('__'))
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+class TTLCache:
+    """Bounded key -> value cache; entries expire after ttl seconds, oldest evicted first when full"""
+    
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires_at, value), in insertion order
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (now + (self.ttl if ttl is None else ttl), value)
+            # Expired entries sit at the front unless a per-entry ttl reordered them; good enough to bound size
+            while self.entries and (len(self.entries) > self.max_entries or next(iter(self.entries.values()))[0] <= now):
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return entry[1] if entry else None
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+def notification_dedupe_key(merchant_id, idempotency_key):
+    """Document id for the dedupe record, or None without a per-payment key: two identical
+    payments are still two payments, so only an explicit key can mark a retry"""
+    if not idempotency_key:
+        return None
+    return hashlib.sha256(f"{merchant_id}:{idempotency_key}".encode('utf-8')).hexdigest()
+
+def notification_record_ref(item):
+    return db.collection('businesses').document(item['payload']['merchant_id']) \
+        .collection('notifications').document(item['id'])
+
+class NotificationOutbox:
+    """Durable outbox for merchant notifications with a batching background dispatcher"""
+    
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.retries = []  # heap of (ready_at, seq, item)
+        self.retry_seq = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.enqueued = 0
+        self.delivered = 0
+        self.failed_attempts = 0
+        self.dead_lettered = 0
+        self.recovered = 0
+        self.latencies = deque(maxlen=1000)
+        self.windows = {}  # merchant_id -> {'flush_at': epoch, 'items': [...]}
+        self.pushes_sent = 0
+        self.digests_sent = 0
+        self.coalesced = 0
+        self.dedupe = TTLCache(NOTIFY_DEDUPE_TTL_SECONDS, NOTIFY_DEDUPE_MAX_KEYS)
+        self.duplicates_local = 0
+        self.duplicates_shared = 0
+        self.analytics_backlog = []  # written records whose rollup write failed, retried next pass
+    
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='notification-dispatcher', daemon=True)
+                self.thread.start()
+    
+    def enqueue(self, payload, dedupe_key):
+        """Durably record a notification and hand it to the dispatcher.
+        Returns (outbox_id, duplicate); duplicates are not queued again. dedupe_key None skips dedupe"""
+        self.start()
+        
+        # Retries landing on this worker: one dict lookup, no Firestore traffic
+        outbox_id = self.dedupe.get(dedupe_key) if dedupe_key else None
+        if outbox_id:
+            with self.lock:
+                self.duplicates_local += 1
+            return outbox_id, True
+        
+        outbox_ref = db.collection('notification_outbox').document()
+        now = datetime.now(timezone.utc)
+        key_record = {
+            'outboxId': outbox_ref.id,
+            'merchantId': payload['merchant_id'],
+            'createdAt': now,
+            # Firestore TTL policy on expiresAt cleans these up
+            'expiresAt': now + timedelta(seconds=NOTIFY_DEDUPE_TTL_SECONDS)
+        }
+        outbox_record = {
+            'payload': payload,
+            'attempts': 0,
+            'enqueuedAt': now,
+            # This worker owns delivery until the lease runs out; recovery picks it up after
+            'leaseUntil': now + timedelta(seconds=NOTIFY_LEASE_SECONDS)
+        }
+        
+        if not dedupe_key:
+            outbox_ref.set(outbox_record)
+            self.dispatch_later(outbox_ref.id, payload, now)
+            return outbox_ref.id, False
+        
+        # Key and outbox entry commit together, so the create() fails for a retry another worker already took
+        key_ref = db.collection('notification_keys').document(dedupe_key)
+        batch = db.batch()
+        batch.create(key_ref, key_record)
+        batch.set(outbox_ref, outbox_record)
+        try:
+            batch.commit()
+        except AlreadyExists:
+            existing = key_ref.get()
+            expires_at = existing.get('expiresAt') if existing.exists else None
+            if expires_at and expires_at > now:
+                self.dedupe.put(dedupe_key, existing.get('outboxId'), ttl=(expires_at - now).total_seconds())
+                with self.lock:
+                    self.duplicates_shared += 1
+                return existing.get('outboxId'), True
+            
+            # Stale key the TTL policy hasn't deleted yet; take it over unless someone else just did
+            batch = db.batch()
+            option = db.write_option(last_update_time=existing.update_time) if existing.update_time else None
+            batch.update(key_ref, key_record, option=option)
+            batch.set(outbox_ref, outbox_record)
+            batch.commit()
+        
+        self.dedupe.put(dedupe_key, outbox_ref.id)
+        self.dispatch_later(outbox_ref.id, payload, now)
+        return outbox_ref.id, False
+    
+    def dispatch_later(self, outbox_id, payload, enqueued_at):
+        self.queue.put({
+            'id': outbox_id,
+            'payload': payload,
+            'enqueued_at': enqueued_at,
+            'attempts': 0,
+            'written': False
+        })
+        with self.lock:
+            self.enqueued += 1
+    
+    def next_batch(self):
+        """Up to NOTIFY_BATCH_SIZE items, waiting at most NOTIFY_FLUSH_SECONDS to fill it"""
+        batch = []
+        now = time.time()
+        with self.lock:
+            while self.retries and self.retries[0][0] <= now and len(batch) < NOTIFY_BATCH_SIZE:
+                batch.append(heapq.heappop(self.retries)[2])
+        
+        deadline = time.time() + NOTIFY_FLUSH_SECONDS
+        while len(batch) < NOTIFY_BATCH_SIZE:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+    
+    def run(self):
+        # Recover right away: entries orphaned by a restart shouldn't wait for new traffic
+        last_recovery = 0
+        while True:
+            try:
+                units, rejected = self.coalesce(self.next_batch())
+                if units or rejected:
+                    self.dispatch(units, rejected)
+                elif self.analytics_backlog:
+                    self.write_analytics([])
+                if time.time() - last_recovery >= NOTIFY_RECOVERY_SECONDS:
+                    last_recovery = time.time()
+                    self.recover()
+            except Exception as e:
+                print(f"⚠️ Notification dispatcher error: {e}")
+                time.sleep(1)
+    
+    def coalesce(self, items):
+        """Group items into push units: (items, message), plus the items whose payload can't be
+        turned into a notification. Items for merchants with a coalescing window wait in it;
+        a window is flushed as one digest push once it closes"""
+        units, rejected, waiting = [], [], []
+        now = time.time()
+        for item in items:
+            # Build each item's own message first, so a malformed payload fails (and retries or
+            # dead-letters) by itself instead of taking the rest of the batch with it
+            try:
+                message = payment_push_message(item['payload'])
+            except Exception as e:
+                item['error'] = f"Bad notification payload: {e}"
+                rejected.append(item)
+                continue
+            
+            merchant_id = item['payload']['merchant_id']
+            window_seconds = business_index.coalesce_window(merchant_id)
+            if window_seconds is None:
+                window_seconds = NOTIFY_COALESCE_SECONDS
+            if window_seconds <= 0:
+                units.append(([item], message))
+                continue
+            window = self.windows.setdefault(merchant_id, {'flush_at': now + window_seconds, 'items': []})
+            window['items'].append(item)
+            waiting.append((item, window['flush_at']))
+        
+        self.extend_leases(waiting)
+        
+        for merchant_id in [m for m, window in self.windows.items() if window['flush_at'] <= now]:
+            window_items = self.windows.pop(merchant_id)['items']
+            try:
+                if len(window_items) == 1:
+                    message = payment_push_message(window_items[0]['payload'])
+                else:
+                    message = payment_digest_message(merchant_id, [item['payload'] for item in window_items])
+            except Exception as e:
+                for item in window_items:
+                    item['error'] = f"Bad notification payload: {e}"
+                rejected.extend(window_items)
+                continue
+            units.append((window_items, message))
+        return units, rejected
+    
+    def extend_leases(self, waiting):
+        """Hold the lease on items parked in a coalescing window until the window has flushed,
+        so recovery can't re-queue (and double count) a payment that is only waiting"""
+        for chunk in chunks(waiting, 500):
+            try:
+                write_batch = db.batch()
+                for item, flush_at in chunk:
+                    lease_until = datetime.fromtimestamp(flush_at, timezone.utc) + timedelta(seconds=NOTIFY_LEASE_SECONDS)
+                    write_batch.update(db.collection('notification_outbox').document(item['id']), {'leaseUntil': lease_until})
+                write_batch.commit()
+            except Exception as e:
+                print(f"⚠️ Outbox lease renewal failed: {e}")
+    
+    def dispatch(self, units, rejected=()):
+        items = [item for unit_items, _ in units for item in unit_items]
+        
+        # 1. In-app notification records, one per payment even when the push is a digest;
+        # the outbox id doubles as the notification id so retries overwrite. Revenue totals are
+        # incremented in the same batch and the outbox entry is marked, so a recovered entry
+        # never counts a payment twice. 80 items keeps the worst case under 500 writes.
+        unwritten = [item for item in items if not item['written']]
+        for chunk in chunks(unwritten, 80):
+            try:
+                self.write_records(chunk)
+            except Exception as e:
+                print(f"⚠️ Notification batch write failed: {e}")
+                if len(chunk) == 1:
+                    chunk[0]['error'] = str(e)
+                    continue
+                # One bad item fails the whole batch; write the others one at a time so only
+                # the item that actually fails is retried and dead-lettered
+                for item in chunk:
+                    try:
+                        self.write_records([item])
+                    except Exception as e:
+                        print(f"⚠️ Notification record write failed for {item['id']}: {e}")
+                        item['error'] = str(e)
+        
+        # 2. Analytics rollups for the records just written, off the delivery path
+        self.write_analytics([item for item in unwritten if item['written']])
+        
+        # 3. FCM pushes, up to 500 per send_each call; a unit's items share its push result
+        delivered, failed = [], list(rejected)
+        ready = []
+        for unit_items, message in units:
+            if all(item['written'] for item in unit_items):
+                ready.append((unit_items, message))
+            else:
+                failed.extend(unit_items)
+        for chunk in chunks(ready, 500):
+            try:
+                response = messaging.send_each([message for _, message in chunk])
+                results = [(result.success, result.exception) for result in response.responses]
+            except Exception as e:
+                print(f"⚠️ FCM send_each failed: {e}")
+                results = [(False, e)] * len(chunk)
+            for (unit_items, _), (success, exception) in zip(chunk, results):
+                if success:
+                    delivered.extend(unit_items)
+                else:
+                    for item in unit_items:
+                        item['error'] = str(exception)
+                    failed.extend(unit_items)
+        
+        with self.lock:
+            self.pushes_sent += len(ready)
+            self.digests_sent += sum(1 for unit_items, _ in ready if len(unit_items) > 1)
+            self.coalesced += sum(len(unit_items) for unit_items, _ in ready if len(unit_items) > 1)
+        self.settle(delivered, failed)
+    
+    def write_records(self, items):
+        """One batch: notification records, revenue increments and the outbox marks"""
+        write_batch = db.batch()
+        for item in items:
+            write_batch.set(notification_record_ref(item), payment_notification_doc(item['payload'], item['enqueued_at']))
+            write_batch.update(db.collection('notification_outbox').document(item['id']), {'recordWritten': True})
+        add_revenue_increments(write_batch, items)
+        write_batch.commit()
+        for item in items:
+            item['written'] = True
+    
+    def write_analytics(self, items):
+        """Analytics rollups in their own batches, so a rollup problem never holds up delivery.
+        Failed items are retried on later passes; after NOTIFY_MAX_ATTEMPTS they are left
+        (analyticsRolledUp False) for `flask backfill-rollups`"""
+        items = self.analytics_backlog + items
+        self.analytics_backlog = []
+        failed = []
+        for chunk in chunks(items, 80):
+            try:
+                self.fold_analytics(chunk)
+                continue
+            except Exception as e:
+                print(f"⚠️ Analytics rollup write failed: {e}")
+            if len(chunk) == 1:
+                failed.extend(chunk)
+                continue
+            for item in chunk:
+                try:
+                    self.fold_analytics([item])
+                except Exception as e:
+                    print(f"⚠️ Analytics rollup write failed for {item['id']}: {e}")
+                    failed.append(item)
+        
+        for item in failed:
+            item['analytics_attempts'] = item.get('analytics_attempts', 0) + 1
+            if item['analytics_attempts'] < NOTIFY_MAX_ATTEMPTS:
+                self.analytics_backlog.append(item)
+            else:
+                print(f"⚠️ Leaving analytics for {item['id']} to backfill-rollups")
+    
+    def fold_analytics(self, items):
+        """Rollup increments plus the analyticsRolledUp flag on each record, in one batch"""
+        write_batch = db.batch()
+        for item in items:
+            write_batch.update(notification_record_ref(item), {'analyticsRolledUp': True})
+        add_analytics_increments(write_batch, items)
+        write_batch.commit()
+    
+    def settle(self, delivered, failed):
+        """Clear delivered items from the outbox; schedule retries or dead-letter the rest"""
+        now = datetime.now(timezone.utc)
+        retry, dead = [], []
+        for item in failed:
+            item['attempts'] += 1
+            (dead if item['attempts'] >= NOTIFY_MAX_ATTEMPTS else retry).append(item)
+        
+        operations = [('delete', item) for item in delivered + dead] + [('dead', item) for item in dead] + \
+            [('retry', item) for item in retry]
+        for chunk in chunks(operations, 500):
+            try:
+                write_batch = db.batch()
+                for operation, item in chunk:
+                    outbox_ref = db.collection('notification_outbox').document(item['id'])
+                    if operation == 'delete':
+                        write_batch.delete(outbox_ref)
+                    elif operation == 'dead':
+                        write_batch.set(db.collection('notification_dead_letters').document(item['id']), {
+                            'payload': item['payload'],
+                            'attempts': item['attempts'],
+                            'error': item.get('error'),
+                            'enqueuedAt': item['enqueued_at'],
+                            'deadLetteredAt': now
+                        })
+                    else:
+                        write_batch.update(outbox_ref, {
+                            'attempts': item['attempts'],
+                            'lastError': item.get('error'),
+                            'leaseUntil': now + timedelta(seconds=NOTIFY_LEASE_SECONDS)
+                        })
+                write_batch.commit()
+            except Exception as e:
+                # Outbox bookkeeping is best-effort; the lease lets recovery redo it
+                print(f"⚠️ Outbox update failed: {e}")
+        
+        with self.lock:
+            for item in delivered:
+                self.latencies.append((now - item['enqueued_at']).total_seconds())
+            self.delivered += len(delivered)
+            self.failed_attempts += len(failed)
+            self.dead_lettered += len(dead)
+            for item in retry:
+                # Exponential backoff with jitter
+                delay = NOTIFY_RETRY_BASE_SECONDS * 2 ** (item['attempts'] - 1) * random.uniform(0.5, 1.5)
+                heapq.heappush(self.retries, (time.time() + delay, next(self.retry_seq), item))
+        
+        if delivered:
+            print(f"✅ Delivered {len(delivered)} merchant notifications")
+        for item in dead:
+            print(f"☠️ Dead-lettered notification {item['id']}: {item.get('error')}")
+    
+    def recover(self):
+        """Claim outbox entries whose lease expired (e.g. a worker died mid-delivery)"""
+        now = datetime.now(timezone.utc)
+        stale = db.collection('notification_outbox').where('leaseUntil', '<', now).limit(NOTIFY_BATCH_SIZE).stream()
+        for outbox_doc in stale:
+            try:
+                # Precondition on update_time so two workers can't both claim it
+                option = db.write_option(last_update_time=outbox_doc.update_time) if outbox_doc.update_time else None
+                outbox_doc.reference.update({'leaseUntil': now + timedelta(seconds=NOTIFY_LEASE_SECONDS)}, option=option)
+            except Exception:
+                continue
+            record = outbox_doc.to_dict()
+            self.queue.put({
+                'id': outbox_doc.id,
+                'payload': record['payload'],
+                'enqueued_at': record['enqueuedAt'],
+                'attempts': record.get('attempts', 0),
+                'written': record.get('recordWritten', False)
+            })
+            with self.lock:
+                self.recovered += 1
+    
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            pick = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1) if latencies else None
+            return {
+                'queue_depth': self.queue.qsize(),
+                'retry_depth': len(self.retries),
+                'enqueued': self.enqueued,
+                'delivered': self.delivered,
+                'failed_attempts': self.failed_attempts,
+                'dead_lettered': self.dead_lettered,
+                'recovered': self.recovered,
+                'duplicates_suppressed': self.duplicates_local + self.duplicates_shared,
+                'duplicates_local': self.duplicates_local,
+                'duplicates_shared': self.duplicates_shared,
+                'dedupe_cache': self.dedupe.stats(),
+                'pushes_sent': self.pushes_sent,
+                'digests_sent': self.digests_sent,
+                'coalesced_payments': self.coalesced,
+                'open_windows': len(self.windows),
+                'analytics_backlog': len(self.analytics_backlog),
+                'delivery_latency_p50_ms': pick(0.50),
+                'delivery_latency_p95_ms': pick(0.95)
+            }
+
+notification_outbox = NotificationOutbox()
+
 @app.route('/send-merchant-notification', methods=['POST'])
 def send_merchant_notification():
-    """Send push notification to merchant when payment received"""
+    """Queue a push notification to the merchant when payment received"""
     try:
         data = request.get_json()
         merchant_id = data.get('merchant_id')
+        if not merchant_id:
+            return jsonify({'error': 'merchant_id is required'}), 400
+        if not is_document_id(merchant_id):
+            return jsonify({'error': 'merchant_id is not a valid id'}), 400
+        
         amount = data.get('amount', 0)
         tip_amount = data.get('tip_amount', 0)
-        payment_method = data.get('payment_method', 'unknown')
-        customer_name = data.get('customer_name', 'Customer')
+        if any(isinstance(value, bool) or not isinstance(value, (int, float)) for value in (amount, tip_amount)):
+            return jsonify({'error': 'amount and tip_amount must be numbers'}), 400
         
-        # Create in-app notification in Firestore
-        notification_data = {
-            'type': 'paymentReceived',
-            'userId': merchant_id,
+        payload = {
+            'merchant_id': merchant_id,
             'amount': amount,
-            'tipAmount': tip_amount,
-            'paymentMethod': payment_method,
-            'customerName': customer_name,
-            'timestamp': firestore.SERVER_TIMESTAMP,
-            'isRead': False
+            'tip_amount': tip_amount,
+            'payment_method': data.get('payment_method', 'unknown'),
+            'customer_name': data.get('customer_name', 'Customer')
         }
         
-        db.collection('businesses').document(merchant_id).collection('notifications').add(notification_data)
+        # Only a per-payment key marks a retry; without one every request is a new payment
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key') \
+            or data.get('transaction_id')
+        dedupe_key = notification_dedupe_key(merchant_id, idempotency_key)
         
-        # Send FCM push notification
-        try:
-            # Build the notification message
-            if tip_amount > 0:
-                body = f"{customer_name} paid ${amount:.2f} + ${tip_amount:.2f} tip"
-            else:
-                body = f"{customer_name} paid ${amount:.2f}"
-            
-            message = messaging.Message(
-                notification=messaging.Notification(
-                    title='💰 Payment Received!',
-                    body=body,
-                ),
-                data={
-                    'type': 'payment_received',
+        # Durable enqueue only; Firestore record + FCM push happen in the dispatcher
+        outbox_id, duplicate = notification_outbox.enqueue(payload, dedupe_key)
+        if duplicate:
+            return jsonify({'success': True, 'queued': False, 'duplicate': True, 'id': outbox_id}), 200
+        
+        return jsonify({'success': True, 'queued': True, 'id': outbox_id}), 202
+        
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return jsonify({'error': str(e)}), 400
+
+@app.before_first_request
+def start_notification_outbox():
+    notification_outbox.start()
+
+@app.route('/debug/notification-outbox', methods=['GET'])
+def debug_notification_outbox():
+    return jsonify(notification_outbox.stats())
+
+ANALYTICS_BACKFILL_PAGE_SIZE = int(os.getenv('ANALYTICS_BACKFILL_PAGE_SIZE', 100))
+
+def backfill_merchant_rollups(merchant_id, page_size=ANALYTICS_BACKFILL_PAGE_SIZE):
+    """Fold existing paymentReceived notifications into the revenue counters and analytics
+    rollups, one page at a time. Safe to rerun: folded notifications are marked rolledUp /
+    analyticsRolledUp. Records whose analytics the dispatcher may still be writing (younger
+    than NOTIFY_LEASE_SECONDS) are left to it"""
+    notifications = db.collection('businesses').document(merchant_id).collection('notifications').order_by('timestamp')
+    in_flight_after = datetime.now(timezone.utc) - timedelta(seconds=NOTIFY_LEASE_SECONDS)
+    folded = 0
+    last_doc = None
+    while True:
+        page_query = notifications.limit(page_size)
+        if last_doc is not None:
+            page_query = page_query.start_after(last_doc)
+        page = list(page_query.stream())
+        if not page:
+            break
+        last_doc = page[-1]
+        
+        entries = []
+        for notification_doc in page:
+            notification = notification_doc.to_dict()
+            if notification.get('type') != 'paymentReceived' or not notification.get('timestamp'):
+                continue
+            revenue_pending = not notification.get('rolledUp')
+            # Records from before the split carry no analyticsRolledUp and were folded with revenue
+            analytics_pending = revenue_pending or notification.get('analyticsRolledUp') is False
+            if not analytics_pending or (not revenue_pending and notification['timestamp'] > in_flight_after):
+                continue
+            item = {
+                'payload': {
                     'merchant_id': merchant_id,
-                    'amount': str(amount),
-                    'tip_amount': str(tip_amount)
+                    'amount': notification.get('amount', 0),
+                    'tip_amount': notification.get('tipAmount', 0),
+                    'payment_method': notification.get('paymentMethod', 'unknown'),
+                    'customer_name': notification.get('customerName', 'Customer')
                 },
-                topic=f'merchant_{merchant_id}'
-            )
-            
-            # Send the message
-            response = messaging.send(message)
-            print(f'✅ Push notification sent: {response}')
-            
-        except Exception as fcm_error:
-            print(f'⚠️ FCM error (notification still created): {fcm_error}')
-            # Don't fail the whole request if push fails
+                'enqueued_at': notification['timestamp']
+            }
+            entries.append((item, notification_doc.reference, notification_doc.update_time, revenue_pending))
+        
+        # 80 per batch keeps the analytics writes (buckets + customer documents) under 500
+        for chunk in chunks(entries, 80):
+            write_batch = db.batch()
+            for _, ref, update_time, _ in chunk:
+                # Precondition so a concurrent backfill can't fold the same notification twice
+                option = db.write_option(last_update_time=update_time) if update_time else None
+                write_batch.update(ref, {'rolledUp': True, 'analyticsRolledUp': True}, option=option)
+            add_revenue_increments(write_batch, [item for item, _, _, revenue_pending in chunk if revenue_pending])
+            add_analytics_increments(write_batch, [item for item, _, _, _ in chunk])
+            write_batch.commit()
+            folded += len(chunk)
+        
+        if len(page) < page_size:
+            break
+    return folded
+
+@app.cli.command('backfill-rollups')
+@click.argument('merchant_ids', nargs=-1)
+def backfill_rollups_command(merchant_ids):
+    """Fold historical payment notifications into revenue counters and analytics rollups"""
+    if not merchant_ids:
+        merchant_ids = [business.id for business in db.collection('businesses').stream()]
+    for merchant_id in merchant_ids:
+        folded = backfill_merchant_rollups(merchant_id)
+        click.echo(f"✅ {merchant_id}: folded {folded} payments")
+
+ANALYTICS_TOP_CUSTOMERS = int(os.getenv('ANALYTICS_TOP_CUSTOMERS', 5))
+# Customers read per bucket before merging across the range; the top customers of the range
+# are taken from each bucket's leaders, so keep this a few times ANALYTICS_TOP_CUSTOMERS
+ANALYTICS_CUSTOMERS_PER_BUCKET = int(os.getenv('ANALYTICS_CUSTOMERS_PER_BUCKET', 20))
+
+def bucket_top_customers(rollup_ref):
+    """(key, customer) for the highest-revenue customers of one analytics bucket"""
+    customers = rollup_ref.collection('customers') \
+        .order_by('revenueCents', direction=firestore.Query.DESCENDING).limit(ANALYTICS_CUSTOMERS_PER_BUCKET).stream()
+    return [(customer_doc.id, customer_doc.to_dict()) for customer_doc in customers]
+
+@app.route('/merchant-analytics/<merchant_id>', methods=['GET'])
+def get_merchant_analytics(merchant_id):
+    """Pre-aggregated hourly or daily series: revenue, tip rate, payment-method mix, top customers"""
+    try:
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in ('hour', 'day'):
+            return jsonify({'error': 'granularity must be hour or day'}), 400
+        
+        now = datetime.now(timezone.utc)
+        default_span = timedelta(hours=24) if granularity == 'hour' else timedelta(days=30)
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else now
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else end - default_span
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        if end.tzinfo is None:
+            end = end.replace(tzinfo=timezone.utc)
+        
+        first_bucket = analytics_buckets(start)[0 if granularity == 'hour' else 1][0]
+        last_bucket = analytics_buckets(end)[0 if granularity == 'hour' else 1][0]
+        rollups = list(db.collection('businesses').document(merchant_id).collection('analytics')
+                       .where('bucket', '>=', first_bucket).where('bucket', '<=', last_bucket).order_by('bucket').stream())
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            bucket_customers = list(pool.map(lambda rollup_doc: bucket_top_customers(rollup_doc.reference), rollups))
+        
+        series = []
+        totals = {'revenueCents': 0, 'tipCents': 0, 'count': 0}
+        methods = {}
+        customers = {}
+        for rollup_doc, top in zip(rollups, bucket_customers):
+            rollup = rollup_doc.to_dict()
+            revenue_cents = rollup.get('revenueCents', 0)
+            tip_cents = rollup.get('tipCents', 0)
+            series.append({
+                'start': rollup['start'].isoformat(),
+                'revenue': revenue_cents / 100,
+                'tips': tip_cents / 100,
+                'tip_rate': round(tip_cents / revenue_cents, 4) if revenue_cents else None,
+                'payments': rollup.get('count', 0),
+                'methods': rollup.get('methods', {})
+            })
+            totals['revenueCents'] += revenue_cents
+            totals['tipCents'] += tip_cents
+            totals['count'] += rollup.get('count', 0)
+            for method, count in rollup.get('methods', {}).items():
+                methods[method] = methods.get(method, 0) + count
+            # Buckets written before customers moved to their own documents keep them inline
+            for key, customer in list(rollup.get('customers', {}).items()) + top:
+                merged = customers.setdefault(key, {'name': customer.get('name'), 'payments': 0, 'revenueCents': 0})
+                merged['payments'] += customer.get('count', 0)
+                merged['revenueCents'] += customer.get('revenueCents', 0)
+        
+        top_customers = sorted(customers.values(), key=lambda c: c['revenueCents'], reverse=True)[:ANALYTICS_TOP_CUSTOMERS]
         
-        return jsonify({'success': True}), 200
+        return jsonify({
+            'success': True,
+            'merchant_id': merchant_id,
+            'granularity': granularity,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'series': series,
+            'summary': {
+                'revenue': totals['revenueCents'] / 100,
+                'tips': totals['tipCents'] / 100,
+                'tip_rate': round(totals['tipCents'] / totals['revenueCents'], 4) if totals['revenueCents'] else None,
+                'payments': totals['count'],
+                'methods': methods,
+                'top_customers': [
+                    {'name': c['name'], 'payments': c['payments'], 'revenue': c['revenueCents'] / 100}
+                    for c in top_customers
+                ]
+            }
+        })
         
     except Exception as e:
         print(f"❌ Error: {e}")
         return jsonify({'error': str(e)}), 400
 
+@app.route('/merchant-revenue/<merchant_id>', methods=['GET'])
+def get_merchant_revenue(merchant_id):
+    """Lifetime and daily revenue/tip/payment totals, summed from the counter shards"""
+    try:
+        day = request.args.get('date') or revenue_period(datetime.now(timezone.utc))
+        datetime.strptime(day, '%Y-%m-%d')
+        
+        totals = {period: {'revenueCents': 0, 'tipCents': 0, 'count': 0} for period in ('lifetime', day)}
+        shards = db.collection('businesses').document(merchant_id).collection('revenue_shards') \
+            .where('period', 'in', ['lifetime', day]).stream()
+        for shard in shards:
+            shard_data = shard.to_dict()
+            total = totals[shard_data['period']]
+            for field in total:
+                total[field] += shard_data.get(field, 0)
+        
+        def as_dollars(total):
+            return {
+                'revenue': total['revenueCents'] / 100,
+                'tips': total['tipCents'] / 100,
+                'payments': total['count']
+            }
+        
+        return jsonify({
+            'success': True,
+            'merchant_id': merchant_id,
+            'lifetime': as_dollars(totals['lifetime']),
+            'daily': dict(as_dollars(totals[day]), date=day)
+        })
+        
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return jsonify({'error': str(e)}), 400
+
+# Process-local mirrors of businesses (card index) and nfc_payments (pending
+# charges), kept current by Firestore listeners so a tap never waits on the network
+NFC_INDEX_ENABLED = os.getenv('NFC_INDEX_ENABLED', 'true').lower() == 'true'
+NFC_INDEX_RESTART_SECONDS = int(os.getenv('NFC_INDEX_RESTART_SECONDS', 30))
+NFC_SWEEP_SECONDS = int(os.getenv('NFC_SWEEP_SECONDS', 60))
+
+class SnapshotCacheUnavailable(Exception):
+    """Raised when a listener isn't live, so the caller must read Firestore"""
+
+class SnapshotCache:
+    """In-memory mirror of a Firestore collection fed by on_snapshot"""
+    
+    collection_name = None
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watch = None
+        self.ready = False
+        self.last_snapshot_at = None
+        self.last_start_attempt = 0
+        self.fallbacks = 0
+        self.restarts = 0
+        self._reset()
+    
+    def _reset(self):
+        raise NotImplementedError
+    
+    def _apply(self, doc_id, data, snapshot):
+        """Index one document; data is None when it was removed"""
+        raise NotImplementedError
+    
+    def start(self):
+        """(Re)subscribe; the first snapshot preloads the whole collection"""
+        with self.lock:
+            if self.watch is not None and self.watch.is_active:
+                return
+            if self.last_start_attempt and time.time() - self.last_start_attempt < NFC_INDEX_RESTART_SECONDS:
+                return
+            if self.watch is not None:
+                self.restarts += 1
+            self.last_start_attempt = time.time()
+            self.ready = False
+        
+        try:
+            self.watch = db.collection(self.collection_name).on_snapshot(self._on_snapshot)
+            print(f"✅ {self.collection_name} listener started")
+        except Exception as e:
+            print(f"⚠️ {self.collection_name} listener failed to start: {e}")
+    
+    def _on_snapshot(self, docs, changes, read_time):
+        with self.lock:
+            if not self.ready:
+                # First snapshot after (re)subscribing is the full collection
+                self._reset()
+                for doc in docs:
+                    self._apply(doc.id, doc.to_dict(), doc)
+            else:
+                for change in changes:
+                    removed = change.type.name == 'REMOVED'
+                    self._apply(change.document.id, None if removed else change.document.to_dict(), change.document)
+            self.ready = True
+            self.last_snapshot_at = time.time()
+    
+    def is_live(self):
+        return self.ready and self.watch is not None and self.watch.is_active
+    
+    def ensure_live(self):
+        """Raise SnapshotCacheUnavailable (and try to resubscribe) if the listener dropped"""
+        if not self.is_live():
+            with self.lock:
+                self.fallbacks += 1
+            self.start()
+            raise SnapshotCacheUnavailable()
+    
+    def listener_stats(self):
+        return {
+            'live': self.is_live(),
+            'fallbacks': self.fallbacks,
+            'restarts': self.restarts,
+            'seconds_since_snapshot': round(time.time() - self.last_snapshot_at, 1) if self.last_snapshot_at else None
+        }
+
+def pay_redirect_base(card_id, business_id, merchant_name):
+    """luxapp://pay deep link for a card, with every component URL-encoded"""
+    query = urlencode({'merchantId': business_id, 'merchant': merchant_name}, quote_via=quote)
+    return f"luxapp://pay/{quote(card_id, safe='')}?{query}"
+
+def pay_redirect_url(redirect_base, amount):
+    """Append the amount suffix (if any) to a precomputed redirect base"""
+    if not amount:
+        return redirect_base
+    return f"{redirect_base}&amount={quote(str(amount), safe='')}"
+
+class BusinessIndex(SnapshotCache):
+    """nfcCardId -> (business_id, merchant_name, redirect_base), redirect URLs precomputed"""
+    
+    collection_name = 'businesses'
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        super().__init__()
+    
+    def _reset(self):
+        self.by_card = {}
+        self.card_by_business = {}
+        self.coalesce_by_business = {}
+    
+    def _apply(self, business_id, business_data, snapshot):
+        old_card = self.card_by_business.pop(business_id, None)
+        if old_card is not None:
+            self.by_card.pop(old_card, None)
+        coalesce_seconds = business_data.get('notificationCoalesceSeconds') if business_data else None
+        if coalesce_seconds is not None:
+            self.coalesce_by_business[business_id] = float(coalesce_seconds)
+        else:
+            self.coalesce_by_business.pop(business_id, None)
+        card_id = business_data.get('nfcCardId') if business_data else None
+        if card_id:
+            merchant_name = business_data.get('name', 'Unknown Business')
+            self.by_card[card_id] = (business_id, merchant_name, pay_redirect_base(card_id, business_id, merchant_name))
+            self.card_by_business[business_id] = card_id
+    
+    def lookup(self, card_id):
+        """Business for a card, or None if unknown; raises SnapshotCacheUnavailable if not live"""
+        self.ensure_live()
+        with self.lock:
+            business = self.by_card.get(card_id)
+            if business is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return business
+    
+    def coalesce_window(self, business_id):
+        """Merchant's notificationCoalesceSeconds override, or None (also when the index isn't live)"""
+        with self.lock:
+            return self.coalesce_by_business.get(business_id)
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.fallbacks
+            return dict(
+                self.listener_stats(),
+                cards=len(self.by_card),
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=round(self.hits / lookups, 4) if lookups else None
+            )
+
+def charge_expiry(expires_at):
+    """expiresAt as epoch seconds (None if missing); naive values are local time, as before"""
+    if not expires_at or not hasattr(expires_at, 'timestamp'):
+        return None
+    return expires_at.timestamp()
+
+class PendingChargeCache(SnapshotCache):
+    """business_id -> pending nfc_payments charge; expired entries age out on their own"""
+    
+    collection_name = 'nfc_payments'
+    
+    def __init__(self):
+        self.hits = 0
+        self.expired_seen = 0
+        self.swept = 0
+        # Expired docs found on the fallback path, left for the sweeper
+        self.to_sweep = {}
+        super().__init__()
+    
+    def _reset(self):
+        self.charges = {}
+    
+    def _apply(self, business_id, payment_data, snapshot):
+        if not payment_data or payment_data.get('status') != 'pending':
+            self.charges.pop(business_id, None)
+            return
+        self.charges[business_id] = {
+            'amount': payment_data.get('amount'),
+            'expires_at': charge_expiry(payment_data.get('expiresAt')),
+            'update_time': getattr(snapshot, 'update_time', None)
+        }
+    
+    def _live_amount(self, business_id, charge):
+        if charge is None:
+            return None
+        if charge['expires_at'] and charge['expires_at'] > time.time():
+            self.hits += 1
+            return charge['amount']
+        # Expired or no expiry time - treat as expired; the sweeper deletes it
+        self.expired_seen += 1
+        return None
+    
+    def read_pending_amount(self, business_id):
+        """Fallback: read the charge document directly, leaving expired ones for the sweeper"""
+        nfc_payment_doc = db.collection('nfc_payments').document(business_id).get()
+        payment_data = nfc_payment_doc.to_dict() if nfc_payment_doc.exists else None
+        if not payment_data or payment_data.get('status') != 'pending':
+            return None
+        charge = {
+            'amount': payment_data.get('amount'),
+            'expires_at': charge_expiry(payment_data.get('expiresAt')),
+            'update_time': getattr(nfc_payment_doc, 'update_time', None)
+        }
+        with self.lock:
+            amount = self._live_amount(business_id, charge)
+            if amount is None:
+                self.to_sweep[business_id] = charge['update_time']
+            return amount
+    
+    def pending_amount(self, business_id):
+        """Amount of a live pending charge for a business, or None"""
+        try:
+            self.ensure_live()
+        except SnapshotCacheUnavailable:
+            return self.read_pending_amount(business_id)
+        
+        with self.lock:
+            return self._live_amount(business_id, self.charges.get(business_id))
+    
+    def sweep(self):
+        """Delete expired pending charges, one precondition-checked delete per document"""
+        now = time.time()
+        with self.lock:
+            expired = dict(self.to_sweep)
+            self.to_sweep = {}
+            for business_id, charge in self.charges.items():
+                if not charge['expires_at'] or charge['expires_at'] <= now:
+                    expired[business_id] = charge['update_time']
+        
+        # Not batched: a batch is all-or-nothing, so one replaced charge (or one another
+        # worker already swept) would fail every other delete with it
+        swept = 0
+        for business_id, update_time in expired.items():
+            ref = db.collection('nfc_payments').document(business_id)
+            try:
+                if update_time:
+                    # Don't delete a charge the merchant replaced since we saw it
+                    ref.delete(option=db.write_option(last_update_time=update_time))
+                else:
+                    ref.delete()
+                swept += 1
+            except (FailedPrecondition, NotFound):
+                # Replaced or already swept; the listener has or will get the new state
+                pass
+            except Exception as e:
+                print(f"⚠️ Error sweeping expired charge {business_id}: {e}")
+                with self.lock:
+                    self.to_sweep.setdefault(business_id, update_time)
+        
+        with self.lock:
+            self.swept += swept
+        if swept:
+            print(f"🧹 Swept {swept} expired pending charges")
+        return swept
+    
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.listener_stats(),
+                pending=len(self.charges),
+                hits=self.hits,
+                expired_seen=self.expired_seen,
+                swept=self.swept
+            )
+
+business_index = BusinessIndex()
+pending_charges = PendingChargeCache()
+_nfc_sweeper = None
+
+def run_nfc_sweeper():
+    while True:
+        time.sleep(NFC_SWEEP_SECONDS)
+        try:
+            pending_charges.sweep()
+        except Exception as e:
+            print(f"⚠️ NFC sweeper error: {e}")
+
+@app.before_first_request
+def start_nfc_caches():
+    global _nfc_sweeper
+    if NFC_INDEX_ENABLED:
+        business_index.start()
+        pending_charges.start()
+    if _nfc_sweeper is None:
+        _nfc_sweeper = threading.Thread(target=run_nfc_sweeper, name='nfc-sweeper', daemon=True)
+        _nfc_sweeper.start()
+
+def find_business_by_card(card_id):
+    """(business_id, merchant_name, redirect_base) for an NFC card, or None if not registered"""
+    if NFC_INDEX_ENABLED:
+        try:
+            return business_index.lookup(card_id)
+        except SnapshotCacheUnavailable:
+            print(f"⚠️ NFC index not live, querying Firestore for {card_id}")
+    
+    query = db.collection('businesses').where('nfcCardId', '==', card_id).limit(1)
+    docs = list(query.stream())
+    print(f"🔍 Firestore query for nfcCardId='{card_id}' returned {len(docs)} results")
+    if not docs:
+        return None
+    merchant_name = docs[0].to_dict().get('name', 'Unknown Business')
+    return docs[0].id, merchant_name, pay_redirect_base(card_id, docs[0].id, merchant_name)
+
+def find_pending_amount(business_id):
+    """Amount of a live pending charge; never deletes on the tap path"""
+    if NFC_INDEX_ENABLED:
+        return pending_charges.pending_amount(business_id)
+    return pending_charges.read_pending_amount(business_id)
+
+@app.route('/debug/nfc-index', methods=['GET'])
+def debug_nfc_index():
+    return jsonify({
+        'businesses': business_index.stats(),
+        'pending_charges': pending_charges.stats()
+    })
+
 @app.route('/', methods=['GET'])
 def handle_nfc_redirect():
    card_id = request.args.get('cardId', 'unknown')
    url_amount = request.args.get('amount')
    
-   print(f"🔍 Request: cardId={card_id}, url_amount={url_amount}")
-   print(f"🔍 User-Agent: {request.headers.get('User-Agent', 'None')}")
-   
    try:
-       # Look up business by nfcCardId
-       businesses_ref = db.collection('businesses')
-       query = businesses_ref.where('nfcCardId', '==', card_id).limit(1)
-       docs = list(query.stream())
+       # Look up business by nfcCardId (in-memory index, Firestore query fallback)
+       business = find_business_by_card(card_id)
        
-       print(f"🔍 Firestore query for nfcCardId='{card_id}' returned {len(docs)} results")
-       
-       if docs:
-           business_doc = docs[0]
-           business_data = business_doc.to_dict()
-           business_id = business_doc.id
-           merchant_name = business_data.get('name', 'Unknown Business')
-           
-           print(f"🔍 Found business: {merchant_name} (ID: {business_id})")
+       if business:
+           business_id, merchant_name, redirect_base = business
            
-           # CHECK FOR PENDING CHARGE IN nfc_payments collection
+           # CHECK FOR PENDING CHARGE IN nfc_payments collection (expired ones are swept in the background)
            pending_amount = None
            try:
-               nfc_payment_doc = db.collection('nfc_payments').document(business_id).get()
-               if nfc_payment_doc.exists:
-                   payment_data = nfc_payment_doc.to_dict()
-                   if payment_data.get('status') == 'pending':
-                       # Check if charge has expired
-                       expires_at = payment_data.get('expiresAt')
-                       if expires_at:
-                           current_time = datetime.now()
-                           expire_time = expires_at.replace(tzinfo=None) if hasattr(expires_at, 'replace') else expires_at
-                           
-                           if expire_time > current_time:
-                               pending_amount = payment_data.get('amount')
-                               print(f"🔍 Found valid pending charge: ${pending_amount}")
-                           else:
-                               print(f"⏰ Pending charge expired, clearing...")
-                               # Clear expired charge
-                               db.collection('nfc_payments').document(business_id).delete()
-                       else:
-                           # No expiry time - treat as expired
-                           print(f"⏰ No expiry time, clearing charge...")
-                           db.collection('nfc_payments').document(business_id).delete()
+               pending_amount = find_pending_amount(business_id)
            except Exception as e:
                print(f"⚠️ Error checking pending charge: {e}")
            
            # Use URL amount first, then pending amount
            final_amount = url_amount or pending_amount
-           
-           query_params = f"?merchantId={business_id}&merchant={merchant_name}"
-           if final_amount:
-               query_params += f"&amount={final_amount}"
-           
-           redirect_url = f"luxapp://pay/{card_id}{query_params}"
-           print(f"🔁 Found {merchant_name}, amount={final_amount}, redirecting to: {redirect_url}")
+           redirect_url = pay_redirect_url(redirect_base, final_amount)
+           print(f"🔁 Tap {card_id}: {merchant_name}, amount={final_amount}, redirecting to: {redirect_url}")
            
            return redirect(redirect_url, code=302)
        else:
@@ -207,187 +1425,456 @@ def fix_base64_padding(base64_string):
     return base64.b64decode(base64_string)
 
 
+# Pass signing credentials, decoded and parsed once per worker process
+_pass_signer = None
+_pass_signer_lock = threading.Lock()
 
+def load_pass_signer():
+    """Decode and parse the signer cert, private key and WWDR cert (cached)"""
+    global _pass_signer
+    if _pass_signer is not None:
+        return _pass_signer
+    
+    with _pass_signer_lock:
+        if _pass_signer is None:
+            cert_pem = fix_base64_padding(PASS_CERTIFICATE or '')
+            key_pem = fix_base64_padding(PASS_PRIVATE_KEY or '')
+            wwdr_pem = fix_base64_padding(WWDR_CERTIFICATE or '')
+            
+            print(f"Cert decoded length: {len(cert_pem)}")
+            print(f"Key decoded length: {len(key_pem)}")
+            print(f"WWDR decoded length: {len(wwdr_pem)}")
+            
+            _pass_signer = {
+                'cert': x509.load_pem_x509_certificate(cert_pem),
+                'key': serialization.load_pem_private_key(key_pem, password=None),
+                'wwdr': x509.load_pem_x509_certificate(wwdr_pem)
+            }
+            print("✅ Loaded pass signing certificates")
+    return _pass_signer
 
+def sign_manifest(manifest_data):
+    """Create the detached DER PKCS#7 signature for manifest.json in-process"""
+    signer = load_pass_signer()
+    
+    # Same output as `openssl smime -sign -binary -outform DER` with -certfile WWDR
+    return (
+        pkcs7.PKCS7SignatureBuilder()
+        .set_data(manifest_data)
+        .add_signer(signer['cert'], signer['key'], hashes.SHA256())
+        .add_certificate(signer['wwdr'])
+        .sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.DetachedSignature, pkcs7.PKCS7Options.Binary])
+    )
 
 
 
 
-@app.route('/generate-wallet-pass', methods=['POST'])
-def generate_wallet_pass():
-    try:
-        data = request.get_json()
-        user_id = data.get('user_id')
-        merchant_id = data.get('merchant_id')
-        merchant_name = data.get('merchant_name')
-        merchant_location = data.get('location', {})
-        stamps = data.get('stamps', [])
-        sat_back = data.get('sat_back', 0)
-        credit_balance = data.get('credit_balance', 0)
-        user_balance = data.get('user_balance', 0)
-        is_nonprofit = data.get('is_nonprofit', False)  # NEW
-        has_qr_payments = data.get('has_qr_payments', False)  # NEW
-        
-        print(f"Generating pass for user {user_id} at {merchant_name}")
-        
-        # Create unique serial number
-        serial_number = f"{user_id}-{merchant_id}"
-        
-        # Determine background color
-        if is_nonprofit:
-            background_color = "rgb(255, 255, 255)"  # White for nonprofits
-        else:
-            background_color = get_tier_color(sat_back)
-        
-        # Build auxiliary fields based on business type
-        auxiliary_fields = []
-        
-        # Always add check-in button
+
+
+
+
+def pass_state_from_request(data):
+    """Pull the pass inputs out of a /generate-wallet-pass request body"""
+    return {
+        'user_id': data.get('user_id'),
+        'merchant_id': data.get('merchant_id'),
+        'merchant_name': data.get('merchant_name'),
+        'location': data.get('location', {}),
+        'stamps': data.get('stamps', []),
+        'sat_back': data.get('sat_back', 0),
+        'credit_balance': data.get('credit_balance', 0),
+        'user_balance': data.get('user_balance', 0),
+        'is_nonprofit': data.get('is_nonprofit', False),
+        'has_qr_payments': data.get('has_qr_payments', False)
+    }
+
+def pass_user_fields(state):
+    """The user-specific values in a pass; everything else is merchant-constant"""
+    # Create unique serial number
+    serial_number = f"{state['user_id']}-{state['merchant_id']}"
+    
+    # Day-granularity clock so same-day passes are byte-identical JSON
+    today = pass_clock_today()
+    
+    return {
+        'serialNumber': serial_number,
+        'authenticationToken': generate_auth_token(serial_number),
+        'balance': f"${state['user_balance']:.2f}",
+        'stamps': f"{len([s for s in state['stamps'] if s])}/20",
+        'stampsDetail': format_stamps_for_pass(state['stamps']),
+        'memberSince': today.strftime("%B %Y"),
+        'lastVisit': today.strftime("%B %d, %Y")
+    }
+
+def build_pass_json(state, user_fields=None):
+    """Build the pass.json document for one user's pass at one merchant"""
+    merchant_id = state['merchant_id']
+    merchant_name = state['merchant_name']
+    merchant_location = state['location']
+    sat_back = state['sat_back']
+    is_nonprofit = state['is_nonprofit']
+    has_qr_payments = state['has_qr_payments']
+    
+    if user_fields is None:
+        user_fields = pass_user_fields(state)
+
+    # Determine background color
+    if is_nonprofit:
+        background_color = "rgb(255, 255, 255)"  # White for nonprofits
+    else:
+        background_color = get_tier_color(sat_back)
+
+    # Build auxiliary fields based on business type
+    auxiliary_fields = []
+
+    # Always add check-in button
+    auxiliary_fields.append({
+        "key": "checkin",
+        "label": "",
+        "value": "✓ CHECK IN",
+        "textAlignment": "PKTextAlignmentLeft",
+        "attributedValue": f"<a href='luxapp://checkin/{merchant_id}'>✓ CHECK IN</a>"
+    })
+
+    # Add appropriate payment button
+    if is_nonprofit:
+        # Nonprofit gets GIVE button
         auxiliary_fields.append({
-            "key": "checkin",
+            "key": "give",
             "label": "",
-            "value": "✓ CHECK IN",
-            "textAlignment": "PKTextAlignmentLeft",
-            "attributedValue": f"<a href='luxapp://checkin/{merchant_id}'>✓ CHECK IN</a>"
+            "value": "💝 GIVE",
+            "textAlignment": "PKTextAlignmentCenter",
+            "link": f"luxapp://give/{merchant_id}"
         })
-        
-        # Add appropriate payment button
-        if is_nonprofit:
-            # Nonprofit gets GIVE button
-            auxiliary_fields.append({
-                "key": "give",
-                "label": "",
-                "value": "💝 GIVE",
-                "textAlignment": "PKTextAlignmentCenter",
-                "link": f"luxapp://give/{merchant_id}"
-            })
-        else:
-            # Regular merchant gets PAY button
-            auxiliary_fields.append({
-                "key": "pay",
-                "label": "",
-                "value": "💳 PAY",
+    else:
+        # Regular merchant gets PAY button
+        auxiliary_fields.append({
+            "key": "pay",
+            "label": "",
+            "value": "💳 PAY",
+            "textAlignment": "PKTextAlignmentCenter",
+            "link": f"luxapp://smartpay/{merchant_id}"
+        })
+
+    # Create enhanced pass structure
+    pass_json = {
+        "formatVersion": 1,
+        "passTypeIdentifier": PASS_TYPE_ID,
+        "serialNumber": user_fields['serialNumber'],
+        "teamIdentifier": TEAM_ID,
+        "organizationName": "LUX",
+        "description": f"{merchant_name} {'Support' if is_nonprofit else 'Loyalty'} Card",
+        "foregroundColor": "rgb(0, 0, 0)" if is_nonprofit else "rgb(255, 255, 255)",
+        "backgroundColor": background_color,
+        "logoText": merchant_name,
+
+        # Smart location triggers
+        "locations": [{
+            "latitude": merchant_location.get('lat', 34.0522),
+            "longitude": merchant_location.get('lng', -118.2437),
+            "relevantText": f"Welcome to {merchant_name}!",
+            "maxDistance": 100
+        }] if merchant_location.get('lat') else [],
+
+        # Using generic pass for flexibility
+        "generic": {
+            # Header - show balance
+            "headerFields": [{
+                "key": "balance",
+                "label": "YOUR BALANCE",
+                "value": user_fields['balance'],
+                "textAlignment": "PKTextAlignmentNatural"
+            }],
+
+            # Primary field - big stamp count
+            "primaryFields": [{
+                "key": "stamps",
+                "label": "STAMPS",
+                "value": user_fields['stamps'],
                 "textAlignment": "PKTextAlignmentCenter",
-                "link": f"luxapp://smartpay/{merchant_id}"
-            })
-        
-        # Create enhanced pass structure
-        pass_json = {
-            "formatVersion": 1,
-            "passTypeIdentifier": PASS_TYPE_ID,
-            "serialNumber": serial_number,
-            "teamIdentifier": TEAM_ID,
-            "organizationName": "LUX",
-            "description": f"{merchant_name} {'Support' if is_nonprofit else 'Loyalty'} Card",
-            "foregroundColor": "rgb(0, 0, 0)" if is_nonprofit else "rgb(255, 255, 255)",
-            "backgroundColor": background_color,
-            "logoText": merchant_name,
-            
-            # Smart location triggers
-            "locations": [{
-                "latitude": merchant_location.get('lat', 34.0522),
-                "longitude": merchant_location.get('lng', -118.2437),
-                "relevantText": f"Welcome to {merchant_name}!",
-                "maxDistance": 100
-            }] if merchant_location.get('lat') else [],
-            
-            # Using generic pass for flexibility
-            "generic": {
-                # Header - show balance
-                "headerFields": [{
-                    "key": "balance",
-                    "label": "YOUR BALANCE",
-                    "value": f"${user_balance:.2f}",
-                    "textAlignment": "PKTextAlignmentNatural"
-                }],
-                
-                # Primary field - big stamp count
-                "primaryFields": [{
-                    "key": "stamps",
-                    "label": "STAMPS",
-                    "value": f"{len([s for s in stamps if s])}/20",
-                    "textAlignment": "PKTextAlignmentCenter",
-                    "changeMessage": "You earned a new stamp!"
-                }],
-                
-                # Secondary fields - rewards info
-
-
-                # In your secondaryFields array, add:
-                "secondaryFields": [
-                    {
-                        "key": "rewards",
-                        "label": "REWARDS" if not is_nonprofit else "IMPACT",
-                        "value": f"{sat_back}% back" if not is_nonprofit else "Thank you!",
-                        "textAlignment": "PKTextAlignmentLeft"
-                    },
-                    {
-                        "key": "checkin_action",
-                        "label": "",
-                        "value": "✓ CHECK IN",
-                        "attributedValue": f"<a href='luxapp://checkin/{merchant_id}'>✓ CHECK IN</a>",
-                        "textAlignment": "PKTextAlignmentRight"
-                    }
-                ],
-                
-
-
-                
-                # Our dynamic auxiliary fields (buttons)
-                "auxiliaryFields": auxiliary_fields,
-                
-                # Back of pass
-                "backFields": [
-                    {
-                        "key": "member",
-                        "label": "Member Since",
-                        "value": datetime.now().strftime("%B %Y")
-                    },
-                    {
-                        "key": "lastvisit",
-                        "label": "Last Visit",
-                        "value": datetime.now().strftime("%B %d, %Y")
-                    },
-                    {
-                        "key": "stamps_detail",
-                        "label": "Your Progress",
-                        "value": format_stamps_for_pass(stamps)
-                    }
-                ]
-            },
-            
-            # Enable updates - CRITICAL for real-time color changes
-            "webServiceURL": "https://lux-stripe-backend.onrender.com/pass",
-            "authenticationToken": generate_auth_token(serial_number)
-        }
-        
-        # Add Lightning scanner link if merchant has QR payments
-        if has_qr_payments and not is_nonprofit:
-            pass_json["generic"]["backFields"].append({
-                "key": "lightning_scan",
-                "label": "",
-                "value": "⚡ Scan Lightning Invoice",
-                "link": f"luxapp://scan-lightning/{merchant_id}"
-            })
-        
-        # Add navigation link to merchant profile
+                "changeMessage": "You earned a new stamp!"
+            }],
+
+            # Secondary fields - rewards info
+
+
+            # In your secondaryFields array, add:
+            "secondaryFields": [
+                {
+                    "key": "rewards",
+                    "label": "REWARDS" if not is_nonprofit else "IMPACT",
+                    "value": f"{sat_back}% back" if not is_nonprofit else "Thank you!",
+                    "textAlignment": "PKTextAlignmentLeft"
+                },
+                {
+                    "key": "checkin_action",
+                    "label": "",
+                    "value": "✓ CHECK IN",
+                    "attributedValue": f"<a href='luxapp://checkin/{merchant_id}'>✓ CHECK IN</a>",
+                    "textAlignment": "PKTextAlignmentRight"
+                }
+            ],
+
+
+
+
+            # Our dynamic auxiliary fields (buttons)
+            "auxiliaryFields": auxiliary_fields,
+
+            # Back of pass
+            "backFields": [
+                {
+                    "key": "member",
+                    "label": "Member Since",
+                    "value": user_fields['memberSince']
+                },
+                {
+                    "key": "lastvisit",
+                    "label": "Last Visit",
+                    "value": user_fields['lastVisit']
+                },
+                {
+                    "key": "stamps_detail",
+                    "label": "Your Progress",
+                    "value": user_fields['stampsDetail']
+                }
+            ]
+        },
+
+        # Enable updates - CRITICAL for real-time color changes
+        "webServiceURL": "https://lux-stripe-backend.onrender.com/pass",
+        "authenticationToken": user_fields['authenticationToken']
+    }
+
+    # Add Lightning scanner link if merchant has QR payments
+    if has_qr_payments and not is_nonprofit:
         pass_json["generic"]["backFields"].append({
-            "key": "merchant_link",
+            "key": "lightning_scan",
             "label": "",
-            "value": f"View in LUX App →",
-            "link": f"luxapp://merchant/{merchant_id}"
+            "value": "⚡ Scan Lightning Invoice",
+            "link": f"luxapp://scan-lightning/{merchant_id}"
         })
+
+    # Add navigation link to merchant profile
+    pass_json["generic"]["backFields"].append({
+        "key": "merchant_link",
+        "label": "",
+        "value": f"View in LUX App →",
+        "link": f"luxapp://merchant/{merchant_id}"
+    })
+    
+    return pass_json
+
+# Pass signing runs on a dedicated bounded executor with admission control, so a
+# burst of pass downloads gets fast 503s instead of tying up the payment routes.
+# Every admitted pass request parks its gunicorn request thread until it is signed, so
+# admission (workers + queue) is capped at WEB_THREADS (keep in step with --threads in
+# render.yaml) minus the threads reserved for / and the payment routes
+WEB_THREADS = int(os.getenv('WEB_THREADS', 8))
+PASS_SIGNING_RESERVED_THREADS = int(os.getenv('PASS_SIGNING_RESERVED_THREADS', 4))
+PASS_SIGNING_MAX_ADMITTED = max(1, WEB_THREADS - PASS_SIGNING_RESERVED_THREADS)
+PASS_SIGNING_WORKERS = min(int(os.getenv('PASS_SIGNING_WORKERS', 2)), PASS_SIGNING_MAX_ADMITTED)
+PASS_SIGNING_QUEUE_DEPTH = min(int(os.getenv('PASS_SIGNING_QUEUE_DEPTH', 2)),
+                               PASS_SIGNING_MAX_ADMITTED - PASS_SIGNING_WORKERS)
+PASS_SIGNING_TIMEOUT = float(os.getenv('PASS_SIGNING_TIMEOUT', 10))
+PASS_SIGNING_RETRY_AFTER = int(os.getenv('PASS_SIGNING_RETRY_AFTER', 2))
+
+class SigningQueueFull(Exception):
+    """Raised when the signing executor has no free worker or queue slot"""
+
+class SigningExecutor:
+    """Thread pool with a hard cap on queued + running jobs"""
+    
+    def __init__(self, workers, queue_depth):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pass-signing')
+        self.slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.max_service = 0.0
+    
+    def run(self, fn, *args):
+        """Run fn on the pool and wait for it; raises SigningQueueFull when at capacity"""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise SigningQueueFull()
+        
+        enqueued_at = time.perf_counter()
+        with self.lock:
+            self.queued += 1
+        
+        def job():
+            started_at = time.perf_counter()
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return fn(*args)
+            finally:
+                finished_at = time.perf_counter()
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.total_wait += started_at - enqueued_at
+                    self.max_wait = max(self.max_wait, started_at - enqueued_at)
+                    self.total_service += finished_at - started_at
+                    self.max_service = max(self.max_service, finished_at - started_at)
+                self.slots.release()
+        
+        future = self.executor.submit(job)
+        try:
+            return future.result(timeout=PASS_SIGNING_TIMEOUT)
+        except FutureTimeoutError:
+            with self.lock:
+                self.timeouts += 1
+            raise SigningQueueFull()
+    
+    def stats(self):
+        with self.lock:
+            completed = self.completed or 1
+            return {
+                'workers': self.workers,
+                'queue_depth_limit': self.queue_depth,
+                'request_threads': WEB_THREADS,
+                'reserved_threads': PASS_SIGNING_RESERVED_THREADS,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'avg_wait_ms': round(self.total_wait / completed * 1000, 2),
+                'max_wait_ms': round(self.max_wait * 1000, 2),
+                'avg_service_ms': round(self.total_service / completed * 1000, 2),
+                'max_service_ms': round(self.max_service * 1000, 2)
+            }
+
+signing_executor = SigningExecutor(PASS_SIGNING_WORKERS, PASS_SIGNING_QUEUE_DEPTH)
+
+# Compiled pass templates: merchant-constant JSON pre-serialized around user-field slots
+PASS_TEMPLATE_CACHE_SIZE = int(os.getenv('PASS_TEMPLATE_CACHE_SIZE', 1024))
+_pass_templates = OrderedDict()
+_pass_templates_lock = threading.Lock()
+pass_template_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+def pass_template_key(state):
+    """Everything a pass depends on apart from the user fields"""
+    return (
+        state['merchant_id'],
+        state['merchant_name'],
+        json.dumps(state['location'], sort_keys=True),
+        state['sat_back'],
+        state['is_nonprofit'],
+        state['has_qr_payments']
+    )
+
+def compile_pass_template(state):
+    """Serialize the pass once with placeholders, then split it around them"""
+    placeholders = {field: f"@@PASS_FIELD_{field}@@" for field in pass_user_fields(state)}
+    serialized = json.dumps(build_pass_json(state, user_fields=placeholders), indent=2)
+    
+    fragments = []
+    fields = []
+    # Slots appear in document order; a string value serializes the same anywhere
+    positions = sorted((serialized.index(json.dumps(token)), field) for field, token in placeholders.items())
+    cursor = 0
+    for position, field in positions:
+        fragments.append(serialized[cursor:position].encode('utf-8'))
+        fields.append(field)
+        cursor = position + len(json.dumps(placeholders[field]))
+    fragments.append(serialized[cursor:].encode('utf-8'))
+    return fragments, fields
+
+def get_pass_template(state):
+    key = pass_template_key(state)
+    with _pass_templates_lock:
+        template = _pass_templates.get(key)
+        if template is not None:
+            _pass_templates.move_to_end(key)
+            pass_template_stats['hits'] += 1
+            return template
+        pass_template_stats['misses'] += 1
+    
+    template = compile_pass_template(state)
+    with _pass_templates_lock:
+        _pass_templates[key] = template
+        while len(_pass_templates) > PASS_TEMPLATE_CACHE_SIZE:
+            _pass_templates.popitem(last=False)
+    return template
+
+def invalidate_pass_templates(merchant_id):
+    """Drop compiled templates for a merchant after its data changes"""
+    with _pass_templates_lock:
+        for key in [key for key in _pass_templates if key[0] == merchant_id]:
+            del _pass_templates[key]
+            pass_template_stats['invalidations'] += 1
+
+def render_pass_json(state):
+    """Serialized pass.json for a state; byte-identical to json.dumps(build_pass_json(state), indent=2)"""
+    fragments, fields = get_pass_template(state)
+    user_fields = pass_user_fields(state)
+    parts = [fragments[0]]
+    for field, fragment in zip(fields, fragments[1:]):
+        parts.append(json.dumps(user_fields[field]).encode('utf-8'))
+        parts.append(fragment)
+    return b''.join(parts)
+
+def send_pass(pass_json_data, merchant_name, last_modified=None):
+    """Sign (or reuse from cache) serialized pass.json and return it, honouring If-None-Match"""
+    # Content-address the pass so unchanged passes skip signing
+    digest = hashlib.sha256(pass_json_data).hexdigest()
+    if request.if_none_match.contains(digest):
+        response = app.response_class(status=304)
+        response.set_etag(digest)
+        if last_modified:
+            response.last_modified = last_modified
+        return response
+    
+    # Generate the .pkpass file (or reuse the cached one)
+    pass_data = pass_cache.get(digest)
+    if pass_data is None:
+        try:
+            pass_data = signing_executor.run(create_pkpass_manually, pass_json_data)
+        except SigningQueueFull:
+            print("⚠️ Pass signing queue full, shedding request")
+            response = jsonify({'error': 'Pass signing is busy, try again shortly', 'success': False})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(PASS_SIGNING_RETRY_AFTER)
+            return response
+        pass_cache.put(digest, pass_data)
+    
+    # Return the pass file
+    return send_file(
+        io.BytesIO(pass_data),
+        mimetype='application/vnd.apple.pkpass',
+        as_attachment=True,
+        download_name=f'{merchant_name.lower().replace(" ", "-")}-loyalty.pkpass',
+        etag=digest,
+        last_modified=last_modified
+    )
+
+@app.route('/generate-wallet-pass', methods=['POST'])
+def generate_wallet_pass():
+    try:
+        data = request.get_json()
+        state = pass_state_from_request(data)
         
-        # Generate the .pkpass file
-        pass_data = create_pkpass_manually(pass_json)
+        print(f"Generating pass for user {state['user_id']} at {state['merchant_name']}")
         
-        # Return the pass file
-        return send_file(
-            io.BytesIO(pass_data),
-            mimetype='application/vnd.apple.pkpass',
-            as_attachment=True,
-            download_name=f'{merchant_name.lower().replace(" ", "-")}-loyalty.pkpass'
-        )
+        pass_json_data = render_pass_json(state)
+        
+        # Remember the inputs so Wallet can fetch an updated pass later
+        record_pass_state(f"{state['user_id']}-{state['merchant_id']}", state)
+        
+        return send_pass(pass_json_data, state['merchant_name'])
         
     except Exception as e:
         print(f"Error generating pass: {str(e)}")
@@ -398,6 +1885,180 @@ def generate_wallet_pass():
 
 
 
+# Bulk pass generation (merchant onboarding, tier migrations)
+PASS_BATCH_WORKERS = int(os.getenv('PASS_BATCH_WORKERS', os.cpu_count() or 1))
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+batch_stats = {'batches': 0, 'passes': 0, 'failed': 0, 'seconds': 0.0}
+_batch_stats_lock = threading.Lock()
+
+def get_batch_pool():
+    """Process pool for signing; workers load the signing certs themselves on first use"""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            # By now this worker runs listener, dispatcher and sweeper threads, so a plain
+            # fork could copy a held lock into the children; forkserver children start
+            # from a clean single-threaded process that has only imported this module
+            mp_context = multiprocessing.get_context('forkserver')
+            mp_context.set_forkserver_preload([__name__])
+            _batch_pool = ProcessPoolExecutor(max_workers=PASS_BATCH_WORKERS, mp_context=mp_context)
+    return _batch_pool
+
+def render_pass_for_batch(state):
+    """Worker: build and sign one pass with the same layout as /generate-wallet-pass"""
+    try:
+        serial_number = f"{state['user_id']}-{state['merchant_id']}"
+        return serial_number, create_pkpass_manually(render_pass_json(state)), None
+    except Exception as e:
+        return f"{state.get('user_id')}-{state.get('merchant_id')}", None, str(e)
+
+def generate_pass_batch(states):
+    """Yield (serial, pkpass bytes, error) per state, signed in parallel"""
+    pool = get_batch_pool()
+    chunksize = max(1, len(states) // (PASS_BATCH_WORKERS * 4))
+    start = time.perf_counter()
+    done = failed = 0
+    
+    try:
+        for serial, pass_data, error in pool.map(render_pass_for_batch, states, chunksize=chunksize):
+            done += 1
+            if error:
+                failed += 1
+                print(f"❌ Batch pass {serial} failed: {error}")
+            if done % 100 == 0 or done == len(states):
+                elapsed = time.perf_counter() - start
+                print(f"📦 Batch progress: {done}/{len(states)} passes, {done / elapsed:.1f} passes/sec")
+            yield serial, pass_data, error
+    finally:
+        with _batch_stats_lock:
+            batch_stats['batches'] += 1
+            batch_stats['passes'] += done - failed
+            batch_stats['failed'] += failed
+            batch_stats['seconds'] += time.perf_counter() - start
+
+def write_pass_states(states, known=None):
+    """Record pass states in batched writes (100 passes per commit); returns the serials that
+    changed. known maps serial -> stored record for callers that already read them"""
+    changed_serials = []
+    for i in range(0, len(states), 100):
+        chunk = {f"{state['user_id']}-{state['merchant_id']}": state for state in states[i:i + 100]}
+        if known is None:
+            refs = [db.collection('wallet_passes').document(serial) for serial in chunk]
+            previous = {doc.id: doc.to_dict() for doc in db.get_all(refs) if doc.exists}
+        else:
+            previous = known
+        changed = [serial for serial, state in chunk.items()
+                   if (previous.get(serial) or {}).get('stateHash') != pass_digest(state)]
+        
+        registrations = {}
+        for j in range(0, len(changed), 30):
+            for registration in db.collection('pass_registrations').where('serialNumber', 'in', changed[j:j + 30]).stream():
+                registrations.setdefault(registration.get('serialNumber'), []).append(registration.reference)
+        
+        batch = db.batch()
+        for serial in changed:
+            stage_pass_state(batch, serial, chunk[serial], previous.get(serial) or {}, registrations.get(serial, []))
+        if changed:
+            batch.commit()
+        changed_serials.extend(changed)
+    return changed_serials
+
+def store_pass_states(states):
+    """Record bulk-generated pass states and push the passes that changed"""
+    changed_serials = write_pass_states(states)
+    print(f"🔄 {len(changed_serials)}/{len(states)} bulk passes changed")
+    
+    # Installed copies refresh through the same fan-out as /merchant-pass-update
+    if changed_serials:
+        threading.Thread(target=push_pass_updates, args=(changed_serials,), daemon=True).start()
+    return changed_serials
+
+class _ZipStream(io.RawIOBase):
+    """Write-only sink that lets zipfile output be streamed in chunks"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+@app.route('/generate-wallet-passes', methods=['POST'])
+def generate_wallet_passes():
+    """Bulk version of /generate-wallet-pass; streams back a zip of .pkpass files"""
+    try:
+        data = request.get_json()
+        states = [pass_state_from_request(item) for item in data.get('passes', [])]
+        if not states:
+            return jsonify({'error': 'No passes requested', 'success': False}), 400
+        
+        print(f"Generating {len(states)} passes in bulk")
+        store_pass_states(states)
+        
+    except Exception as e:
+        print(f"Error starting pass batch: {str(e)}")
+        return jsonify({'error': str(e), 'success': False}), 400
+    
+    def stream_zip():
+        sink = _ZipStream()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zip_file:
+            for serial, pass_data, error in generate_pass_batch(states):
+                if pass_data is not None:
+                    zip_file.writestr(f"{serial}.pkpass", pass_data)
+                yield sink.drain()
+        yield sink.drain()
+    
+    return Response(
+        stream_with_context(stream_zip()),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=passes.zip'}
+    )
+
+@app.route('/debug/pass-signing', methods=['GET'])
+def debug_pass_signing():
+    return jsonify(signing_executor.stats())
+
+@app.route('/debug/pass-batches', methods=['GET'])
+def debug_pass_batches():
+    with _batch_stats_lock:
+        stats = dict(batch_stats)
+    stats['passes_per_sec'] = round(stats['passes'] / stats['seconds'], 1) if stats['seconds'] else 0
+    stats['workers'] = PASS_BATCH_WORKERS
+    return jsonify(stats)
+
+@app.cli.command('generate-passes')
+@click.argument('input_file', type=click.File('r'))
+@click.option('--out', 'out_dir', required=True, type=click.Path(file_okay=False), help='Directory for .pkpass files')
+@click.option('--store-state/--no-store-state', default=True, help='Record pass state for Wallet refreshes')
+def generate_passes_command(input_file, out_dir, store_state):
+    """Render and sign passes from a JSON array or JSONL file of pass requests"""
+    raw = input_file.read().strip()
+    items = json.loads(raw) if raw.startswith('[') else [json.loads(line) for line in raw.splitlines() if line.strip()]
+    states = [pass_state_from_request(item) for item in items]
+    
+    os.makedirs(out_dir, exist_ok=True)
+    if store_state:
+        store_pass_states(states)
+    
+    start = time.perf_counter()
+    written = 0
+    for serial, pass_data, error in generate_pass_batch(states):
+        if pass_data is not None:
+            with open(os.path.join(out_dir, f"{serial}.pkpass"), 'wb') as f:
+                f.write(pass_data)
+            written += 1
+    elapsed = time.perf_counter() - start
+    click.echo(f"✅ Wrote {written}/{len(states)} passes to {out_dir} in {elapsed:.1f}s ({written / elapsed:.1f} passes/sec)")
+
 def get_tier_name(sat_back):
     """Get tier name based on satBack percentage"""
     tiers = {
@@ -417,126 +2078,169 @@ def get_tier_name(sat_back):
    
        
         
-def create_pkpass_manually(pass_json):
-    """Create a properly signed .pkpass file"""
-
+# Static pass images - icon is a 29x29 black square, reused for @2x
+PASS_ICON_PNG = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x1d\x00\x00\x00\x1d\x08\x02\x00\x00\x00\xfd\xd4\x9as\x00\x00\x00\x1dIDATx\x9c\xed\xc1\x01\r\x00\x00\x00\xc2\xa0\xf7Om\x0e7\xa0\x00\x00\x00\x00\x00\x00\x00\x00\xbe\r!\x00\x00\x01\x9a`\xe1\xd5\x00\x00\x00\x00IEND\xaeB`\x82'
+PASS_ICON_SHA1 = hashlib.sha1(PASS_ICON_PNG).hexdigest()
+PASS_IMAGES = [
+    ('icon.png', PASS_ICON_PNG, PASS_ICON_SHA1),
+    ('icon@2x.png', PASS_ICON_PNG, PASS_ICON_SHA1)
+]
+
+# PNGs are already compressed, so by default store them without DEFLATE
+PASS_STORE_IMAGES = os.getenv('PASS_STORE_IMAGES', 'true').lower() == 'true'
+
+def build_manifest(pass_json_data):
+    """manifest.json with SHA-1 hashes (image hashes precomputed)"""
+    manifest = {'pass.json': hashlib.sha1(pass_json_data).hexdigest()}
+    for filename, _, sha1 in PASS_IMAGES:
+        manifest[filename] = sha1
+    return json.dumps(manifest, indent=2).encode('utf-8')
+
+def zip_pkpass(pass_json_data, manifest_data, signature, store_images):
+    """Assemble the .pkpass ZIP archive in memory"""
+    image_compression = zipfile.ZIP_STORED if store_images else zipfile.ZIP_DEFLATED
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        # Files must be added in this specific order
+        zip_file.writestr('pass.json', pass_json_data)
+        for filename, data, _ in PASS_IMAGES:
+            zip_file.writestr(filename, data, compress_type=image_compression)
+        zip_file.writestr('manifest.json', manifest_data)
+        zip_file.writestr('signature', signature)
+    return zip_buffer.getvalue()
+
+def create_pkpass_manually(pass_json, store_images=None):
+    """Create a properly signed .pkpass file entirely in memory
+    
+    pass_json may be a dict or already-serialized pass.json bytes.
+    """
+    if store_images is None:
+        store_images = PASS_STORE_IMAGES
     
-    # Create a temporary directory for pass contents
-    with tempfile.TemporaryDirectory() as temp_dir:
+    try:
+        # Serialize pass.json
+        if isinstance(pass_json, bytes):
+            pass_json_data = pass_json
+        else:
+            pass_json_data = json.dumps(pass_json, indent=2).encode('utf-8')
+        
+        manifest_data = build_manifest(pass_json_data)
+        
+        # Sign manifest.json in-process (no openssl fork per pass)
         try:
-            # Write pass.json
-            pass_json_path = os.path.join(temp_dir, 'pass.json')
-            with open(pass_json_path, 'w') as f:
-                json.dump(pass_json, f, indent=2)
-            
-            # Create required images (minimum set)
-            # Icon - 29x29 black square
-            icon_path = os.path.join(temp_dir, 'icon.png')
-            icon2x_path = os.path.join(temp_dir, 'icon@2x.png')
-            with open(icon_path, 'wb') as f:
-                f.write(b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x1d\x00\x00\x00\x1d\x08\x02\x00\x00\x00\xfd\xd4\x9as\x00\x00\x00\x1dIDATx\x9c\xed\xc1\x01\r\x00\x00\x00\xc2\xa0\xf7Om\x0e7\xa0\x00\x00\x00\x00\x00\x00\x00\x00\xbe\r!\x00\x00\x01\x9a`\xe1\xd5\x00\x00\x00\x00IEND\xaeB`\x82')
-            # Copy same image for @2x
-            shutil.copy(icon_path, icon2x_path)
-            
-            # Create manifest.json with SHA-1 hashes
-            manifest = {}
-            files_to_hash = ['pass.json', 'icon.png', 'icon@2x.png']
-            
-            for filename in files_to_hash:
-                filepath = os.path.join(temp_dir, filename)
-                if os.path.exists(filepath):
-                    with open(filepath, 'rb') as f:
-                        content = f.read()
-                        manifest[filename] = hashlib.sha1(content).hexdigest()
-            
-            manifest_path = os.path.join(temp_dir, 'manifest.json')
-            with open(manifest_path, 'w') as f:
-                json.dump(manifest, f, indent=2)
-            
-            # Decode certificates from environment variables
-            try:
-                cert_pem = fix_base64_padding(os.getenv('PASS_CERTIFICATE', ''))
-                key_pem = fix_base64_padding(os.getenv('PASS_PRIVATE_KEY', ''))
-                wwdr_pem = fix_base64_padding(os.getenv('WWDR_CERTIFICATE', ''))
-                
-                print(f"Cert decoded length: {len(cert_pem)}")
-                print(f"Key decoded length: {len(key_pem)}")
-                print(f"WWDR decoded length: {len(wwdr_pem)}")
-                
-                # Write certificates to temp files
-                cert_path = os.path.join(temp_dir, 'cert.pem')
-                key_path = os.path.join(temp_dir, 'key.pem')
-                wwdr_path = os.path.join(temp_dir, 'wwdr.pem')
-                
-                with open(cert_path, 'wb') as f:
-                    f.write(cert_pem)
-                with open(key_path, 'wb') as f:
-                    f.write(key_pem)
-                with open(wwdr_path, 'wb') as f:
-                    f.write(wwdr_pem)
-                
-                # Create the signature using OpenSSL
-                signature_path = os.path.join(temp_dir, 'signature')
-                
-                # Method 1: Try using PKCS7 signing
-                openssl_cmd = [
-                    'openssl', 'smime', '-sign', '-binary',
-                    '-signer', cert_path,
-                    '-inkey', key_path,
-                    '-certfile', wwdr_path,
-                    '-in', manifest_path,
-                    '-out', signature_path,
-                    '-outform', 'DER'
-                ]
-                
-                result = subprocess.run(openssl_cmd, capture_output=True, text=True)
-                
-                if result.returncode != 0:
-                    print(f"❌ OpenSSL signing failed: {result.stderr}")
-                    
-                    # Try alternative method
-                    alt_cmd = [
-                        'openssl', 'cms', '-sign', '-binary',
-                        '-signer', cert_path,
-                        '-inkey', key_path,
-                        '-certfile', wwdr_path,
-                        '-in', manifest_path,
-                        '-out', signature_path,
-                        '-outform', 'DER'
-                    ]
-                    
-                    alt_result = subprocess.run(alt_cmd, capture_output=True, text=True)
-                    
-                    if alt_result.returncode != 0:
-                        print(f"❌ Alternative signing also failed: {alt_result.stderr}")
-                        raise Exception("Signing failed")
-                    else:
-                        print("✅ Signed with CMS command")
-                else:
-                    print("✅ Signed successfully with SMIME")
-                
-            except Exception as e:
-                print(f"❌ Certificate processing error: {str(e)}")
-                raise
-            
-            # Create the .pkpass file (ZIP archive)
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                # Files must be added in this specific order
-                zip_file.write(pass_json_path, 'pass.json')
-                zip_file.write(icon_path, 'icon.png')
-                zip_file.write(icon2x_path, 'icon@2x.png')
-                zip_file.write(manifest_path, 'manifest.json')
-                zip_file.write(signature_path, 'signature')
-            
-            print(f"✅ Created .pkpass file, size: {len(zip_buffer.getvalue())} bytes")
-            return zip_buffer.getvalue()
-            
+            signature = sign_manifest(manifest_data)
         except Exception as e:
-            print(f"❌ Error in create_pkpass_manually: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            raise 
+            print(f"❌ Certificate processing error: {str(e)}")
+            raise
+        
+        # Create the .pkpass file (ZIP archive)
+        pass_data = zip_pkpass(pass_json_data, manifest_data, signature, store_images)
+        print(f"✅ Created .pkpass file, size: {len(pass_data)} bytes")
+        return pass_data
+        
+    except Exception as e:
+        print(f"❌ Error in create_pkpass_manually: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+class PassCache:
+    """LRU cache of signed .pkpass bytes keyed by pass.json digest, bounded by total size"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def get(self, digest):
+        with self.lock:
+            pass_data = self.entries.get(digest)
+            if pass_data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return pass_data
+    
+    def put(self, digest, pass_data):
+        if len(pass_data) > self.max_bytes:
+            return
+        with self.lock:
+            if digest in self.entries:
+                self.total_bytes -= len(self.entries.pop(digest))
+            self.entries[digest] = pass_data
+            self.total_bytes += len(pass_data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+                self.evictions += 1
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+PASS_CACHE_MAX_BYTES = int(os.getenv('PASS_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+pass_cache = PassCache(PASS_CACHE_MAX_BYTES)
+
+def pass_clock_today():
+    """Date used for the volatile back fields (Member Since / Last Visit)"""
+    return datetime.now().date()
+
+def pass_digest(pass_json):
+    """Canonical SHA-256 digest of pass content (or pass state), used as cache key and ETag"""
+    canonical = json.dumps(pass_json, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def next_update_tag(previous_tag=0):
+    """Monotonically increasing update tag (microseconds since epoch)"""
+    return max(int(datetime.now().timestamp() * 1_000_000), (previous_tag or 0) + 1)
+
+def stage_pass_state(write_batch, serial_number, state, previous, registration_refs):
+    """Add the pass state write and the matching registration tag updates to write_batch"""
+    update_tag = next_update_tag(previous.get('updateTag'))
+    write_batch.set(db.collection('wallet_passes').document(serial_number), {
+        'state': state,
+        'stateHash': pass_digest(state),
+        'updateTag': update_tag,
+        'lastModified': firestore.SERVER_TIMESTAMP
+    })
+    
+    # Copy the tag onto each registration so passesUpdatedSince is one range query
+    for registration_ref in registration_refs:
+        write_batch.update(registration_ref, {'updateTag': update_tag})
+    return update_tag
+
+def record_pass_state(serial_number, state, previous=None):
+    """Persist pass inputs; bump lastModified/updateTag only when they actually change"""
+    try:
+        if previous is None:
+            pass_doc = db.collection('wallet_passes').document(serial_number).get()
+            previous = pass_doc.to_dict() if pass_doc.exists else {}
+        if previous.get('stateHash') == pass_digest(state):
+            return False
+        
+        batch = db.batch()
+        registrations = db.collection('pass_registrations').where('serialNumber', '==', serial_number).stream()
+        update_tag = stage_pass_state(batch, serial_number, state, previous,
+                                      [registration.reference for registration in registrations])
+        batch.commit()
+        
+        print(f"✅ Pass state updated: {serial_number} (tag {update_tag})")
+        return True
+    except Exception as e:
+        print(f"⚠️ Error saving pass state (pass still generated): {e}")
+        return False
 
 def format_stamps_for_pass(stamps):
     """Format stamps as a grid for the pass back"""
@@ -559,46 +2263,122 @@ def generate_auth_token(serial_number):
 
 
 
+def verify_pass_auth(serial):
+    """Check the ApplePass authorization header for a serial"""
+    auth_token = request.headers.get('Authorization', '').replace('ApplePass ', '')
+    return auth_token == generate_auth_token(serial)
+
 @app.route('/v1/devices/<device_id>/registrations/<pass_type>/<serial>', methods=['POST'])
 def register_pass(device_id, pass_type, serial):
     """Called when a pass is first installed"""
-    data = request.get_json()
-    push_token = data.get('pushToken')
+    if not verify_pass_auth(serial):
+        return '', 401
     
-    # Store this registration in Firestore
-    registration_data = {
-        'deviceId': device_id,
-        'passTypeIdentifier': pass_type,
-        'serialNumber': serial,
-        'pushToken': push_token,
-        'registeredAt': datetime.now().isoformat()
-    }
+    data = request.get_json(silent=True) or {}
+    push_token = data.get('pushToken')
     
-    # Store in Firestore for later push updates
-    # Note: You'll need to import firestore at the top of your file
-    # from google.cloud import firestore
-    # db = firestore.Client()
-    # db.collection('pass_registrations').document(f"{device_id}_{serial}").set(registration_data)
+    try:
+        registration_ref = db.collection('pass_registrations').document(f"{device_id}_{serial}")
+        already_registered = registration_ref.get().exists
+        
+        # Start from the pass's current tag so the device only hears about later changes
+        pass_doc = db.collection('wallet_passes').document(serial).get()
+        update_tag = pass_doc.to_dict().get('updateTag', 0) if pass_doc.exists else 0
+        
+        # Registration plus device -> serials index in one batched write
+        batch = db.batch()
+        batch.set(registration_ref, {
+            'deviceId': device_id,
+            'passTypeIdentifier': pass_type,
+            'serialNumber': serial,
+            'pushToken': push_token,
+            'updateTag': update_tag,
+            'registeredAt': datetime.now().isoformat()
+        })
+        batch.set(db.collection('pass_devices').document(device_id), {
+            'pushToken': push_token,
+            'serials': firestore.ArrayUnion([serial]),
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        batch.commit()
+    except Exception as e:
+        print(f"❌ Error registering pass: {e}")
+        return '', 500
     
     print(f"✅ Pass registered: {serial} on device {device_id}")
-    return '', 201
+    return '', 200 if already_registered else 201
+
+@app.route('/v1/devices/<device_id>/registrations/<pass_type>/<serial>', methods=['DELETE'])
+def unregister_pass(device_id, pass_type, serial):
+    """Called when a pass is removed from a device"""
+    if not verify_pass_auth(serial):
+        return '', 401
+    
+    try:
+        batch = db.batch()
+        batch.delete(db.collection('pass_registrations').document(f"{device_id}_{serial}"))
+        batch.set(db.collection('pass_devices').document(device_id), {
+            'serials': firestore.ArrayRemove([serial]),
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        batch.commit()
+    except Exception as e:
+        print(f"❌ Error unregistering pass: {e}")
+        return '', 500
+    
+    print(f"🗑️ Pass unregistered: {serial} on device {device_id}")
+    return '', 200
+
+@app.route('/v1/devices/<device_id>/registrations/<pass_type>', methods=['GET'])
+def list_updated_passes(device_id, pass_type):
+    """Serial numbers of this device's passes that changed since passesUpdatedSince"""
+    updated_since = request.args.get('passesUpdatedSince')
+    
+    try:
+        # Needs a composite index on (deviceId, passTypeIdentifier, updateTag)
+        query = db.collection('pass_registrations') \
+            .where('deviceId', '==', device_id) \
+            .where('passTypeIdentifier', '==', pass_type)
+        if updated_since:
+            query = query.where('updateTag', '>', int(updated_since))
+        registrations = [doc.to_dict() for doc in query.stream()]
+    except ValueError:
+        return '', 400
+    except Exception as e:
+        print(f"❌ Error listing updated passes: {e}")
+        return '', 500
+    
+    if not registrations:
+        return '', 204
+    
+    return jsonify({
+        'serialNumbers': [r['serialNumber'] for r in registrations],
+        'lastUpdated': str(max(r.get('updateTag', 0) for r in registrations))
+    })
 
 @app.route('/v1/passes/<pass_type>/<serial>', methods=['GET'])
 def get_updated_pass(pass_type, serial):
     """Called when device requests updated pass"""
-    auth_token = request.headers.get('Authorization', '').replace('ApplePass ', '')
-    
-    # Verify auth token
-    expected_token = generate_auth_token(serial)
-    if auth_token != expected_token:
+    if not verify_pass_auth(serial):
         return '', 401
     
-    # Parse serial to get user and merchant IDs
-    user_id, merchant_id = serial.split('-')
+    # One small document read decides whether anything changed
+    pass_doc = db.collection('wallet_passes').document(serial).get()
+    if not pass_doc.exists:
+        return '', 404
+    
+    record = pass_doc.to_dict()
+    last_modified = record.get('lastModified')
+    if last_modified:
+        # HTTP dates have one-second resolution
+        last_modified = last_modified.replace(microsecond=0)
+        if request.if_modified_since and last_modified <= request.if_modified_since:
+            return '', 304
     
-    # TODO: Fetch current business data from Firestore and regenerate pass
-    # For now, return 304 (not modified)
-    return '', 304
+    # Rebuild from stored state; the pass cache skips signing if nothing changed
+    state = record['state']
+    print(f"🔄 Sending updated pass {serial}")
+    return send_pass(render_pass_json(state), state['merchant_name'], last_modified=last_modified)
 
 @app.route('/v1/log', methods=['POST'])
 def log_pass_activity():
@@ -614,6 +2394,154 @@ def log_pass_activity():
 
 
 
+# Apple Wallet pass-update pushes over one pooled, multiplexed HTTP/2 connection
+APNS_URL = os.getenv('APNS_URL', 'https://api.push.apple.com')
+APNS_CONCURRENCY = int(os.getenv('APNS_CONCURRENCY', 32))
+_apns_client = None
+_apns_client_lock = threading.Lock()
+
+def apns_ssl_context():
+    """TLS context authenticating with the pass type certificate"""
+    ssl_context = ssl.create_default_context()
+    pem = fix_base64_padding(PASS_CERTIFICATE or '') + b'\n' + fix_base64_padding(PASS_PRIVATE_KEY or '')
+    # ssl can only load a client cert from a path; give it an in-memory file so the
+    # private key never lands on disk (anonymous memfd on Linux, tmpfs /dev/shm otherwise)
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('apns-cert', os.MFD_CLOEXEC)
+        try:
+            with os.fdopen(os.dup(fd), 'wb') as f:
+                f.write(pem)
+            ssl_context.load_cert_chain(f"/proc/self/fd/{fd}")
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile(suffix='.pem', dir='/dev/shm') as f:
+            f.write(pem)
+            f.flush()
+            ssl_context.load_cert_chain(f.name)
+    return ssl_context
+
+def get_apns_client():
+    """Shared APNs client; all pushes multiplex over a single HTTP/2 connection"""
+    global _apns_client
+    if _apns_client is not None:
+        return _apns_client
+    
+    with _apns_client_lock:
+        if _apns_client is None:
+            limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+            timeout = httpx.Timeout(10.0, connect=5.0)
+            if APNS_URL.startswith('https://'):
+                _apns_client = httpx.Client(http2=True, verify=apns_ssl_context(), limits=limits, timeout=timeout)
+            else:
+                # Plain-text HTTP/2 with prior knowledge, for a local fake APNs server
+                _apns_client = httpx.Client(http1=False, http2=True, limits=limits, timeout=timeout)
+    return _apns_client
+
+def send_pass_push(push_token):
+    """Send an empty pass-update push; returns the APNs status code"""
+    host = urlparse(APNS_URL).netloc
+    start = time.perf_counter()
+    try:
+        response = get_apns_client().post(
+            f"{APNS_URL}/3/device/{push_token}",
+            headers={'apns-topic': PASS_TYPE_ID or ''},
+            content=b'{}'
+        )
+        outbound_metrics.record(host, time.perf_counter() - start, status=response.status_code)
+        return response.status_code
+    except httpx.HTTPError as e:
+        outbound_metrics.record(host, time.perf_counter() - start, error=True)
+        print(f"⚠️ APNs error for token {push_token[:8]}…: {e}")
+        return None
+
+def prune_pass_device(device_id):
+    """Remove every registration for a device whose push token APNs rejected (410)"""
+    batch = db.batch()
+    for registration in db.collection('pass_registrations').where('deviceId', '==', device_id).stream():
+        batch.delete(registration.reference)
+    batch.delete(db.collection('pass_devices').document(device_id))
+    batch.commit()
+
+def push_pass_updates(serials):
+    """Notify every device holding any of these serials (one push per device)"""
+    serials = list(serials)
+    
+    # Deduplicate tokens per device; Firestore 'in' queries take 30 values at most
+    tokens_by_device = {}
+    for i in range(0, len(serials), 30):
+        registrations = db.collection('pass_registrations').where('serialNumber', 'in', serials[i:i + 30]).stream()
+        for registration in registrations:
+            registration_data = registration.to_dict()
+            if registration_data.get('pushToken'):
+                tokens_by_device[registration_data['deviceId']] = registration_data['pushToken']
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=APNS_CONCURRENCY) as pool:
+        statuses = dict(zip(tokens_by_device, pool.map(send_pass_push, tokens_by_device.values())))
+    elapsed = time.perf_counter() - start
+    
+    dead_devices = [device_id for device_id, status in statuses.items() if status == 410]
+    for device_id in dead_devices:
+        try:
+            prune_pass_device(device_id)
+        except Exception as e:
+            print(f"⚠️ Error pruning device {device_id}: {e}")
+    
+    stats = {
+        'serials': len(serials),
+        'devices': len(tokens_by_device),
+        'sent': sum(1 for status in statuses.values() if status == 200),
+        'failed': sum(1 for status in statuses.values() if status not in (200, 410)),
+        'pruned': len(dead_devices),
+        'seconds': round(elapsed, 3),
+        'pushes_per_sec': round(len(statuses) / elapsed, 1) if elapsed else 0
+    }
+    print(f"📲 Pass push fan-out: {stats}")
+    return stats
+
+def apply_merchant_pass_update(merchant_id, merchant_fields):
+    """Rewrite every pass of a merchant through the batched bulk path, then push the changed ones"""
+    try:
+        records = {
+            pass_doc.id: pass_doc.to_dict()
+            for pass_doc in db.collection('wallet_passes').where('state.merchant_id', '==', merchant_id).stream()
+        }
+        states = [dict(record['state'], **merchant_fields) for record in records.values()]
+        changed_serials = write_pass_states(states, known=records)
+        print(f"🔄 {len(changed_serials)}/{len(states)} passes changed for merchant {merchant_id}")
+        if changed_serials:
+            push_pass_updates(changed_serials)
+    except Exception as e:
+        print(f"❌ Error updating passes for merchant {merchant_id}: {e}")
+
+@app.route('/merchant-pass-update', methods=['POST'])
+def merchant_pass_update():
+    """Apply merchant changes (e.g. a new sat_back tier) to every pass and push them"""
+    try:
+        data = request.get_json()
+        merchant_id = data.get('merchant_id')
+        merchant_fields = {
+            key: data[key]
+            for key in ('merchant_name', 'location', 'sat_back', 'is_nonprofit', 'has_qr_payments')
+            if key in data
+        }
+        
+        if not merchant_id:
+            return jsonify({'error': 'merchant_id is required', 'success': False}), 400
+        
+        invalidate_pass_templates(merchant_id)
+        
+        # State rewrite and push fan-out both run in the background so the caller isn't held
+        # for thousands of Firestore writes and APNs round trips
+        threading.Thread(target=apply_merchant_pass_update, args=(merchant_id, merchant_fields), daemon=True).start()
+        
+        return jsonify({'queued': True, 'success': True}), 202
+        
+    except Exception as e:
+        print(f"❌ Error updating merchant passes: {e}")
+        return jsonify({'error': str(e), 'success': False}), 400
+
 # Add this endpoint for pass updates
 @app.route('/pass-updates/<serial_number>', methods=['GET'])
 def get_pass_updates(serial_number):
@@ -638,6 +2566,10 @@ def update_pass_for_payment():
 # YOUR EXISTING ENDPOINTS CONTINUE HERE...
 # YOUR EXISTING ENDPOINTS CONTINUE HERE...
 
+@app.route('/debug/outbound-http', methods=['GET'])
+def debug_outbound_http():
+    return jsonify(outbound_metrics.stats())
+
 @app.route('/debug/square-config', methods=['GET'])
 def debug_square_config():
     return jsonify({
@@ -646,6 +2578,13 @@ def debug_square_config():
         'has_secret': SQUARE_APPLICATION_SECRET is not None
     })
 
+@app.route('/debug/pass-cache', methods=['GET'])
+def debug_pass_cache():
+    stats = pass_cache.stats()
+    with _pass_templates_lock:
+        stats['templates'] = dict(pass_template_stats, entries=len(_pass_templates))
+    return jsonify(stats)
+
 @app.route('/check-mode', methods=['GET'])
 def check_mode():
     return jsonify({
@@ -776,19 +2715,320 @@ def create_express_login():
             'success': False
         }), 400
 
+# Connected-account status is mirrored in stripe_accounts/<id>: written on a Stripe fetch or by
+# the account.updated webhook, and fed to every worker by a listener. Entries older than the
+# TTL are refetched, which covers missed webhooks.
+ACCOUNT_STATUS_TTL_SECONDS = int(os.getenv('ACCOUNT_STATUS_TTL_SECONDS', 6 * 60 * 60))
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+
+def account_status_fields(account):
+    return {
+        'charges_enabled': bool(account.get('charges_enabled')),
+        'payouts_enabled': bool(account.get('payouts_enabled')),
+        'details_submitted': bool(account.get('details_submitted'))
+    }
+
+@firestore.transactional
+def store_account_status(transaction, account_ref, status, as_of):
+    """Write an account status unless the stored one reflects later Stripe state, so a slow
+    cache-miss fetch can't overwrite what a webhook stored meanwhile. Returns whether it wrote"""
+    account_doc = account_ref.get(transaction=transaction)
+    if account_doc.exists and (account_doc.get('asOf') or 0) > as_of:
+        return False
+    transaction.set(account_ref, {
+        'status': status,
+        'asOf': as_of,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    })
+    return True
+
+class AccountStatusCache(SnapshotCache):
+    """account_id -> (status, as_of epoch), mirrored from stripe_accounts"""
+    
+    collection_name = 'stripe_accounts'
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.webhook_updates = 0
+        super().__init__()
+    
+    def _reset(self):
+        self.statuses = {}
+    
+    def _apply(self, account_id, account_data, snapshot):
+        if account_data is None:
+            self.statuses.pop(account_id, None)
+            return
+        current = self.statuses.get(account_id)
+        # Writes can arrive out of order; keep the one that reflects the later Stripe state
+        if current is None or account_data.get('asOf', 0) >= current[1]:
+            self.statuses[account_id] = (account_data['status'], account_data.get('asOf', 0))
+    
+    def get(self, account_id):
+        """Account status, from memory when fresh, otherwise from Stripe (and stored for every worker)"""
+        if not self.is_live():
+            # Local entries still honour the TTL while the listener resubscribes
+            self.start()
+        with self.lock:
+            entry = self.statuses.get(account_id)
+            if entry is not None and time.time() - entry[1] < ACCOUNT_STATUS_TTL_SECONDS:
+                self.hits += 1
+                return entry[0]
+            if entry is None:
+                self.misses += 1
+            else:
+                self.expired += 1
+        
+        # As-of is taken before the call so a webhook landing meanwhile wins
+        as_of = time.time()
+        status = account_status_fields(stripe.Account.retrieve(account_id))
+        self.store(account_id, status, as_of)
+        return status
+    
+    def store(self, account_id, status, as_of):
+        with self.lock:
+            self._apply(account_id, {'status': status, 'asOf': as_of}, None)
+        try:
+            store_account_status(db.transaction(), db.collection('stripe_accounts').document(account_id), status, as_of)
+        except Exception as e:
+            # Other workers fall back to their own fetch / the TTL
+            print(f"⚠️ Could not store account status for {account_id}: {e}")
+    
+    def invalidate(self, account_id):
+        with self.lock:
+            self._apply(account_id, None, None)
+        db.collection('stripe_accounts').document(account_id).delete()
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.expired
+            return dict(
+                self.listener_stats(),
+                accounts=len(self.statuses),
+                hits=self.hits,
+                misses=self.misses,
+                expired=self.expired,
+                webhook_updates=self.webhook_updates,
+                hit_rate=round(self.hits / lookups, 4) if lookups else None
+            )
+
+account_statuses = AccountStatusCache()
+
+@app.before_first_request
+def start_account_status_cache():
+    account_statuses.start()
+
+@app.route('/debug/account-status-cache', methods=['GET'])
+def debug_account_status_cache():
+    return jsonify(account_statuses.stats())
+
+def handle_account_updated(event):
+    account = event['data']['object']
+    account_statuses.store(account['id'], account_status_fields(account), event['created'])
+    with account_statuses.lock:
+        account_statuses.webhook_updates += 1
+    print(f"🔄 Account {account['id']} status updated from webhook")
+
+def handle_account_deauthorized(event):
+    account_id = event.get('account')
+    if account_id:
+        account_statuses.invalidate(account_id)
+        print(f"🔄 Account {account_id} deauthorized, status dropped")
+
+# Newest succeeded charges per connected account, kept in recent_charges/<account_id> by the
+# charge webhooks and mirrored into every worker, so POS polls don't list charges on Stripe
+RECENT_CHARGES_PER_ACCOUNT = int(os.getenv('RECENT_CHARGES_PER_ACCOUNT', 20))
+RECENT_CHARGE_BACKFILL_PAGES = int(os.getenv('RECENT_CHARGE_BACKFILL_PAGES', 3))
+# An account whose backfill found no succeeded charges isn't listed again for this long
+RECENT_CHARGE_EMPTY_TTL_SECONDS = int(os.getenv('RECENT_CHARGE_EMPTY_TTL_SECONDS', 60))
+
+def charge_record(charge, event_created):
+    return {
+        'id': charge['id'],
+        'amount': charge.get('amount'),
+        'amount_refunded': charge.get('amount_refunded', 0),
+        'refunded': bool(charge.get('refunded')),
+        'description': charge.get('description'),
+        'created': charge.get('created'),
+        'status': charge.get('status'),
+        # State of the charge as of this event, so an older redelivery can't undo a refund
+        'eventCreated': event_created
+    }
+
+def merge_charges(charges, new_records):
+    """Newest-first ring of at most RECENT_CHARGES_PER_ACCOUNT charges, keeping the latest state of each"""
+    by_id = {charge['id']: charge for charge in charges}
+    for record in new_records:
+        current = by_id.get(record['id'])
+        if current is None or record['eventCreated'] >= current['eventCreated']:
+            by_id[record['id']] = record
+    ordered = sorted(by_id.values(), key=lambda charge: (charge['created'] or 0, charge['id']), reverse=True)
+    return ordered[:RECENT_CHARGES_PER_ACCOUNT]
+
+class RecentChargeIndex(SnapshotCache):
+    """account_id -> deque of recent charges (newest first), mirrored from recent_charges"""
+    
+    collection_name = 'recent_charges'
+    
+    def __init__(self):
+        self.hits = 0
+        self.empty = 0
+        self.backfills = 0
+        self.webhook_charges = 0
+        super().__init__()
+    
+    def _reset(self):
+        self.by_account = {}
+        self.empty_until = {}
+    
+    def _apply(self, account_id, charges_data, snapshot):
+        if charges_data is None:
+            self.by_account.pop(account_id, None)
+            self.empty_until.pop(account_id, None)
+        else:
+            self.by_account[account_id] = deque(charges_data.get('charges', []), maxlen=RECENT_CHARGES_PER_ACCOUNT)
+            self.empty_until[account_id] = charges_data.get('emptyUntil')
+    
+    def recent(self, account_id):
+        """Recent charges for an account, newest first; [] while a backfill's "no charges" marker
+        is fresh, None when nothing is indexed for the account"""
+        try:
+            self.ensure_live()
+            with self.lock:
+                charges = self.by_account.get(account_id)
+                charges = list(charges) if charges is not None else None
+                empty_until = self.empty_until.get(account_id)
+        except SnapshotCacheUnavailable:
+            charges_doc = db.collection('recent_charges').document(account_id).get()
+            charges_data = charges_doc.to_dict() if charges_doc.exists else {}
+            charges = charges_data.get('charges') if charges_doc.exists else None
+            empty_until = charges_data.get('emptyUntil')
+        if not charges and not (empty_until and empty_until > time.time()):
+            charges = None
+        with self.lock:
+            if charges:
+                self.hits += 1
+            else:
+                self.empty += 1
+        return charges
+    
+    def add(self, account_id, records, empty_until=None):
+        """Merge charge records into the account's ring, in Firestore and locally. empty_until
+        marks an account with no charges as known-empty until then"""
+        charges_ref = db.collection('recent_charges').document(account_id)
+        for attempt in range(8):
+            charges_doc = charges_ref.get()
+            current = charges_doc.to_dict().get('charges', []) if charges_doc.exists else []
+            charges = merge_charges(current, records)
+            charges_data = {'charges': charges, 'updatedAt': firestore.SERVER_TIMESTAMP}
+            if not charges and empty_until:
+                charges_data['emptyUntil'] = empty_until
+            try:
+                # Concurrent webhooks for one account: a lost update is retried instead of dropping
+                # a charge, both when the document changed and when another webhook created it first
+                if charges_doc.exists:
+                    charges_ref.update(charges_data, option=db.write_option(last_update_time=charges_doc.update_time))
+                else:
+                    charges_ref.create(charges_data)
+                break
+            except (FailedPrecondition, AlreadyExists, NotFound) as e:
+                if attempt == 7:
+                    raise
+                print(f"⚠️ Retrying recent charge update for {account_id}: {e}")
+                time.sleep(random.uniform(0, 0.02 * (attempt + 1)))
+        with self.lock:
+            self._apply(account_id, charges_data, None)
+        return charges
+    
+    def backfill(self, account_id):
+        """Cold start: page through Charge.list for the newest succeeded charges"""
+        records = []
+        page = stripe.Charge.list(limit=RECENT_CHARGES_PER_ACCOUNT, stripe_account=account_id)
+        for _ in range(RECENT_CHARGE_BACKFILL_PAGES):
+            records.extend(charge_record(charge, charge['created']) for charge in page.data
+                           if charge.get('status') == 'succeeded')
+            if len(records) >= RECENT_CHARGES_PER_ACCOUNT or not page.has_more:
+                break
+            page = stripe.Charge.list(limit=RECENT_CHARGES_PER_ACCOUNT, stripe_account=account_id,
+                                      starting_after=page.data[-1].id)
+        with self.lock:
+            self.backfills += 1
+        # Stored even when empty, so polls for an account without charges stop listing them
+        return self.add(account_id, records, empty_until=time.time() + RECENT_CHARGE_EMPTY_TTL_SECONDS)
+    
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.listener_stats(),
+                accounts=len(self.by_account),
+                hits=self.hits,
+                empty=self.empty,
+                backfills=self.backfills,
+                webhook_charges=self.webhook_charges
+            )
+
+recent_charges = RecentChargeIndex()
+
+@app.before_first_request
+def start_recent_charge_index():
+    recent_charges.start()
+
+@app.route('/debug/recent-charges', methods=['GET'])
+def debug_recent_charges():
+    return jsonify(recent_charges.stats())
+
+def handle_charge_event(event):
+    account_id = event.get('account')
+    charge = event['data']['object']
+    if not account_id:
+        # Platform charges aren't part of any merchant's POS feed
+        return
+    recent_charges.add(account_id, [charge_record(charge, event['created'])])
+    with recent_charges.lock:
+        recent_charges.webhook_charges += 1
+    print(f"💳 {event['type']} {charge['id']} indexed for {account_id}")
+
+STRIPE_WEBHOOK_HANDLERS = {
+    'account.updated': handle_account_updated,
+    'account.application.deauthorized': handle_account_deauthorized,
+    'charge.succeeded': handle_charge_event,
+    'charge.refunded': handle_charge_event
+}
+
+@app.route('/stripe/webhook', methods=['POST'])
+def stripe_webhook():
+    """Stripe (Connect) webhook endpoint; events are verified against STRIPE_WEBHOOK_SECRET"""
+    if not STRIPE_WEBHOOK_SECRET:
+        return jsonify({'error': 'Webhook secret not configured', 'success': False}), 400
+    try:
+        event = stripe.Webhook.construct_event(
+            request.get_data(), request.headers.get('Stripe-Signature'), STRIPE_WEBHOOK_SECRET
+        )
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        print(f"❌ Rejected webhook: {e}")
+        return jsonify({'error': 'Invalid payload or signature', 'success': False}), 400
+    
+    handler = STRIPE_WEBHOOK_HANDLERS.get(event['type'])
+    if handler is None:
+        return jsonify({'received': True, 'success': True})
+    try:
+        handler(event)
+        return jsonify({'received': True, 'success': True})
+    except Exception as e:
+        # Non-2xx makes Stripe redeliver the event
+        print(f"❌ Error handling {event['type']} webhook: {e}")
+        return jsonify({'error': str(e), 'success': False}), 400
+
 @app.route('/account-status/<account_id>', methods=['GET'])
 def account_status(account_id):
     try:
         print(f"Checking status for account: {account_id}")
         
-        account = stripe.Account.retrieve(account_id)
+        status = account_statuses.get(account_id)
         
-        return jsonify({
-            'charges_enabled': account.charges_enabled,
-            'payouts_enabled': account.payouts_enabled,
-            'details_submitted': account.details_submitted,
-            'success': True
-        })
+        return jsonify(dict(status, success=True))
         
     except Exception as e:
         print(f"❌ Error checking account status: {e}")
@@ -797,6 +3037,291 @@ def account_status(account_id):
             'success': False
         }), 400
 
+# Transfers are sent with a deterministic Stripe idempotency key; completed results are kept
+# per worker and in Firestore so a retried request returns the original transfer without
+# calling Stripe again. Stripe keeps idempotency keys for 24 hours.
+TRANSFER_RESULT_TTL_SECONDS = int(os.getenv('TRANSFER_RESULT_TTL_SECONDS', 24 * 60 * 60))
+TRANSFER_RESULT_MAX_ENTRIES = int(os.getenv('TRANSFER_RESULT_MAX_ENTRIES', 10000))
+
+class TransferConflict(Exception):
+    """Idempotency key reused with different transfer parameters"""
+
+class IdempotentTransfers:
+    """Exactly-once stripe.Transfer.create keyed by idempotency key"""
+    
+    def __init__(self):
+        self.results = TTLCache(TRANSFER_RESULT_TTL_SECONDS, TRANSFER_RESULT_MAX_ENTRIES)
+        # Duplicates arriving together on one worker wait for the first instead of racing to Stripe
+        self.key_locks = [threading.Lock() for _ in range(64)]
+        self.lock = threading.Lock()
+        self.created = 0
+        self.replayed_local = 0
+        self.replayed_shared = 0
+    
+    @staticmethod
+    def key_for(scope, client_key):
+        """Stripe idempotency key from the client/transaction key. Without one the key is random:
+        it still covers this request's network retries, but two real transfers with the same
+        parameters are two transfers, so they must never replay each other"""
+        basis = client_key or uuid.uuid4().hex
+        return f"{scope}-{hashlib.sha256(str(basis).encode('utf-8')).hexdigest()}"
+    
+    def execute(self, idempotency_key, params, build_response):
+        """Create the transfer once; returns (response dict, replayed)"""
+        fingerprint = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        
+        with self.key_locks[hash(idempotency_key) % len(self.key_locks)]:
+            cached = self.results.get(idempotency_key)
+            if cached is not None:
+                with self.lock:
+                    self.replayed_local += 1
+                return self.checked(cached, fingerprint), True
+            
+            result_ref = db.collection('transfer_results').document(idempotency_key)
+            stored = result_ref.get()
+            if stored.exists:
+                cached = stored.to_dict()
+                self.results.put(idempotency_key, cached)
+                with self.lock:
+                    self.replayed_shared += 1
+                return self.checked(cached, fingerprint), True
+            
+            # Another worker may be mid-request with the same key; Stripe replays its transfer to us
+            transfer = stripe.Transfer.create(idempotency_key=idempotency_key, **params)
+            response = build_response(transfer)
+            now = datetime.now(timezone.utc)
+            cached = {
+                'transferId': transfer.id,
+                'fingerprint': fingerprint,
+                'response': response,
+                'createdAt': now,
+                'expiresAt': now + timedelta(seconds=TRANSFER_RESULT_TTL_SECONDS)
+            }
+            try:
+                result_ref.set(cached)
+            except Exception as e:
+                # Stripe's own key still protects retries for 24h
+                print(f"⚠️ Could not store transfer result {transfer.id}: {e}")
+            self.results.put(idempotency_key, cached)
+            with self.lock:
+                self.created += 1
+            return response, False
+    
+    @staticmethod
+    def checked(cached, fingerprint):
+        if cached.get('fingerprint') != fingerprint:
+            raise TransferConflict('Idempotency key was already used for a transfer with different parameters')
+        return cached['response']
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'created': self.created,
+                'replayed_local': self.replayed_local,
+                'replayed_shared': self.replayed_shared,
+                'result_cache': self.results.stats()
+            }
+
+idempotent_transfers = IdempotentTransfers()
+
+@app.route('/debug/transfers', methods=['GET'])
+def debug_transfers():
+    return jsonify(idempotent_transfers.stats())
+
+# SETTLEMENT_MODE=batched: /create-balance-payment only records the payment in
+# settlement_ledger; a scheduler nets each merchant's window into one transfer
+SETTLEMENT_MODE = os.getenv('SETTLEMENT_MODE', 'immediate')
+SETTLEMENT_WINDOW_SECONDS = int(os.getenv('SETTLEMENT_WINDOW_SECONDS', 60 * 60))
+# Wait this long after a window closes so checkouts in flight at the boundary land first
+SETTLEMENT_GRACE_SECONDS = int(os.getenv('SETTLEMENT_GRACE_SECONDS', 60))
+SETTLEMENT_POLL_SECONDS = int(os.getenv('SETTLEMENT_POLL_SECONDS', 60))
+
+def settlement_window(epoch_seconds):
+    return int(epoch_seconds // SETTLEMENT_WINDOW_SECONDS) * SETTLEMENT_WINDOW_SECONDS
+
+def record_settlement_entry(ledger_id, entry):
+    """Add a payment to the ledger once; returns the stored entry (the original one for a retry)"""
+    ledger_ref = db.collection('settlement_ledger').document(ledger_id)
+    now = time.time()
+    entry = dict(entry, status='pending', window=settlement_window(now), recordedAt=datetime.now(timezone.utc))
+    try:
+        ledger_ref.create(entry)
+        return entry, False
+    except AlreadyExists:
+        return ledger_ref.get().to_dict(), True
+
+# A claim writes the settlement plus one update per entry, inside Firestore's 500 writes per transaction
+SETTLEMENT_MAX_ENTRIES = 400
+
+@firestore.transactional
+def claim_settlement_entries(transaction, destination, window, entry_refs):
+    """Create the window's next settlement and mark every entry that is still pending as claimed
+    by it, in one transaction, so an overlapping run can't put a payment in a second transfer.
+    Returns (settlement_id, settlement), or None if other runs already claimed all of them"""
+    entries = [(snapshot.reference, snapshot.to_dict()) for snapshot in transaction.get_all(entry_refs)]
+    entries = [(ref, entry) for ref, entry in entries if entry and entry['status'] == 'pending']
+    if not entries:
+        return None
+    
+    for sequence in itertools.count(1):
+        # Late entries for a window that already has a settlement go in a follow-up one
+        settlement_id = f"{destination}-{window}" + (f"-{sequence}" if sequence > 1 else '')
+        settlement_ref = db.collection('settlements').document(settlement_id)
+        if not settlement_ref.get(transaction=transaction).exists:
+            break
+    
+    settlement = {
+        'destination': destination,
+        'windowStart': window,
+        'status': 'transferring',
+        'entryIds': sorted(ref.id for ref, _ in entries),
+        'params': {
+            'amount': sum(entry['merchantReceives'] for _, entry in entries),
+            'currency': 'usd',
+            'destination': destination,
+            'description': f"Settlement {settlement_id} ({len(entries)} payments)",
+            'metadata': {
+                'settlement_id': settlement_id,
+                'window_start': window,
+                'transactions': len(entries),
+                'base_amount': sum(entry['baseAmount'] for _, entry in entries),
+                'tip_amount': sum(entry['tipAmount'] for _, entry in entries),
+                'reward_amount': sum(entry['rewardAmount'] for _, entry in entries),
+                'platform_fee': sum(entry['platformFee'] for _, entry in entries)
+            }
+        },
+        'createdAt': datetime.now(timezone.utc)
+    }
+    transaction.create(settlement_ref, settlement)
+    for ref, _ in entries:
+        transaction.update(ref, {'status': 'claimed', 'settlementId': settlement_id})
+    return settlement_id, settlement
+
+class SettlementScheduler:
+    """Nets pending ledger entries into one Stripe transfer per merchant per closed window"""
+    
+    def __init__(self):
+        self.thread = None
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.transfers = 0
+        self.entries_settled = 0
+        self.failures = 0
+        self.last_run = None
+    
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='settlement-scheduler', daemon=True)
+                self.thread.start()
+    
+    def run(self):
+        while True:
+            time.sleep(SETTLEMENT_POLL_SECONDS)
+            try:
+                self.settle()
+            except Exception as e:
+                print(f"⚠️ Settlement scheduler error: {e}")
+    
+    def settle(self, include_open=False):
+        """Settle every closed window (and the current one too if include_open); returns settlement summaries"""
+        # Settlements an earlier run claimed but didn't finish retry with their stored params and Stripe key
+        summaries = [self.transfer_settlement(settlement_doc.id, settlement_doc.to_dict())
+                     for settlement_doc in db.collection('settlements').where('status', '==', 'transferring').stream()]
+        
+        cutoff = settlement_window(time.time() - SETTLEMENT_GRACE_SECONDS)
+        groups = {}
+        for ledger_doc in db.collection('settlement_ledger').where('status', '==', 'pending').stream():
+            entry = ledger_doc.to_dict()
+            if not include_open and entry['window'] >= cutoff:
+                continue
+            groups.setdefault((entry['destination'], entry['window']), []).append(ledger_doc.reference)
+        
+        for (destination, window), entry_refs in sorted(groups.items()):
+            for chunk in chunks(entry_refs, SETTLEMENT_MAX_ENTRIES):
+                claimed = claim_settlement_entries(db.transaction(), destination, window, chunk)
+                if claimed:
+                    summaries.append(self.transfer_settlement(*claimed))
+        with self.lock:
+            self.runs += 1
+            self.last_run = datetime.now(timezone.utc).isoformat()
+        return summaries
+    
+    def transfer_settlement(self, settlement_id, settlement):
+        destination = settlement['destination']
+        params = settlement['params']
+        
+        transfer_id = None
+        if params['amount'] > 0:
+            try:
+                response, _ = idempotent_transfers.execute(f"settlement-{settlement_id}", params,
+                                                           lambda transfer: {'transfer_id': transfer.id})
+            except Exception as e:
+                # Entries stay claimed; the next run resumes this settlement with the same key
+                print(f"❌ Settlement {settlement_id} failed: {e}")
+                with self.lock:
+                    self.failures += 1
+                return {'settlement_id': settlement_id, 'error': str(e)}
+            transfer_id = response['transfer_id']
+        
+        now = datetime.now(timezone.utc)
+        ledger = db.collection('settlement_ledger')
+        for chunk in chunks(settlement['entryIds'], 400):
+            batch = db.batch()
+            for ledger_id in chunk:
+                batch.update(ledger.document(ledger_id), {
+                    'status': 'settled', 'settlementId': settlement_id, 'transferId': transfer_id, 'settledAt': now
+                })
+            batch.commit()
+        db.collection('settlements').document(settlement_id).update({
+            'status': 'settled',
+            'transferId': transfer_id,
+            'settledAt': now
+        })
+        
+        with self.lock:
+            self.transfers += 1 if transfer_id else 0
+            self.entries_settled += len(settlement['entryIds'])
+        print(f"✅ Settled {len(settlement['entryIds'])} payments to {destination}: ${params['amount']/100} ({transfer_id})")
+        return {
+            'settlement_id': settlement_id,
+            'transfer_id': transfer_id,
+            'amount': params['amount'],
+            'payments': len(settlement['entryIds'])
+        }
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'mode': SETTLEMENT_MODE,
+                'window_seconds': SETTLEMENT_WINDOW_SECONDS,
+                'runs': self.runs,
+                'last_run': self.last_run,
+                'transfers': self.transfers,
+                'entries_settled': self.entries_settled,
+                'failures': self.failures
+            }
+
+settlement_scheduler = SettlementScheduler()
+
+@app.before_first_request
+def start_settlement_scheduler():
+    if SETTLEMENT_MODE == 'batched':
+        settlement_scheduler.start()
+
+@app.route('/debug/settlements', methods=['GET'])
+def debug_settlements():
+    return jsonify(settlement_scheduler.stats())
+
+@app.cli.command('settle')
+@click.option('--include-open', is_flag=True, help='Also settle the current, still-open window')
+def settle_command(include_open):
+    """Net pending balance payments into per-merchant transfers now"""
+    summaries = settlement_scheduler.settle(include_open=include_open)
+    for summary in summaries:
+        click.echo(json.dumps(summary))
+    click.echo(f"✅ {len(summaries)} settlements")
+
 @app.route('/transfer-to-merchant', methods=['POST'])
 def transfer_to_merchant():
     try:
@@ -809,21 +3334,34 @@ def transfer_to_merchant():
         
         print(f"Creating transfer to {destination_account} for ${amount_cents/100}")
         
-        transfer = stripe.Transfer.create(
-            amount=amount_cents,
-            currency=currency,
-            destination=destination_account,
-            description=description,
-            metadata=metadata
-        )
-        
-        print(f"✅ Created transfer: {transfer.id} Amount: ${amount_cents/100}")
+        params = {
+            'amount': amount_cents,
+            'currency': currency,
+            'destination': destination_account,
+            'description': description,
+            'metadata': metadata
+        }
+        client_key = request.headers.get('Idempotency-Key') or data.get('transaction_id') or metadata.get('transaction_id')
+        idempotency_key = IdempotentTransfers.key_for('transfer', client_key)
         
-        return jsonify({
+        response, replayed = idempotent_transfers.execute(idempotency_key, params, lambda transfer: {
             'transfer_id': transfer.id,
             'success': True
         })
         
+        if replayed:
+            print(f"↩️ Replayed transfer: {response['transfer_id']}")
+        else:
+            print(f"✅ Created transfer: {response['transfer_id']} Amount: ${amount_cents/100}")
+        
+        return jsonify(response)
+        
+    except TransferConflict as e:
+        print(f"❌ Error creating transfer: {e}")
+        return jsonify({
+            'error': str(e),
+            'success': False
+        }), 409
     except Exception as e:
         print(f"❌ Error creating transfer: {e}")
         return jsonify({
@@ -874,6 +3412,132 @@ def payment_return():
     </html>
     """
 
+def payment_split(base_amount_cents, tip_amount_cents, merchant_rate):
+    """(reward_amount, platform_fee, merchant_receives) in cents for one balance payment"""
+    reward_amount = int(base_amount_cents * merchant_rate / 100)
+    platform_fee = int(base_amount_cents * 0.01)  # 1% platform fee on base only
+    merchant_receives = base_amount_cents - reward_amount - platform_fee + tip_amount_cents
+    return reward_amount, platform_fee, merchant_receives
+
+def payment_splits(base_amount_cents, tip_amount_cents, merchant_rate):
+    """payment_split over arrays. Same float64 multiply/divide and truncation toward zero,
+    so every row matches the per-request result exactly"""
+    base = np.asarray(base_amount_cents, dtype=np.int64)
+    tip = np.asarray(tip_amount_cents, dtype=np.int64)
+    rate = np.asarray(merchant_rate, dtype=np.float64)
+    base_float = base.astype(np.float64)
+    scaled = base_float * rate
+    scaled /= 100
+    # float64 -> int64 casts truncate toward zero, like int()
+    reward_amount = scaled.astype(np.int64)
+    base_float *= 0.01
+    platform_fee = base_float.astype(np.int64)
+    merchant_receives = base - reward_amount
+    merchant_receives -= platform_fee
+    merchant_receives += tip
+    return reward_amount, platform_fee, merchant_receives
+
+SETTLEMENT_PREVIEW_CHUNK_ROWS = int(os.getenv('SETTLEMENT_PREVIEW_CHUNK_ROWS', 16384))
+SETTLEMENT_PREVIEW_FIELDS = ('base_amount', 'tip_amount', 'reward_amount', 'platform_fee', 'merchant_receives')
+
+def settlement_chunks(lines):
+    """Column chunks (merchants, base_amount_cents, tip_amount_cents, merchant_rate) of up to
+    SETTLEMENT_PREVIEW_CHUNK_ROWS rows from CSV with a header row or JSONL, using the same
+    field names as /create-balance-payment"""
+    lines = iter(lines)
+    first = next((line for line in lines if line.strip()), None)
+    if first is None:
+        return
+    
+    if first.lstrip().startswith('{'):
+        records = (json.loads(line) for line in itertools.chain([first], lines) if line.strip())
+        while True:
+            chunk = list(itertools.islice(records, SETTLEMENT_PREVIEW_CHUNK_ROWS))
+            if not chunk:
+                return
+            yield (np.array([row['merchant_stripe_account'] for row in chunk]),
+                   np.array([int(row['base_amount_cents']) for row in chunk], dtype=np.int64),
+                   np.array([int(row.get('tip_amount_cents') or 0) for row in chunk], dtype=np.int64),
+                   np.array([row.get('merchant_rate') or 0 for row in chunk], dtype=np.float64))
+    
+    header = next(csv.reader([first]))
+    columns = [header.index(name) if name in header else None
+               for name in ('merchant_stripe_account', 'base_amount_cents', 'tip_amount_cents', 'merchant_rate')]
+    if columns[0] is None or columns[1] is None:
+        raise ValueError('CSV needs merchant_stripe_account and base_amount_cents columns')
+    
+    def column(rows, index, cast, dtype):
+        if index is None:
+            return np.zeros(len(rows), dtype=dtype)
+        values = [row[index] for row in rows]
+        if '' in values:
+            values = [value or '0' for value in values]
+        # int()/float() per cell, so parsing matches the per-request path exactly
+        return np.fromiter(map(cast, values), dtype=dtype, count=len(values))
+    
+    reader = csv.reader(lines)
+    while True:
+        rows = [row for row in itertools.islice(reader, SETTLEMENT_PREVIEW_CHUNK_ROWS) if row]
+        if not rows:
+            return
+        yield (np.array([row[columns[0]] for row in rows]), column(rows, columns[1], int, np.int64),
+               column(rows, columns[2], int, np.int64), column(rows, columns[3], float, np.float64))
+
+def settlement_preview(lines):
+    """Per-merchant totals for a transaction file, computed in vectorized chunks"""
+    totals = {}  # merchant -> [payments, base, tip, reward, fee, receives]
+    for merchants, base, tip, rate in settlement_chunks(lines):
+        reward_amount, platform_fee, merchant_receives = payment_splits(base, tip, rate)
+        
+        # Group rows by merchant and sum in int64, so totals are exact
+        names, codes = np.unique(merchants, return_inverse=True)
+        order = np.argsort(codes, kind='stable')
+        starts = np.searchsorted(codes[order], np.arange(len(names)))
+        counts = np.bincount(codes, minlength=len(names))
+        sums = [np.add.reduceat(column[order], starts).tolist()
+                for column in (base, tip, reward_amount, platform_fee, merchant_receives)]
+        for i, name in enumerate(names.tolist()):
+            total = totals.setdefault(name, [0] * 6)
+            total[0] += int(counts[i])
+            for j, column_sums in enumerate(sums, start=1):
+                total[j] += column_sums[i]
+    
+    for merchant, (payments, *amounts) in sorted(totals.items()):
+        yield dict({'merchant_stripe_account': merchant, 'payments': payments}, **dict(zip(SETTLEMENT_PREVIEW_FIELDS, amounts)))
+
+
+@app.route('/settlement-preview', methods=['POST'])
+def settlement_preview_route():
+    """Per-merchant fee/reward/payout totals for an uploaded CSV or JSONL of balance payments,
+    streamed back as JSON lines"""
+    try:
+        upload = request.files.get('file')
+        source = upload.stream if upload else request.stream
+        merchants = settlement_preview(io.TextIOWrapper(source, encoding='utf-8'))
+        # The first line needs the whole upload totalled, so a malformed file still gets a 400 here
+        first = next(merchants, None)
+        
+        def generate():
+            count = 0
+            for merchant in itertools.chain([first] if first else [], merchants):
+                count += 1
+                yield json.dumps(merchant) + '\n'
+            print(f"✅ Settlement preview: {count} merchants")
+        
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return jsonify({'error': str(e), 'success': False}), 400
+
+@app.cli.command('settlement-preview')
+@click.argument('input_file', type=click.File('r'))
+@click.option('--output', type=click.File('w'), default='-', help='JSON lines output (default stdout)')
+def settlement_preview_command(input_file, output):
+    """Per-merchant settlement totals for a CSV/JSONL file of balance payments"""
+    for merchant in settlement_preview(input_file):
+        output.write(json.dumps(merchant) + '\n')
+
 @app.route('/create-balance-payment', methods=['POST'])
 def create_balance_payment():
     try:
@@ -890,32 +3554,54 @@ def create_balance_payment():
         print(f"Merchant rate: {merchant_rate}%")
         
         # Calculate what merchant gets (base minus rewards + full tip)
-        reward_amount = int(base_amount_cents * merchant_rate / 100)
-        platform_fee = int(base_amount_cents * 0.01)  # 1% platform fee on base only
-        merchant_receives = base_amount_cents - reward_amount - platform_fee + tip_amount_cents
+        reward_amount, platform_fee, merchant_receives = payment_split(base_amount_cents, tip_amount_cents, merchant_rate)
         
         print(f"Merchant receives: ${merchant_receives/100}")
         print(f"Reward pool: ${reward_amount/100}")
         print(f"Platform fee: ${platform_fee/100}")
         
-        # Create the transfer to merchant
-        transfer = stripe.Transfer.create(
-            amount=merchant_receives,
-            currency='usd',
-            destination=merchant_stripe_account,
-            description=f"Payment for transaction {transaction_id}",
-            metadata={
+        # Create the transfer to merchant, once per transaction
+        params = {
+            'amount': merchant_receives,
+            'currency': 'usd',
+            'destination': merchant_stripe_account,
+            'description': f"Payment for transaction {transaction_id}",
+            'metadata': {
                 'transaction_id': transaction_id,
                 'base_amount': base_amount_cents,
                 'tip_amount': tip_amount_cents,
                 'reward_amount': reward_amount,
                 'platform_fee': platform_fee
             }
-        )
-        
-        print(f"✅ Transfer created: {transfer.id}")
+        }
+        client_key = request.headers.get('Idempotency-Key') or transaction_id
+        idempotency_key = IdempotentTransfers.key_for('balance-payment', client_key)
+        
+        if SETTLEMENT_MODE == 'batched':
+            # Just a ledger write at checkout; the transfer happens at settlement
+            entry, replayed = record_settlement_entry(idempotency_key, {
+                'destination': merchant_stripe_account,
+                'transactionId': transaction_id,
+                'merchantReceives': merchant_receives,
+                'baseAmount': base_amount_cents,
+                'tipAmount': tip_amount_cents,
+                'rewardAmount': reward_amount,
+                'platformFee': platform_fee
+            })
+            if entry['merchantReceives'] != merchant_receives or entry['destination'] != merchant_stripe_account:
+                raise TransferConflict('Idempotency key was already used for a payment with different parameters')
+            print(f"{'↩️ Already recorded' if replayed else '✅ Recorded'} payment {idempotency_key[:24]} for settlement")
+            return jsonify({
+                'transfer_id': entry.get('transferId'),
+                'settlement': entry['status'],
+                'ledger_id': idempotency_key,
+                'merchant_received': merchant_receives,
+                'reward_amount': reward_amount,
+                'platform_fee': platform_fee,
+                'success': True
+            })
         
-        return jsonify({
+        response, replayed = idempotent_transfers.execute(idempotency_key, params, lambda transfer: {
             'transfer_id': transfer.id,
             'merchant_received': merchant_receives,
             'reward_amount': reward_amount,
@@ -923,6 +3609,19 @@ def create_balance_payment():
             'success': True
         })
         
+        if replayed:
+            print(f"↩️ Replayed transfer: {response['transfer_id']}")
+        else:
+            print(f"✅ Transfer created: {response['transfer_id']}")
+        
+        return jsonify(response)
+        
+    except TransferConflict as e:
+        print(f"❌ Error: {e}")
+        return jsonify({
+            'error': str(e),
+            'success': False
+        }), 409
     except stripe.error.StripeError as e:
         print(f"❌ Stripe error: {e}")
         return jsonify({
@@ -944,18 +3643,17 @@ def get_recent_charge():
         
         print(f"Fetching recent charges for account: {account_id}")
         
-        # Get charges from the connected account
-        charges = stripe.Charge.list(
-            limit=1,
-            stripe_account=account_id
-        )
+        # Webhook-fed index first; Stripe is only asked when nothing is indexed for the account
+        charges = recent_charges.recent(account_id)
+        if charges is None:
+            charges = recent_charges.backfill(account_id)
         
-        if charges.data:
-            charge = charges.data[0]
+        if charges:
+            charge = charges[0]
             return jsonify({
-                'amount': charge.amount,
-                'description': charge.description,
-                'created': charge.created,
+                'amount': charge['amount'],
+                'description': charge['description'],
+                'created': charge['created'],
                 'success': True
             })
         else:
@@ -1033,7 +3731,7 @@ def square_oauth_callback():
             'grant_type': 'authorization_code'
         }
         
-        response = requests.post(f"{base_url}/oauth2/token", json=token_data)
+        response = outbound.post(f"{base_url}/oauth2/token", json=token_data)
         token_response = response.json()
         
         if 'access_token' not in token_response:
@@ -1104,7 +3802,7 @@ def get_recent_square_order():
         }
         
         # First, get the merchant's locations
-        locations_response = requests.get(f"{base_url}/v2/locations", headers=headers)
+        locations_response = outbound.get(f"{base_url}/v2/locations", headers=headers)
         
         if locations_response.status_code != 200:
             print(f"❌ Failed to get locations: {locations_response.text}")
@@ -1121,8 +3819,9 @@ def get_recent_square_order():
         print(f"✅ Using location ID: {location_id}")
         
         # Now search for orders with the location ID
-        response = requests.post(f"{base_url}/v2/orders/search", 
+        response = outbound.post(f"{base_url}/v2/orders/search", 
                                headers=headers,
+                               idempotent=True,  # read-only search
                                json={
                                    "limit": 1,
                                    "location_ids": [location_id],  # Add location_ids here
@@ -1151,7 +3850,7 @@ def get_recent_square_order():
             print("No orders found - trying payments instead")
             
             # Try getting payments instead of orders
-            payments_response = requests.get(
+            payments_response = outbound.get(
                 f"{base_url}/v2/payments",
                 headers=headers,
                 params={
@@ -0,0 +1,125 @@
+"""Pass-update push fan-out benchmark against a local fake APNs server.
+
+The fake server speaks plain-text HTTP/2 (prior knowledge) on localhost,
+answers 410 Unregistered for tokens starting with "dead" and 200 otherwise,
+and counts TCP connections so connection reuse is visible.
+
+    python bench_apns.py --devices 2000 --serials-per-device 3 --latency-ms 20
+"""
+import argparse
+import json
+import socket
+import threading
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.settings
+
+from bench_wallet_pass import setup_environment
+
+
+class FakeAPNsServer:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.connections = 0
+        self.requests = 0
+        self.max_concurrent_streams = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(16)
+        self.url = f"http://127.0.0.1:{self._sock.getsockname()[1]}"
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            conn, _ = self._sock.accept()
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, sock):
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        conn.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: 1000})
+        lock = threading.Lock()
+        paths = {}
+        in_flight = set()
+        sock.sendall(conn.data_to_send())
+
+        def respond(stream_id):
+            token = paths.pop(stream_id).rsplit('/', 1)[-1]
+            status, body = (410, b'{"reason":"Unregistered"}') if token.startswith('dead') else (200, b'')
+            with lock:
+                in_flight.discard(stream_id)
+                conn.send_headers(stream_id, [(':status', str(status)), ('content-length', str(len(body)))],
+                                  end_stream=not body)
+                if body:
+                    conn.send_data(stream_id, body, end_stream=True)
+                sock.sendall(conn.data_to_send())
+
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return
+            with lock:
+                events = conn.receive_data(data)
+                sock.sendall(conn.data_to_send())
+            for event in events:
+                if isinstance(event, h2.events.RequestReceived):
+                    paths[event.stream_id] = dict(event.headers)[b':path'].decode()
+                elif isinstance(event, h2.events.StreamEnded):
+                    self.requests += 1
+                    in_flight.add(event.stream_id)
+                    self.max_concurrent_streams = max(self.max_concurrent_streams, len(in_flight))
+                    if self.latency:
+                        threading.Timer(self.latency, respond, args=(event.stream_id,)).start()
+                    else:
+                        respond(event.stream_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--serials-per-device', type=int, default=3)
+    parser.add_argument('--dead-ratio', type=float, default=0.05, help='share of devices APNs reports as 410')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='fake APNs response delay')
+    args = parser.parse_args()
+
+    app, *_ = setup_environment()
+    from fake_firestore import FakeFirestore
+
+    server = FakeAPNsServer(latency=args.latency_ms / 1000)
+    app.APNS_URL = server.url
+    app.db = FakeFirestore()
+
+    # Several serials per device, so tokens must be deduplicated per device
+    serials = set()
+    dead_every = int(1 / args.dead_ratio) if args.dead_ratio else 0
+    batch = app.db.batch()
+    for d in range(args.devices):
+        device_id = f"device{d:06d}"
+        token = f"{'dead' if dead_every and d % dead_every == 0 else 'live'}{d:060d}"
+        for s in range(args.serials_per_device):
+            serial = f"user{d:06d}-merchant{s}"
+            serials.add(serial)
+            batch.set(app.db.collection('pass_registrations').document(f"{device_id}_{serial}"), {
+                'deviceId': device_id, 'serialNumber': serial, 'pushToken': token,
+                'passTypeIdentifier': app.PASS_TYPE_ID, 'updateTag': 0,
+            })
+        batch.set(app.db.collection('pass_devices').document(device_id), {'pushToken': token})
+    batch.commit()
+
+    stats = app.push_pass_updates(sorted(serials))
+    remaining = len(app.db.collection('pass_registrations').get())
+    print(json.dumps({
+        'fanout': stats,
+        'apns_requests': server.requests,
+        'apns_connections': server.connections,
+        'max_concurrent_streams': server.max_concurrent_streams,
+        'registrations_left': remaining,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""NFC tap redirect (`/`) benchmarks.
+
+    python bench_nfc_redirect.py lookup --max-cards 1000000
+        per-tap CPU cost as the card index grows (should stay flat)
+    python bench_nfc_redirect.py storm --concurrency 1,4,16,64 --latency-ms 20 [--no-index]
+        tap-storm load test: the app served over HTTP on localhost against the
+        Firestore stand-in, with a mix of valid, unknown, pending and expired taps
+
+No network and no Google credentials required.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import requests
+from werkzeug.serving import make_server
+
+from bench_wallet_pass import percentiles, setup_environment
+
+
+class _LiveWatch:
+    is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+
+
+def _snapshot(doc_id, data):
+    return SimpleNamespace(id=doc_id, to_dict=lambda: data, update_time=None)
+
+
+def grow_index(app, start, stop, pending_every=10):
+    """Add cards [start, stop) through the same snapshot path a listener uses"""
+    added = SimpleNamespace(name='ADDED')
+    businesses = [
+        SimpleNamespace(type=added, document=_snapshot(f"biz{i:07d}", {
+            'name': f"Merchant & Sons #{i}", 'nfcCardId': f"card{i:07d}"}))
+        for i in range(start, stop)
+    ]
+    expires_at = SimpleNamespace(timestamp=lambda: time.time() + 3600)
+    charges = [
+        SimpleNamespace(type=added, document=_snapshot(f"biz{i:07d}", {
+            'status': 'pending', 'amount': 12.5, 'expiresAt': expires_at}))
+        for i in range(start, stop) if i % pending_every == 0
+    ]
+    for cache, changes in ((app.business_index, businesses), (app.pending_charges, charges)):
+        if not cache.ready:
+            cache.watch = _LiveWatch()
+            cache._on_snapshot([change.document for change in changes], changes, None)
+        else:
+            cache._on_snapshot([], changes, None)
+
+
+def bench_lookup(app, sizes, taps):
+    client = app.app.test_client()
+    results = []
+    size_so_far = 0
+    for size in sizes:
+        grow_index(app, size_so_far, size)
+        size_so_far = size
+        cards = [f"card{random.randrange(size):07d}" for _ in range(taps)]
+
+        # Core tap work: index lookup, pending charge, URL assembly
+        cpu_start = time.process_time()
+        for card_id in cards:
+            business_id, _, redirect_base = app.find_business_by_card(card_id)
+            app.pay_redirect_url(redirect_base, app.find_pending_amount(business_id))
+        core_ns = (time.process_time() - cpu_start) / taps * 1e9
+
+        # Whole route through Flask, logging included but discarded
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            cpu_start = time.process_time()
+            for card_id in cards:
+                client.get(f"/?cardId={card_id}")
+            route_us = (time.process_time() - cpu_start) / taps * 1e6
+
+        results.append({'cards': size, 'core_cpu_ns_per_tap': round(core_ns),
+                        'route_cpu_us_per_tap': round(route_us, 1)})
+        print(json.dumps(results[-1]))
+
+    core = [r['core_cpu_ns_per_tap'] for r in results]
+    route = [r['route_cpu_us_per_tap'] for r in results]
+    return {
+        'sizes': results,
+        'core_max_over_min': round(max(core) / min(core), 2),
+        'route_max_over_min': round(max(route) / min(route), 2),
+    }
+
+
+def seed_storm_data(app, businesses, pending_ratio, expired_ratio):
+    """Businesses with cards, some with a live pending charge and some with an expired one"""
+    now = datetime.now(timezone.utc)
+    kinds = {}
+    batch = app.db.batch()
+    for i in range(businesses):
+        business_id = f"biz{i:06d}"
+        batch.set(app.db.collection('businesses').document(business_id), {
+            'name': f"Merchant & Sons #{i}", 'nfcCardId': f"card{i:06d}"})
+        roll = random.random()
+        if roll < pending_ratio:
+            kinds[f"card{i:06d}"] = 'pending'
+            batch.set(app.db.collection('nfc_payments').document(business_id), {
+                'status': 'pending', 'amount': 12.5, 'expiresAt': now + timedelta(hours=1)})
+        elif roll < pending_ratio + expired_ratio:
+            kinds[f"card{i:06d}"] = 'expired'
+            batch.set(app.db.collection('nfc_payments').document(business_id), {
+                'status': 'pending', 'amount': 9.0, 'expiresAt': now - timedelta(hours=1)})
+        else:
+            kinds[f"card{i:06d}"] = 'valid'
+    batch.commit()
+    return kinds
+
+
+def tap_traffic(kinds, taps, unknown_ratio):
+    """(url path, kind) for each tap; unknown cards are never registered"""
+    cards = list(kinds)
+    traffic = []
+    for i in range(taps):
+        if random.random() < unknown_ratio:
+            traffic.append((f"/?cardId=unknown{i:06d}", 'unknown'))
+        else:
+            card_id = random.choice(cards)
+            traffic.append((f"/?cardId={card_id}", kinds[card_id]))
+    return traffic
+
+
+def run_storm(base_url, traffic, concurrency):
+    local = threading.local()
+    latencies = [0.0] * len(traffic)
+    outcomes = [None] * len(traffic)
+
+    def tap(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        path, kind = traffic[i]
+        start = time.perf_counter()
+        response = session.get(base_url + path, allow_redirects=False)
+        latencies[i] = time.perf_counter() - start
+        has_amount = 'amount=' in response.headers.get('Location', '')
+        outcomes[i] = (kind, response.status_code, has_amount)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(tap, range(len(traffic))))
+    elapsed = time.perf_counter() - start
+
+    # A tap is correct if the status and amount suffix match what its card should produce
+    expected = {'valid': (302, False), 'pending': (302, True), 'expired': (302, False), 'unknown': (404, False)}
+    wrong = sum(1 for kind, status, has_amount in outcomes if expected[kind] != (status, has_amount))
+    return dict(
+        percentiles(latencies),
+        taps_per_sec=round(len(traffic) / elapsed, 1),
+        statuses=dict(Counter(status for _, status, _ in outcomes)),
+        mix=dict(Counter(kind for kind, _, _ in outcomes)),
+        wrong=wrong,
+    )
+
+
+def bench_storm(app, args):
+    from fake_firestore import FakeFirestore
+
+    app.db = FakeFirestore(latency=args.latency_ms / 1000)
+    app.NFC_INDEX_ENABLED = not args.no_index
+    kinds = seed_storm_data(app, args.businesses, args.pending_ratio, args.expired_ratio)
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = {
+        'config': {
+            'businesses': args.businesses, 'taps': args.taps, 'latency_ms': args.latency_ms,
+            'unknown_ratio': args.unknown_ratio, 'pending_ratio': args.pending_ratio,
+            'expired_ratio': args.expired_ratio, 'index': not args.no_index,
+        },
+        'concurrency': {},
+    }
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # Warm-up tap starts the listeners (before_first_request) outside the measurement
+        requests.get(base_url + '/?cardId=warmup', allow_redirects=False)
+        for concurrency in args.concurrency:
+            traffic = tap_traffic(kinds, args.taps, args.unknown_ratio)
+            app.db.reset_counters()
+            run = run_storm(base_url, traffic, concurrency)
+            run['firestore'] = dict(app.db.counters)
+            results['concurrency'][str(concurrency)] = run
+    server.shutdown()
+
+    for concurrency, run in results['concurrency'].items():
+        print(f"c={concurrency:<4} {run['taps_per_sec']:>8} taps/s  p50 {run['p50_ms']:>8}ms  "
+              f"p99 {run['p99_ms']:>8}ms  wrong {run['wrong']}  firestore {run['firestore']}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('suite', nargs='?', default='lookup', choices=['lookup', 'storm'])
+    parser.add_argument('--max-cards', type=int, default=1_000_000)
+    parser.add_argument('--taps', type=int, default=None, help='taps per measurement')
+    parser.add_argument('--businesses', type=int, default=5_000, help='registered cards for the storm')
+    parser.add_argument('--concurrency', default='1,4,16,64', help='comma-separated storm concurrency levels')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='simulated Firestore round trip')
+    parser.add_argument('--unknown-ratio', type=float, default=0.1, help='share of taps on unregistered cards')
+    parser.add_argument('--pending-ratio', type=float, default=0.3, help='share of businesses with a live charge')
+    parser.add_argument('--expired-ratio', type=float, default=0.1, help='share of businesses with an expired charge')
+    parser.add_argument('--no-index', action='store_true', help='disable the in-memory index (Firestore query path)')
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    args = parser.parse_args()
+
+    app, *_ = setup_environment()
+    from fake_firestore import FakeFirestore
+    app.db = FakeFirestore()
+
+    if args.suite == 'lookup':
+        sizes = [n for n in (1_000, 10_000, 100_000, 1_000_000) if n < args.max_cards] + [args.max_cards]
+        results = bench_lookup(app, sizes, args.taps or 20_000)
+    else:
+        args.taps = args.taps or 2_000
+        args.concurrency = [int(level) for level in args.concurrency.split(',')]
+        results = bench_storm(app, args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
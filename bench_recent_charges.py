@@ -0,0 +1,292 @@
+"""/get-recent-charge index checks: recorded Connect webhook events replayed
+through a signed /stripe/webhook, plus cold-start backfill against a local
+fake Stripe charges API.
+
+    python bench_recent_charges.py --latency-ms 300 --polls 200
+
+Checks that polls are answered from the index without Charge.list calls,
+that refunds and out-of-order redeliveries keep the latest charge state,
+that the ring stays bounded, that concurrent webhooks for one account don't
+lose charges, that an account without charges isn't listed on every poll,
+and that a second worker sees the same index. Exits non-zero on any failed
+check.
+"""
+import argparse
+import contextlib
+import copy
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from bench_wallet_pass import percentiles, setup_environment
+
+WEBHOOK_SECRET = 'whsec_bench'
+
+# Recorded from a test-mode Connect endpoint (ids and amounts varied per replay)
+RECORDED_CHARGE_SUCCEEDED = json.loads("""
+{
+  "id": "evt_3NqA8bH2eZvKYlo21pQk7LrX",
+  "object": "event",
+  "account": "acct_1NqA2xH2eZvKYlo2",
+  "api_version": "2020-08-27",
+  "created": 1695051234,
+  "data": {
+    "object": {
+      "id": "ch_3NqA8bH2eZvKYlo21Yw2Jd7p",
+      "object": "charge",
+      "amount": 2800,
+      "amount_captured": 2800,
+      "amount_refunded": 0,
+      "application_fee_amount": null,
+      "balance_transaction": "txn_3NqA8bH2eZvKYlo21b1kZt1Q",
+      "captured": true,
+      "created": 1695051233,
+      "currency": "usd",
+      "description": "LUX payment",
+      "livemode": false,
+      "metadata": {},
+      "paid": true,
+      "payment_intent": "pi_3NqA8bH2eZvKYlo21zq6ZcDv",
+      "payment_method": "pm_1NqA8aH2eZvKYlo2rQf8hXfB",
+      "refunded": false,
+      "refunds": {"object": "list", "data": [], "has_more": false, "total_count": 0,
+                  "url": "/v1/charges/ch_3NqA8bH2eZvKYlo21Yw2Jd7p/refunds"},
+      "status": "succeeded"
+    }
+  },
+  "livemode": false,
+  "pending_webhooks": 1,
+  "request": {"id": "req_Q7sZ0nJfkq2ZbS", "idempotency_key": "5b1c7e0e-3a3b-4d1f-9c55-2f7d1a2e9c41"},
+  "type": "charge.succeeded"
+}
+""")
+
+RECORDED_CHARGE_REFUNDED = json.loads("""
+{
+  "id": "evt_3NqA8bH2eZvKYlo21Vv0aTf2",
+  "object": "event",
+  "account": "acct_1NqA2xH2eZvKYlo2",
+  "api_version": "2020-08-27",
+  "created": 1695052000,
+  "data": {
+    "object": {
+      "id": "ch_3NqA8bH2eZvKYlo21Yw2Jd7p",
+      "object": "charge",
+      "amount": 2800,
+      "amount_captured": 2800,
+      "amount_refunded": 2800,
+      "captured": true,
+      "created": 1695051233,
+      "currency": "usd",
+      "description": "LUX payment",
+      "livemode": false,
+      "paid": true,
+      "refunded": true,
+      "status": "succeeded"
+    },
+    "previous_attributes": {"amount_refunded": 0, "refunded": false}
+  },
+  "livemode": false,
+  "pending_webhooks": 1,
+  "request": {"id": "req_Wk3Tq9xY1aBcDe", "idempotency_key": null},
+  "type": "charge.refunded"
+}
+""")
+
+
+def charge_event(template, account_id, charge_id, created, amount=None, event_id=None):
+    event = copy.deepcopy(template)
+    event['id'] = event_id or f"evt_{charge_id}_{event['type']}"
+    event['account'] = account_id
+    event['created'] = created
+    charge = event['data']['object']
+    charge['id'] = charge_id
+    charge['created'] = created - 1
+    if amount is not None:
+        charge['amount'] = amount
+    return event
+
+
+def signed(event, secret=WEBHOOK_SECRET):
+    payload = json.dumps(event)
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return payload, {'Stripe-Signature': f"t={timestamp},v1={signature}"}
+
+
+class FakeStripeCharges:
+    """GET /v1/charges with limit / starting_after pagination per Stripe-Account"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.list_calls = 0
+        self.charges = {}  # account id -> newest-first charge dicts
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                fake.list_calls += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                charges = fake.charges.get(self.headers.get('Stripe-Account'), [])
+                start = 0
+                if 'starting_after' in query:
+                    start = [c['id'] for c in charges].index(query['starting_after']) + 1
+                limit = int(query.get('limit', 10))
+                page = charges[start:start + limit]
+                data = json.dumps({'object': 'list', 'url': '/v1/charges', 'data': page,
+                                   'has_more': start + limit < len(charges)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency-ms', type=float, default=300.0, help='fake Stripe Charge.list delay')
+    parser.add_argument('--polls', type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ['STRIPE_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    app, *_ = setup_environment()
+    import stripe
+    from fake_firestore import FakeFirestore
+
+    fake = FakeStripeCharges(latency=args.latency_ms / 1000)
+    stripe.api_base = fake.url
+    app.db = FakeFirestore()
+    client = app.app.test_client()
+    ring = app.RECENT_CHARGES_PER_ACCOUNT
+    checks = {}
+    failures = []
+
+    def check(name, ok, **details):
+        checks[name] = dict(details, ok=bool(ok))
+        if not ok:
+            failures.append(name)
+
+    def poll(account_id):
+        return client.post('/get-recent-charge', json={'account_id': account_id}).get_json()
+
+    def deliver(event, secret=WEBHOOK_SECRET, test_client=None):
+        payload, headers = signed(event, secret)
+        return (test_client or client).post('/stripe/webhook', data=payload, headers=headers,
+                                            content_type='application/json')
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # 1. Cold start: the first poll backfills through paginated Charge.list, later polls don't
+        cold = 'acct_cold'
+        base = int(time.time()) - 10_000
+        fake.charges[cold] = [
+            dict(RECORDED_CHARGE_SUCCEEDED['data']['object'], id=f"ch_cold{i:03d}", created=base - i,
+                 amount=1000 + i, status='failed' if i < 25 else 'succeeded')
+            for i in range(60)
+        ]
+        first = poll(cold)
+        calls_after_first = fake.list_calls
+        for _ in range(5):
+            poll(cold)
+        check('cold_start_backfill', first.get('amount') == 1025 and fake.list_calls == calls_after_first,
+              amount=first.get('amount'), list_calls=calls_after_first)
+
+        # 2. Recorded charge.succeeded event makes the next poll answer without Stripe
+        live = RECORDED_CHARGE_SUCCEEDED['account']
+        calls_before = fake.list_calls
+        response = deliver(RECORDED_CHARGE_SUCCEEDED)
+        result = poll(live)
+        check('charge_succeeded_indexed', response.status_code == 200 and result.get('amount') == 2800
+              and fake.list_calls == calls_before, webhook_status=response.status_code, poll=result)
+
+        # 3. Refund, then a late redelivery of the older succeeded event: the refund sticks
+        deliver(RECORDED_CHARGE_REFUNDED)
+        deliver(RECORDED_CHARGE_SUCCEEDED)
+        indexed = app.recent_charges.recent(live)[0]
+        check('refund_survives_redelivery', indexed['refunded'] and indexed['amount_refunded'] == 2800,
+              charge=indexed)
+
+        # 4. A burst of charges stays bounded and newest-first
+        now = int(time.time())
+        for i in range(ring + 15):
+            deliver(charge_event(RECORDED_CHARGE_SUCCEEDED, live, f"ch_burst{i:03d}", now + i, amount=5000 + i))
+        charges = app.recent_charges.recent(live)
+        check('ring_bounded', len(charges) == ring and charges[0]['id'] == f"ch_burst{ring + 14:03d}"
+              and poll(live).get('amount') == 5000 + ring + 14, size=len(charges), ring=ring)
+
+        # 5. Bad signature is rejected and changes nothing
+        forged = charge_event(RECORDED_CHARGE_SUCCEEDED, live, 'ch_forged', now + 10_000, amount=1)
+        response = deliver(forged, secret='whsec_wrong')
+        check('forged_event_rejected', response.status_code == 400 and poll(live).get('amount') != 1,
+              status=response.status_code)
+
+        # 6. Concurrent webhooks for one new account: the first writes race on create(), the rest
+        #    on the update_time precondition; every charge must survive the retries
+        burst_account = 'acct_concurrent'
+        burst = [charge_event(RECORDED_CHARGE_SUCCEEDED, burst_account, f"ch_concurrent{i:03d}", now + i, amount=700 + i)
+                 for i in range(ring)]
+        app.db.latency = 0.005
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            statuses = list(pool.map(lambda event: deliver(event, test_client=app.app.test_client()).status_code, burst))
+        app.db.latency = 0.0
+        stored = app.db.collection('recent_charges').document(burst_account).get().to_dict()['charges']
+        check('concurrent_webhooks_kept', statuses == [200] * ring
+              and sorted(c['id'] for c in stored) == sorted(e['data']['object']['id'] for e in burst),
+              delivered=statuses.count(200), stored=len(stored))
+
+        # 7. An account with no succeeded charges is listed once, then answered from the marker
+        fake.charges['acct_empty'] = [dict(RECORDED_CHARGE_SUCCEEDED['data']['object'], id=f"ch_empty{i:03d}",
+                                           created=base - i, status='failed') for i in range(5)]
+        calls_before = fake.list_calls
+        first = poll('acct_empty')
+        calls_after_first = fake.list_calls
+        for _ in range(5):
+            poll('acct_empty')
+        check('empty_account_marker', first.get('success') is False and calls_after_first > calls_before
+              and fake.list_calls == calls_after_first, list_calls=fake.list_calls - calls_before)
+
+        # 8. Another worker, fed only by the listener, serves the same answer
+        other_worker = app.RecentChargeIndex()
+        other_worker.start()
+        check('shared_across_workers', other_worker.recent(live) == app.recent_charges.recent(live))
+
+        # 9. Poll latency: index vs the old per-poll Charge.list
+        index_latencies = []
+        for _ in range(args.polls):
+            start = time.perf_counter()
+            poll(live)
+            index_latencies.append(time.perf_counter() - start)
+        api_latencies = []
+        for _ in range(max(5, args.polls // 20)):
+            start = time.perf_counter()
+            stripe.Charge.list(limit=1, stripe_account=live)
+            api_latencies.append(time.perf_counter() - start)
+
+    print(json.dumps({
+        'checks': checks,
+        'poll_from_index': percentiles(index_latencies),
+        'charge_list_call': percentiles(api_latencies),
+        'index_stats': app.recent_charges.stats(),
+        'failures': failures,
+    }, indent=2, default=str))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""Exactly-once transfer checks against a local fake Stripe API.
+
+The fake server implements POST /v1/transfers with Stripe's idempotency
+semantics: a repeated Idempotency-Key replays the original transfer, a key
+still in flight answers 409 (which stripe-python retries), and a key reused
+with different parameters answers 400. It counts the transfers it actually
+created, so duplicates are visible.
+
+    python bench_transfers.py --transactions 200 --duplicates 5 --concurrency 32 --latency-ms 50
+
+Exits non-zero if any transaction was paid more than once.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+from werkzeug.serving import make_server
+
+from bench_wallet_pass import setup_environment
+
+
+class FakeStripe:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.transfers = {}   # transfer id -> params
+        self.keys = {}        # idempotency key -> (params, response) or None while in flight
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                status, payload = fake.create_transfer(self.headers.get('Idempotency-Key'), parse_qs(body))
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def create_transfer(self, key, params):
+        with self.lock:
+            self.requests += 1
+            if key in self.keys:
+                stored = self.keys[key]
+                if stored is None:
+                    return 409, {'error': {'type': 'idempotency_error',
+                                           'message': 'Another request with this key is in progress'}}
+                if stored[0] != params:
+                    return 400, {'error': {'type': 'idempotency_error',
+                                           'message': 'Keys for idempotent requests can only be used with the same parameters'}}
+                return 200, stored[1]
+            if key:
+                self.keys[key] = None
+
+        if self.latency:
+            time.sleep(self.latency)
+        transfer_id = f"tr_fake{next(self.ids):08d}"
+        response = {'id': transfer_id, 'object': 'transfer', 'amount': int(params['amount'][0]),
+                    'currency': params['currency'][0], 'destination': params['destination'][0]}
+        with self.lock:
+            self.transfers[transfer_id] = params
+            if key:
+                self.keys[key] = (params, response)
+        return 200, response
+
+
+def balance_payment(transaction_id, base_cents=2500, tip_cents=300):
+    return {
+        'merchant_stripe_account': f"acct_{transaction_id[-3:]}",
+        'amount_cents': base_cents + tip_cents,
+        'base_amount_cents': base_cents,
+        'tip_amount_cents': tip_cents,
+        'merchant_rate': 3,
+        'transaction_id': transaction_id,
+    }
+
+
+def submit_all(base_url, bodies, concurrency, path='/create-balance-payment'):
+    local = threading.local()
+
+    def submit(body):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        response = session.post(base_url + path, json=body)
+        return body.get('transaction_id'), response.status_code, response.json()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(submit, bodies))
+
+
+class StalledLedgerRead:
+    """Firestore client whose pending-ledger query answers with a listing taken when it was
+    created, like a settlement run whose read finished just before another run paid those entries"""
+
+    def __init__(self, client):
+        self.client = client
+        self.listing = list(client.collection('settlement_ledger').where('status', '==', 'pending').stream())
+
+    def collection(self, name):
+        collection = self.client.collection(name)
+        if name != 'settlement_ledger':
+            return collection
+        listing = self.listing
+
+        class Ledger:
+            def where(self, *args):
+                return self
+
+            def stream(self):
+                return iter(listing)
+
+            def __getattr__(self, attr):
+                return getattr(collection, attr)
+
+        return Ledger()
+
+    def __getattr__(self, attr):
+        return getattr(self.client, attr)
+
+
+def check_exactly_once(results, fake):
+    """Every transaction paid once and every duplicate answered with that same transfer"""
+    transfer_ids = {}
+    for transaction_id, status, body in results:
+        if status != 200:
+            return f"{transaction_id}: HTTP {status} {body}"
+        transfer_ids.setdefault(transaction_id, set()).add(body['transfer_id'])
+    split = {t: ids for t, ids in transfer_ids.items() if len(ids) > 1}
+    if split:
+        return f"transactions answered with different transfers: {split}"
+    paid = {}
+    for params in fake.transfers.values():
+        transaction_id = params['metadata[transaction_id]'][0]
+        paid[transaction_id] = paid.get(transaction_id, 0) + 1
+    twice = {t: n for t, n in paid.items() if n > 1}
+    if twice:
+        return f"transactions paid more than once: {twice}"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--transactions', type=int, default=200)
+    parser.add_argument('--duplicates', type=int, default=5, help='submissions per transaction')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='fake Stripe response delay')
+    args = parser.parse_args()
+
+    app, *_ = setup_environment()
+    import stripe
+    from fake_firestore import FakeFirestore
+
+    fake = FakeStripe(latency=args.latency_ms / 1000)
+    stripe.api_base = fake.url
+    stripe.api_key = 'sk_test_bench'
+    app.db = FakeFirestore()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    checks = {}
+    failures = []
+
+    def record(name, error, **details):
+        checks[name] = dict(details, ok=error is None)
+        if error:
+            failures.append(f"{name}: {error}")
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # 1. Concurrent duplicate submissions hitting one worker
+        bodies = [balance_payment(f"txn{i:06d}") for i in range(args.transactions)] * args.duplicates
+        start = time.perf_counter()
+        results = submit_all(base_url, bodies, args.concurrency)
+        elapsed = time.perf_counter() - start
+        record('concurrent_duplicates', check_exactly_once(results, fake),
+               submissions=len(bodies), transfers=len(fake.transfers), stripe_requests=fake.requests,
+               seconds=round(elapsed, 2))
+
+        # 2. Retries landing on a fresh worker (empty local cache): answered from the shared store
+        app.idempotent_transfers.results.entries.clear()
+        requests_before = fake.requests
+        results = submit_all(base_url, bodies[:args.transactions], args.concurrency)
+        record('retry_on_other_worker', check_exactly_once(results, fake) or (
+            f"{fake.requests - requests_before} Stripe calls" if fake.requests != requests_before else None),
+               stripe_requests=fake.requests - requests_before)
+
+        # 3. Two workers racing on the same keys before either has stored a result:
+        #    Stripe's idempotency key is what keeps this exactly-once
+        workers = [app.IdempotentTransfers(), app.IdempotentTransfers()]
+        transfers_before = len(fake.transfers)
+
+        def race(i):
+            params = {'amount': 1000, 'currency': 'usd', 'destination': 'acct_race',
+                      'description': 'race', 'metadata': {'transaction_id': f"race{i // 2:06d}"}}
+            key = app.IdempotentTransfers.key_for('transfer', f"race{i // 2:06d}")
+            response, _ = workers[i % 2].execute(key, params, lambda transfer: {'transfer_id': transfer.id})
+            return f"race{i // 2:06d}", 200, response
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(race, range(2 * args.transactions)))
+        record('cross_worker_race', check_exactly_once(results, fake),
+               transfers=len(fake.transfers) - transfers_before)
+
+        # 4. Same transaction id, different amount: refused, not paid
+        transfers_before = len(fake.transfers)
+        _, status, body = submit_all(base_url, [balance_payment('txn000000', base_cents=9999)], 1)[0]
+        record('conflicting_retry', None if status == 409 and len(fake.transfers) == transfers_before
+               else f"HTTP {status} {body}", status=status)
+
+        # 5. Two real keyless transfers with identical parameters: both paid, never replayed
+        transfers_before = len(fake.transfers)
+        keyless = {'destination_account': 'acct_keyless', 'amount_cents': 450, 'description': 'Tip payout',
+                   'metadata': {'reason': 'tip'}}
+        results = submit_all(base_url, [keyless, keyless], 1, path='/transfer-to-merchant')
+        transfer_ids = {body.get('transfer_id') for _, _, body in results}
+        record('keyless_not_replayed', None if len(transfer_ids) == 2 and len(fake.transfers) == transfers_before + 2
+               else f"{results}", transfers=len(fake.transfers) - transfers_before)
+
+        # 6. Overlapping settlement runs, then a late payment: every ledger entry in exactly one transfer
+        transfers_before = set(fake.transfers)
+        expected = {}
+
+        def ledger_payments(prefix, count):
+            for i in range(count):
+                destination = f"acct_settle{i % 4}"
+                app.record_settlement_entry(f"{prefix}{i:06d}", {
+                    'destination': destination, 'merchantReceives': 1000 + i, 'baseAmount': 1000 + i,
+                    'tipAmount': 0, 'rewardAmount': 0, 'platformFee': 0
+                })
+                expected[destination] = expected.get(destination, 0) + 1000 + i
+
+        ledger_payments('settle', args.transactions)
+        stalled = StalledLedgerRead(app.db)
+        schedulers = [app.SettlementScheduler() for _ in range(4)]
+        with ThreadPoolExecutor(max_workers=len(schedulers)) as pool:
+            list(pool.map(lambda scheduler: scheduler.settle(include_open=True), schedulers))
+        # A run that listed the entries as pending before the runs above paid them
+        client, app.db = app.db, stalled
+        try:
+            app.SettlementScheduler().settle(include_open=True)
+        finally:
+            app.db = client
+        ledger_payments('late', 1)
+        schedulers[0].settle(include_open=True)
+
+        paid = {}
+        for transfer_id in set(fake.transfers) - transfers_before:
+            params = fake.transfers[transfer_id]
+            paid[params['destination'][0]] = paid.get(params['destination'][0], 0) + int(params['amount'][0])
+        unsettled = [doc.id for doc in app.db.collection('settlement_ledger').stream()
+                     if doc.to_dict()['status'] != 'settled']
+        record('overlapping_settlements', None if paid == expected and not unsettled
+               else f"paid {paid}, expected {expected}, unsettled {unsettled[:5]}",
+               transfers=len(set(fake.transfers) - transfers_before))
+
+    server.shutdown()
+    summary = {'checks': checks, 'transfer_stats': app.idempotent_transfers.stats(), 'failures': failures}
+    print(json.dumps(summary, indent=2, default=str))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
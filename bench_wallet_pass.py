@@ -0,0 +1,375 @@
+"""Wallet pass benchmarks.
+
+Generates a throwaway CA (standing in for Apple WWDR) and pass signer cert,
+so no network and no Apple certificates are required.
+
+    python bench_wallet_pass.py signing   # in-process vs openssl subprocess, plus verify check
+    python bench_wallet_pass.py refresh   # /v1/passes no-change vs changed path on fake Firestore
+    python bench_wallet_pass.py pipeline --output results.json [--compare baseline.json]
+                                          # latency percentiles, passes/sec and per-phase cost
+"""
+import argparse
+import base64
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+
+def _make_cert(subject_cn, issuer_cert=None, issuer_key=None, is_ca=False):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject_cn)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(issuer_cert.subject if issuer_cert else subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.BasicConstraints(ca=is_ca, path_length=None), critical=True)
+    )
+    cert = builder.sign(issuer_key or key, hashes.SHA256())
+    return cert, key
+
+
+def make_throwaway_certs():
+    """Return PEM bytes for (signer cert, signer key, wwdr cert)"""
+    wwdr_cert, wwdr_key = _make_cert("Bench WWDR CA", is_ca=True)
+    pass_cert, pass_key = _make_cert("Bench Pass Signer", wwdr_cert, wwdr_key)
+    return (
+        pass_cert.public_bytes(serialization.Encoding.PEM),
+        pass_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()
+        ),
+        wwdr_cert.public_bytes(serialization.Encoding.PEM),
+    )
+
+
+def setup_environment():
+    """Point app.py at throwaway certs and credentials, then import it"""
+    cert_pem, key_pem, wwdr_pem = make_throwaway_certs()
+    os.environ['PASS_CERTIFICATE'] = base64.b64encode(cert_pem).decode()
+    os.environ['PASS_PRIVATE_KEY'] = base64.b64encode(key_pem).decode()
+    os.environ['WWDR_CERTIFICATE'] = base64.b64encode(wwdr_pem).decode()
+    os.environ.setdefault('PASS_TYPE_ID', 'pass.com.example.bench')
+    os.environ.setdefault('TEAM_ID', 'BENCHTEAM')
+    os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_bench')
+
+    if 'GOOGLE_APPLICATION_CREDENTIALS' not in os.environ:
+        # The Firestore client only needs parseable credentials to construct;
+        # nothing in the benchmark talks to Google
+        sa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = json.dumps({
+            'type': 'service_account',
+            'project_id': 'bench',
+            'private_key_id': 'bench',
+            'private_key': sa_key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()
+            ).decode(),
+            'client_email': 'bench@bench.iam.gserviceaccount.com',
+            'client_id': '0',
+            'token_uri': 'https://oauth2.googleapis.com/token',
+        })
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    return app, cert_pem, key_pem, wwdr_pem
+
+
+def sign_with_openssl(temp_dir, manifest_data):
+    """The pre-existing subprocess signing path, kept here for comparison"""
+    manifest_path = os.path.join(temp_dir, 'manifest.json')
+    signature_path = os.path.join(temp_dir, 'signature')
+    with open(manifest_path, 'wb') as f:
+        f.write(manifest_data)
+    subprocess.run([
+        'openssl', 'smime', '-sign', '-binary',
+        '-signer', os.path.join(temp_dir, 'cert.pem'),
+        '-inkey', os.path.join(temp_dir, 'key.pem'),
+        '-certfile', os.path.join(temp_dir, 'wwdr.pem'),
+        '-in', manifest_path,
+        '-out', signature_path,
+        '-outform', 'DER'
+    ], check=True, capture_output=True)
+    with open(signature_path, 'rb') as f:
+        return f.read()
+
+
+def verify_with_openssl(temp_dir, manifest_data, signature):
+    """Run `openssl smime -verify` over a detached DER signature"""
+    manifest_path = os.path.join(temp_dir, 'verify-manifest.json')
+    signature_path = os.path.join(temp_dir, 'verify-signature')
+    with open(manifest_path, 'wb') as f:
+        f.write(manifest_data)
+    with open(signature_path, 'wb') as f:
+        f.write(signature)
+    result = subprocess.run([
+        'openssl', 'smime', '-verify', '-binary',
+        '-inform', 'DER',
+        '-in', signature_path,
+        '-content', manifest_path,
+        '-CAfile', os.path.join(temp_dir, 'wwdr.pem'),
+        '-purpose', 'any',
+        '-out', os.devnull
+    ], capture_output=True, text=True)
+    return result.returncode == 0, result.stderr.strip()
+
+
+def rate(fn, seconds):
+    """Call fn repeatedly for ~seconds and return calls per second"""
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        fn()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def bench_signing(app, cert_pem, key_pem, wwdr_pem, seconds):
+    manifest_data = json.dumps({
+        'pass.json': 'da39a3ee5e6b4b0d3255bfef95601890afd80709',
+        'icon.png': 'da39a3ee5e6b4b0d3255bfef95601890afd80709',
+        'icon@2x.png': 'da39a3ee5e6b4b0d3255bfef95601890afd80709',
+    }, indent=2).encode()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, data in (('cert.pem', cert_pem), ('key.pem', key_pem), ('wwdr.pem', wwdr_pem)):
+            with open(os.path.join(temp_dir, name), 'wb') as f:
+                f.write(data)
+
+        in_process_sig = app.sign_manifest(manifest_data)
+        ok, err = verify_with_openssl(temp_dir, manifest_data, in_process_sig)
+        print(f"openssl smime -verify (in-process signature): {'OK' if ok else 'FAILED ' + err}")
+        tampered_ok, _ = verify_with_openssl(temp_dir, manifest_data + b' ', in_process_sig)
+        print(f"openssl smime -verify (tampered manifest rejected): {'OK' if not tampered_ok else 'FAILED'}")
+
+        in_process = rate(lambda: app.sign_manifest(manifest_data), seconds)
+        forked = rate(lambda: sign_with_openssl(temp_dir, manifest_data), seconds)
+
+    return {
+        'verifies': ok,
+        'tamper_rejected': not tampered_ok,
+        'in_process_signatures_per_sec': round(in_process, 1),
+        'subprocess_signatures_per_sec': round(forked, 1),
+        'speedup': round(in_process / forked, 1) if forked else None,
+    }
+
+
+def percentiles(samples):
+    """p50/p95/p99 of a list of seconds, in milliseconds"""
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {'p50_ms': round(pick(0.50), 3), 'p95_ms': round(pick(0.95), 3), 'p99_ms': round(pick(0.99), 3)}
+
+
+def bench_state(i):
+    """A representative pass request; vary i to defeat the pass cache"""
+    return {
+        'user_id': f'bench-user-{i}', 'merchant_id': 'bench-merchant', 'merchant_name': 'Bench Cafe',
+        'location': {'lat': 34.05, 'lng': -118.24}, 'stamps': [{'emoji': '☕'}] * (i % 21),
+        'sat_back': i % 8, 'credit_balance': 0, 'user_balance': 12.5 + i,
+        'is_nonprofit': False, 'has_qr_payments': True,
+    }
+
+
+def run_concurrent(fn, concurrency, iterations):
+    """Call fn(i) iterations times from `concurrency` threads; latency percentiles and throughput"""
+    latencies = [0.0] * iterations
+
+    def call(i):
+        start = time.perf_counter()
+        fn(i)
+        latencies[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(iterations)))
+    elapsed = time.perf_counter() - start
+    return dict(percentiles(latencies), per_sec=round(iterations / elapsed, 1))
+
+
+def bench_phases(app, iterations):
+    """Single-threaded cost of each create_pkpass_manually phase"""
+    phases = {'json_build': [], 'manifest_hashing': [], 'signing': [], 'zip': []}
+    for i in range(iterations):
+        state = bench_state(i)
+        t0 = time.perf_counter()
+        pass_json_data = app.render_pass_json(state)
+        t1 = time.perf_counter()
+        manifest_data = app.build_manifest(pass_json_data)
+        t2 = time.perf_counter()
+        signature = app.sign_manifest(manifest_data)
+        t3 = time.perf_counter()
+        app.zip_pkpass(pass_json_data, manifest_data, signature, app.PASS_STORE_IMAGES)
+        t4 = time.perf_counter()
+        for name, elapsed in zip(phases, (t1 - t0, t2 - t1, t3 - t2, t4 - t3)):
+            phases[name].append(elapsed)
+
+    total = sum(sum(samples) for samples in phases.values())
+    return {
+        name: dict(percentiles(samples),
+                   mean_ms=round(sum(samples) / len(samples) * 1000, 4),
+                   share=round(sum(samples) / total, 3))
+        for name, samples in phases.items()
+    }
+
+
+def bench_pipeline(app, iterations, concurrency_levels):
+    from fake_firestore import FakeFirestore
+
+    app.db = FakeFirestore()
+    # Size admission control to the benchmark so it measures throughput, not shedding
+    top = max(concurrency_levels)
+    app.signing_executor = app.SigningExecutor(top, top)
+    client = app.app.test_client()
+
+    targets = {
+        'format_stamps_for_pass': lambda i: app.format_stamps_for_pass(bench_state(i)['stamps']),
+        'generate_auth_token': lambda i: app.generate_auth_token(f'bench-user-{i}-bench-merchant'),
+        'create_pkpass_manually': lambda i: app.create_pkpass_manually(app.render_pass_json(bench_state(i))),
+        'generate_wallet_pass': lambda i: client.post('/generate-wallet-pass', json=bench_state(i)),
+    }
+
+    results = {'phases': bench_phases(app, iterations), 'targets': {}}
+    offset = 0
+    for name, fn in targets.items():
+        results['targets'][name] = {}
+        for concurrency in concurrency_levels:
+            # Fresh users each run so the pass cache never short-circuits signing
+            run = lambda i, fn=fn, offset=offset: fn(offset + i)
+            results['targets'][name][str(concurrency)] = run_concurrent(run, concurrency, iterations)
+            offset += iterations
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    """Print p50 and throughput deltas against an earlier results file"""
+    for name, levels in results['targets'].items():
+        for concurrency, current in levels.items():
+            previous = baseline.get('targets', {}).get(name, {}).get(concurrency)
+            if not previous:
+                continue
+            p50 = (current['p50_ms'] - previous['p50_ms']) / previous['p50_ms'] * 100 if previous['p50_ms'] else 0
+            rate = (current['per_sec'] - previous['per_sec']) / previous['per_sec'] * 100 if previous['per_sec'] else 0
+            print(f"{name:<24} c={concurrency:<3} p50 {p50:+6.1f}%  per_sec {rate:+6.1f}%")
+
+
+def bench_refresh(app, iterations, latency):
+    """Time the Wallet refresh endpoint when nothing changed vs when state changed"""
+    from fake_firestore import FakeFirestore
+
+    app.db = FakeFirestore(latency=latency)
+    client = app.app.test_client()
+    state = {
+        'user_id': 'bench-user', 'merchant_id': 'bench-merchant', 'merchant_name': 'Bench Cafe',
+        'location': {'lat': 34.05, 'lng': -118.24}, 'stamps': [{'emoji': '☕'}] * 7,
+        'sat_back': 3, 'credit_balance': 0, 'user_balance': 12.5,
+        'is_nonprofit': False, 'has_qr_payments': True,
+    }
+    client.post('/generate-wallet-pass', json=state)
+    serial = f"{state['user_id']}-{state['merchant_id']}"
+    url = f"/v1/passes/{app.PASS_TYPE_ID}/{serial}"
+    auth = {'Authorization': f"ApplePass {app.generate_auth_token(serial)}"}
+
+    def timed(headers):
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        return time.perf_counter() - start, response.status_code
+
+    # No-change poll: Wallet sends back the Last-Modified it last saw
+    last_modified = client.get(url, headers=auth).headers['Last-Modified']
+    app.db.reset_counters()
+    unchanged = [timed(dict(auth, **{'If-Modified-Since': last_modified})) for _ in range(iterations)]
+    unchanged_reads = app.db.counters['reads']
+
+    # Changed path: every poll sees a new balance, so the pass is rebuilt and re-signed
+    changed = []
+    for i in range(iterations):
+        state['user_balance'] = 12.5 + i + 1
+        app.record_pass_state(serial, state)
+        app.db.reset_counters()
+        changed.append(timed(dict(auth, **{'If-Modified-Since': formatdate(0, usegmt=True)})))
+    changed_reads = app.db.counters['reads']
+
+    return {
+        'firestore_latency_ms': latency * 1000,
+        'no_change': dict(percentiles([t for t, _ in unchanged]),
+                          statuses=sorted({code for _, code in unchanged}),
+                          firestore_reads_per_poll=unchanged_reads / iterations),
+        'changed': dict(percentiles([t for t, _ in changed]),
+                        statuses=sorted({code for _, code in changed}),
+                        firestore_reads_last_poll=changed_reads),
+        'pass_cache': app.pass_cache.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('suite', nargs='?', default='signing', choices=['signing', 'refresh', 'pipeline'])
+    parser.add_argument('--seconds', type=float, default=3.0, help='time spent on each signing measurement')
+    parser.add_argument('--iterations', type=int, default=200, help='requests per measurement')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='simulated Firestore round trip')
+    parser.add_argument('--concurrency', default='1,2,4,8', help='comma-separated pipeline concurrency levels')
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    parser.add_argument('--compare', help='earlier pipeline results JSON to diff against')
+    args = parser.parse_args()
+
+    app, cert_pem, key_pem, wwdr_pem = setup_environment()
+    if args.suite == 'signing':
+        results = bench_signing(app, cert_pem, key_pem, wwdr_pem, args.seconds)
+    elif args.suite == 'refresh':
+        results = bench_refresh(app, args.iterations, args.latency_ms / 1000)
+    else:
+        levels = [int(level) for level in args.concurrency.split(',')]
+        # app.py logs every pass; keep that cost in the numbers but out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = bench_pipeline(app, args.iterations, levels)
+
+    results['meta'] = {
+        'suite': args.suite,
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'iterations': args.iterations,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.suite == 'signing' and not (results['verifies'] and results['tamper_rejected']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
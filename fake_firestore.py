@@ -0,0 +1,412 @@
+"""In-process Firestore stand-in for benchmarks and load tests.
+
+Implements the slice of the google-cloud-firestore client API that app.py
+uses, backed by dicts, with an optional per-call latency to mimic network
+round trips. Swap it in with `app.db = FakeFirestore(latency=0.005)`.
+"""
+import copy
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import Aborted, AlreadyExists, FailedPrecondition, NotFound
+from google.cloud import firestore
+
+
+def _field(data, path):
+    """Look up a dotted field path ('state.merchant_id') in a document dict"""
+    for part in path.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeWriteOption:
+    """Precondition from write_option(); checked when the write is applied"""
+
+    def __init__(self, last_update_time=None, exists=None):
+        self.last_update_time = last_update_time
+        self.exists = exists
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+        self.id = path[-1]
+
+    @property
+    def path(self):
+        return '/'.join(self._path)
+
+    def collection(self, name):
+        return FakeCollectionReference(self._client, self._path + (name,))
+
+    def get(self, transaction=None):
+        self._client._round_trip('reads')
+        with self._client._lock:
+            snapshot = self._client._snapshot(self._path)
+        if transaction is not None:
+            transaction._reads[self._path] = snapshot.update_time
+        return snapshot
+
+    def set(self, data, merge=False):
+        self._client._round_trip('writes')
+        self._client._write(self._path, data, merge=merge)
+
+    def create(self, data):
+        self._client._round_trip('writes')
+        self._client._create(self._path, data)
+
+    def update(self, data, option=None):
+        self._client._round_trip('writes')
+        with self._client._lock:
+            self._client._check(self._path, option, must_exist=True)
+            self._client._write(self._path, data, merge=True)
+
+    def delete(self, option=None):
+        self._client._round_trip('writes')
+        with self._client._lock:
+            self._client._check(self._path, option)
+            self._client._delete(self._path)
+
+
+class FakeQuery:
+    _OPS = {
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<': lambda a, b: a is not None and a < b,
+        '<=': lambda a, b: a is not None and a <= b,
+        '>': lambda a, b: a is not None and a > b,
+        '>=': lambda a, b: a is not None and a >= b,
+        'in': lambda a, b: a in b,
+        'array_contains': lambda a, b: b in (a or []),
+    }
+
+    def __init__(self, client, path, filters=(), order=None, limit=None, start_after=None):
+        self._client = client
+        self._path = path
+        self._filters = filters
+        self._order = order
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        params = dict(filters=self._filters, order=self._order, limit=self._limit,
+                      start_after=self._start_after)
+        params.update(changes)
+        return FakeQuery(self._client, self._path, **params)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(order=(field, direction))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(start_after=snapshot)
+
+    def _matches(self):
+        with self._client._lock:
+            rows = [
+                (path, copy.deepcopy(data), self._client._update_times.get(path))
+                for path, data in self._client._docs.items()
+                if path[:-1] == self._path and all(
+                    self._OPS[op](_field(data, field), value) for field, op, value in self._filters)
+            ]
+        if self._order:
+            field, direction = self._order
+            rows.sort(key=lambda row: (_field(row[1], field) is None, _field(row[1], field), row[0]),
+                      reverse=direction == 'DESCENDING')
+        else:
+            rows.sort(key=lambda row: row[0])
+        if self._start_after is not None:
+            keys = [row[0] for row in rows]
+            marker = tuple(self._start_after.reference._path)
+            rows = rows[keys.index(marker) + 1:] if marker in keys else rows
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return rows
+
+    def stream(self):
+        self._client._round_trip('reads')
+        return iter([
+            FakeSnapshot(FakeDocumentReference(self._client, path), data, update_time)
+            for path, data, update_time in self._matches()
+        ])
+
+    def get(self):
+        return list(self.stream())
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path[-1]
+
+    def document(self, doc_id=None):
+        if doc_id is not None and (not isinstance(doc_id, str) or '/' in doc_id):
+            # The real client splits ids on '/' and rejects the resulting collection path
+            raise ValueError(f"A document must have an even number of path elements: {doc_id!r}")
+        return FakeDocumentReference(self._client, self._path + (doc_id or self._client._new_id(),))
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return datetime.now(timezone.utc), ref
+
+    def on_snapshot(self, callback):
+        return self._client._listen(self._path, callback)
+
+
+class FakeWatch:
+    """Handle returned by on_snapshot; set is_active False to simulate a dropped listener"""
+
+    def __init__(self, client, path, callback):
+        self._client = client
+        self.path = path
+        self.callback = callback
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+        with self._client._lock:
+            if self in self._client._watches:
+                self._client._watches.remove(self)
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, reference, data, merge=False):
+        self._ops.append(('set', reference, data, merge, None))
+
+    def create(self, reference, data):
+        self._ops.append(('create', reference, data, False, FakeWriteOption(exists=False)))
+
+    def update(self, reference, data, option=None):
+        self._ops.append(('update', reference, data, True, option))
+
+    def delete(self, reference, option=None):
+        self._ops.append(('delete', reference, None, False, option))
+
+    def commit(self):
+        # One round trip for the whole batch, like the real client
+        self._client._round_trip('writes')
+        with self._client._lock:
+            # All-or-nothing: any failed precondition fails the whole batch
+            written = set()
+            for op, reference, _, _, option in self._ops:
+                # Writes apply in order, so an update may follow a set of the same document
+                if reference._path not in written:
+                    self._client._check(reference._path, option, must_exist=op == 'update')
+                written.add(reference._path)
+            for op, reference, data, merge, _ in self._ops:
+                if op == 'delete':
+                    self._client._delete(reference._path)
+                else:
+                    self._client._write(reference._path, data, merge=merge)
+        self._ops = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Enough of Transaction for @firestore.transactional: reads are remembered and the
+    commit aborts (and is retried by the decorator) if any of them changed meanwhile"""
+
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, client):
+        super().__init__(client)
+        self._id = None
+        self._reads = {}
+
+    def _clean_up(self):
+        self._ops = []
+        self._reads = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = self._client._new_id()
+
+    def _rollback(self):
+        self._clean_up()
+
+    def get_all(self, references):
+        snapshots = list(self._client.get_all(references))
+        for snapshot in snapshots:
+            self._reads[snapshot.reference._path] = snapshot.update_time
+        return iter(snapshots)
+
+    def _commit(self):
+        with self._client._lock:
+            for path, update_time in self._reads.items():
+                if self._client._update_times.get(path) != update_time:
+                    raise Aborted(f"Transaction {self._id} read {'/'.join(path)}, which changed before commit")
+            self.commit()
+        self._clean_up()
+
+
+class FakeFirestore:
+    """Dict-backed Firestore client with configurable per-call latency"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counters = {'reads': 0, 'writes': 0}
+        self._docs = {}
+        self._update_times = {}
+        self._last_update_time = None
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._watches = []
+
+    def _round_trip(self, kind):
+        with self._lock:
+            self.counters[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _new_id(self):
+        return f"auto{next(self._ids):08d}"
+
+    def _stamp(self):
+        # Strictly increasing, like commit times on the real server
+        now = datetime.now(timezone.utc)
+        if self._last_update_time and now <= self._last_update_time:
+            now = self._last_update_time + timedelta(microseconds=1)
+        self._last_update_time = now
+        return now
+
+    def _snapshot(self, path):
+        return FakeSnapshot(FakeDocumentReference(self, path), copy.deepcopy(self._docs.get(path)),
+                            self._update_times.get(path))
+
+    def _check(self, path, option, must_exist=False):
+        """Raise like the server when a write precondition doesn't hold"""
+        exists = path in self._docs
+        if must_exist and not exists:
+            raise NotFound(f"No document to update: {'/'.join(path)}")
+        if option is None:
+            return
+        if option.exists is False and exists:
+            raise AlreadyExists(f"Document already exists: {'/'.join(path)}")
+        if option.exists and not exists:
+            raise NotFound(f"No document to update: {'/'.join(path)}")
+        if option.last_update_time is not None and option.last_update_time != self._update_times.get(path):
+            raise FailedPrecondition(f"Document {'/'.join(path)} changed since {option.last_update_time}")
+
+    def write_option(self, last_update_time=None, exists=None):
+        return FakeWriteOption(last_update_time=last_update_time, exists=exists)
+
+    def _resolve(self, current, value):
+        if value is firestore.SERVER_TIMESTAMP:
+            return datetime.now(timezone.utc)
+        if isinstance(value, firestore.Increment):
+            return (current or 0) + value.value
+        if isinstance(value, firestore.ArrayUnion):
+            return list(current or []) + [v for v in value.values if v not in (current or [])]
+        if isinstance(value, firestore.ArrayRemove):
+            return [v for v in (current or []) if v not in value.values]
+        return copy.deepcopy(value)
+
+    def _merge(self, current, data):
+        # Nested maps merge field by field, like set(merge=True)
+        updated = dict(current)
+        for key, value in data.items():
+            if isinstance(value, dict) and isinstance(current.get(key), dict):
+                updated[key] = self._merge(current[key], value)
+            elif isinstance(value, dict):
+                updated[key] = self._merge({}, value)
+            else:
+                updated[key] = self._resolve(current.get(key), value)
+        return updated
+
+    def _write(self, path, data, merge=False):
+        with self._lock:
+            existed = path in self._docs
+            updated = self._merge(self._docs.get(path, {}) if merge else {}, data)
+            self._docs[path] = updated
+            update_time = self._update_times[path] = self._stamp()
+        self._notify(path, 'MODIFIED' if existed else 'ADDED', updated, update_time)
+
+    def _create(self, path, data):
+        with self._lock:
+            self._check(path, FakeWriteOption(exists=False))
+            self._write(path, data)
+
+    def _delete(self, path):
+        with self._lock:
+            removed = self._docs.pop(path, None)
+            update_time = self._update_times.pop(path, None)
+        if removed is not None:
+            self._notify(path, 'REMOVED', removed, update_time)
+
+    def _collection_snapshots(self, path):
+        return [self._snapshot(doc_path) for doc_path in sorted(self._docs) if doc_path[:-1] == path]
+
+    def _listen(self, path, callback):
+        watch = FakeWatch(self, path, callback)
+        with self._lock:
+            self._watches.append(watch)
+            docs = self._collection_snapshots(path)
+        changes = [SimpleNamespace(type=SimpleNamespace(name='ADDED'), document=doc) for doc in docs]
+        callback(docs, changes, datetime.now(timezone.utc))
+        return watch
+
+    def _notify(self, path, change_type, data, update_time):
+        with self._lock:
+            watches = [w for w in self._watches if w.is_active and w.path == path[:-1]]
+        if not watches:
+            return
+        document = FakeSnapshot(FakeDocumentReference(self, path), copy.deepcopy(data), update_time)
+        change = SimpleNamespace(type=SimpleNamespace(name=change_type), document=document)
+        for watch in watches:
+            # Listeners get the changed document; the full docs list is only built on subscribe
+            watch.callback([], [change], datetime.now(timezone.utc))
+
+    def collection(self, name):
+        return FakeCollectionReference(self, (name,))
+
+    def document(self, path):
+        return FakeDocumentReference(self, tuple(path.split('/')))
+
+    def get_all(self, references):
+        self._round_trip('reads')
+        with self._lock:
+            return iter([self._snapshot(ref._path) for ref in references])
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def reset_counters(self):
+        with self._lock:
+            self.counters = {key: 0 for key in self.counters}